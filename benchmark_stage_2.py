@@ -0,0 +1,439 @@
+import os
+import json
+import math
+import time
+import argparse
+import statistics
+from functools import partial
+
+import torch
+from omegaconf import OmegaConf
+from PIL import Image
+from torchvision import transforms
+
+from musepose.utils.util import read_frames
+from inference.attention import apply_attention_plan, attention_kinds, extend_position_encoding, matrix_bytes
+from inference.cpu import add_cpu_args, configure_threads
+from inference.parallel_windows import WindowWorkerPool
+from inference.samplers import SAMPLERS, make_scheduler
+from inference.memory import peak_rss
+from inference.vae_decode import iter_decode
+from inference.video_writer import BackgroundEncoder, StreamingVideoWriter
+from test_stage_2 import build_pipeline, cpu_options, get_device, iter_test_cases
+
+
+'''
+    Benchmarks of the Pose2Video pipeline on the first test case of a config.
+
+    steps    seconds per denoising step at each resolution (one context window, first step
+             excluded as warm-up), e.g. for the cpu mode:
+             python benchmark_stage_2.py steps --resolutions 512 768 --cpu_bf16 auto
+    windows  seconds per step, speedup, scaling efficiency and max deviation from the serial
+             path with the windows shared by 1, 2, 4 ... processes:
+             python benchmark_stage_2.py windows --workers 0 1 3 --threads 16
+    samplers wall time and quality proxies per sampler and step count against a DDIM reference
+             with many steps (same seed): PSNR to the reference, CLIP similarity to the reference
+             image, and frame-to-frame flicker relative to the reference:
+             python benchmark_stage_2.py samplers --samplers ddim dpmpp_2m unipc euler_a --steps 8 12 20
+    deep_cache
+             seconds, speedup and quality proxies (PSNR to the run without reuse, CLIP similarity,
+             flicker) of DeepCache-style feature reuse per cache interval, on the dance pose video:
+             python benchmark_stage_2.py deep_cache --intervals 1 2 3 5 --depth 1
+    decode   VAE decode frames per second per micro-batch / tile setting, alone and overlapped
+             with x264 in a background thread, and the max deviation from frame-by-frame decoding:
+             python benchmark_stage_2.py decode --micro_batches 1 4 8 --tiles 0 48
+    temporal seconds and memory of one motion module attention per context length and temporal
+             window (0 = full attention), and the max deviation from full attention:
+             python benchmark_stage_2.py temporal --frames 48 128 256 --windows 0 16 32 64
+'''
+
+
+def load_case(config, frames, ref_image_path=None, pose_video_path=None):
+    if ref_image_path is None or pose_video_path is None:
+        ref_image_path, pose_video_path = next(iter_test_cases(config))
+    ref_image = Image.open(ref_image_path).convert("RGB")
+    pose_images = read_frames(pose_video_path)[:frames]
+    return ref_image, pose_images
+
+
+def time_steps(pipe, ref_image, pose_images, width, height, steps, cfg, seed=42, **kwargs):
+    """Wall time of every denoising step of one pipeline call, and the final latents."""
+    stamps = []
+    final = {}
+
+    def callback(step, t, latents):
+        stamps.append(time.perf_counter())
+        final["latents"] = latents.clone()
+
+    start = time.perf_counter()
+    with pipe.autocast():
+        pipe(
+            ref_image,
+            pose_images,
+            width,
+            height,
+            len(pose_images),
+            steps,
+            cfg,
+            generator=torch.Generator().manual_seed(seed),
+            callback=callback,
+            callback_steps=1,
+            **dict(dict(context_frames=len(pose_images), context_overlap=0), **kwargs),
+        )
+    total = time.perf_counter() - start
+    step_times = [b - a for a, b in zip(stamps, stamps[1:])]
+    return step_times, total, final.get("latents")
+
+
+def bench_steps(pipe, config, args):
+    ref_image, pose_images = load_case(config, args.frames)
+    results = []
+    for resolution in args.resolutions:
+        step_times, total, _ = time_steps(
+            pipe, ref_image, pose_images, resolution, resolution, args.steps, args.cfg
+        )
+        results.append(dict(
+            resolution=resolution,
+            frames=len(pose_images),
+            steps=args.steps,
+            sec_per_step=statistics.median(step_times) if step_times else None,
+            total_sec=total,
+        ))
+        print(f"{resolution}x{resolution}, {len(pose_images)} frames: "
+              f"{results[-1]['sec_per_step']:.2f} s/step, {total:.1f}s total")
+    return results
+
+
+def bench_windows(pipe, config, args, build_fn):
+    ref_image, pose_images = load_case(config, args.frames)
+    results = []
+    serial = None
+    for workers in args.workers:
+        pipe.window_pool = WindowWorkerPool(build_fn, workers, num_threads=args.threads) if workers else None
+        try:
+            step_times, total, latents = time_steps(
+                pipe, ref_image, pose_images, args.resolution, args.resolution, args.steps, args.cfg,
+                context_frames=args.S, context_overlap=args.O,
+            )
+        finally:
+            if pipe.window_pool is not None:
+                pipe.window_pool.close()
+            pipe.window_pool = None
+
+        sec_per_step = statistics.median(step_times)
+        if serial is None:
+            serial = dict(sec_per_step=sec_per_step, latents=latents)
+        processes = workers + 1
+        results.append(dict(
+            processes=processes,
+            sec_per_step=sec_per_step,
+            speedup=serial["sec_per_step"] / sec_per_step,
+            efficiency=serial["sec_per_step"] / sec_per_step / processes,
+            max_abs_diff=(latents.float() - serial["latents"].float()).abs().max().item(),
+        ))
+        print(f"{processes} process(es): {sec_per_step:.2f} s/step, speedup {results[-1]['speedup']:.2f}x, "
+              f"efficiency {results[-1]['efficiency']:.0%}, max |diff| vs serial {results[-1]['max_abs_diff']:.3g}")
+    return results
+
+
+@torch.no_grad()
+def clip_similarity(pipe, video, ref_image, every=4):
+    """Mean cosine similarity of the CLIP image embeds of every `every`-th frame to the reference."""
+    frames = [
+        Image.fromarray((video[0, :, i].permute(1, 2, 0).numpy() * 255).round().astype("uint8"))
+        for i in range(0, video.shape[2], every)
+    ]
+    device, dtype = pipe._execution_device, pipe.image_encoder.dtype
+    pixels = pipe.clip_image_processor.preprocess([ref_image] + frames, return_tensors="pt").pixel_values
+    embeds = pipe.image_encoder(pixels.to(device, dtype)).image_embeds.float()
+    embeds = embeds / embeds.norm(dim=-1, keepdim=True)
+    return (embeds[1:] @ embeds[0]).mean().item()
+
+
+def flicker(video):
+    # mean absolute change between consecutive frames
+    return (video[:, :, 1:] - video[:, :, :-1]).abs().mean().item()
+
+
+def psnr(video, reference):
+    mse = ((video - reference) ** 2).mean().item()
+    return 10 * math.log10(1 / mse) if mse > 0 else float("inf")
+
+
+def bench_samplers(pipe, config, args):
+    ref_image, pose_images = load_case(config, args.frames)
+    scheduler_kwargs = OmegaConf.to_container(OmegaConf.load(config.inference_config).noise_scheduler_kwargs)
+    original = pipe.scheduler
+
+    def run(sampler, steps):
+        pipe.scheduler = make_scheduler(sampler, scheduler_kwargs)
+        start = time.perf_counter()
+        with pipe.autocast():
+            video = pipe(
+                ref_image, pose_images, args.resolution, args.resolution, len(pose_images), steps, args.cfg,
+                generator=torch.Generator().manual_seed(args.seed),
+                context_frames=min(args.S, len(pose_images)), context_overlap=args.O,
+            ).videos
+        return video, time.perf_counter() - start
+
+    try:
+        reference, reference_sec = run("ddim", args.reference_steps)
+        reference_flicker = flicker(reference)
+        print(f"reference: ddim {args.reference_steps} steps, {reference_sec:.1f}s, "
+              f"CLIP sim {clip_similarity(pipe, reference, ref_image):.4f}")
+
+        results = []
+        for sampler in args.samplers:
+            for steps in args.steps:
+                video, seconds = run(sampler, steps)
+                results.append(dict(
+                    sampler=sampler,
+                    steps=steps,
+                    seconds=seconds,
+                    sec_per_step=seconds / steps,
+                    psnr=psnr(video, reference),
+                    clip_similarity=clip_similarity(pipe, video, ref_image),
+                    flicker_ratio=flicker(video) / reference_flicker if reference_flicker else 0.0,
+                ))
+                r = results[-1]
+                print(f"{sampler:>12} {steps:>3} steps: {seconds:6.1f}s, PSNR {r['psnr']:.2f} dB, "
+                      f"CLIP sim {r['clip_similarity']:.4f}, flicker x{r['flicker_ratio']:.2f}")
+    finally:
+        pipe.scheduler = original
+    return results
+
+
+def bench_deep_cache(pipe, config, args):
+    ref_image, pose_images = load_case(config, args.frames, args.ref_image, args.pose_video)
+    cache = pipe.enable_deep_cache(interval=1, depth=args.depth)
+
+    results = []
+    reference = None
+    for interval in args.intervals:
+        # interval 1 recomputes every step, the reference
+        cache.interval = interval
+        cache.hits = cache.misses = 0
+        start = time.perf_counter()
+        with pipe.autocast():
+            video = pipe(
+                ref_image, pose_images, args.resolution, args.resolution, len(pose_images), args.steps, args.cfg,
+                generator=torch.Generator().manual_seed(args.seed),
+                context_frames=min(args.S, len(pose_images)), context_overlap=args.O,
+            ).videos
+        seconds = time.perf_counter() - start
+        sec_per_step = statistics.median(s for _, s in pipe.last_step_times)
+        if reference is None:
+            reference = dict(video=video, seconds=seconds, flicker=flicker(video))
+        results.append(dict(
+            interval=interval,
+            depth=args.depth,
+            seconds=seconds,
+            sec_per_step=sec_per_step,
+            speedup=reference["seconds"] / seconds,
+            psnr=psnr(video, reference["video"]),
+            clip_similarity=clip_similarity(pipe, video, ref_image),
+            flicker_ratio=flicker(video) / reference["flicker"] if reference["flicker"] else 0.0,
+            **cache.stats(),
+        ))
+        r = results[-1]
+        print(f"interval {interval}: {seconds:.1f}s ({sec_per_step:.2f} s/step), speedup {r['speedup']:.2f}x, "
+              f"PSNR {r['psnr']:.2f} dB, CLIP sim {r['clip_similarity']:.4f}, flicker x{r['flicker_ratio']:.2f}, "
+              f"{r['hits']} reused / {r['misses']} full window forwards")
+    return results
+
+
+@torch.no_grad()
+def bench_decode(pipe, config, args):
+    _, pose_images = load_case(config, args.frames)
+    device, vae = pipe._execution_device, pipe.vae
+    transform = transforms.Compose(
+        [transforms.Resize((args.resolution, args.resolution)), transforms.ToTensor()]
+    )
+    # latents of real frames, x264 is much slower on decoded noise
+    latents = []
+    with pipe.autocast():
+        for image in pose_images:
+            x = transform(image.convert("RGB"))[None].to(device, vae.dtype) * 2 - 1
+            latents.append(vae.encode(x).latent_dist.mean * 0.18215)
+    latents = torch.cat(latents).transpose(0, 1)[None].to(vae.dtype)  # (1, 4, f, h, w)
+    frames = latents.shape[2]
+
+    results = []
+    reference = None
+    for tile in args.tiles:
+        for micro_batch in args.micro_batches:
+            with pipe.autocast():
+                start = time.perf_counter()
+                decoded = torch.cat(
+                    [f for _, f in iter_decode(vae, latents, micro_batch, tile, args.tile_overlap)], dim=2
+                )
+                decode_sec = time.perf_counter() - start
+
+                writer = StreamingVideoWriter(os.path.join(args.output_dir, f"decode_{tile}_{micro_batch}.mp4"), 25)
+                encoder = BackgroundEncoder()
+                start = time.perf_counter()
+                for _, chunk in iter_decode(vae, latents, micro_batch, tile, args.tile_overlap):
+                    encoder.submit(writer.write_grid, chunk)
+                encoder.close()
+                writer.close()
+                overlapped_sec = time.perf_counter() - start
+
+            if reference is None:
+                reference = decoded
+            results.append(dict(
+                tile=tile,
+                micro_batch=micro_batch,
+                decode_fps=frames / decode_sec,
+                decode_encode_fps=frames / overlapped_sec,
+                max_abs_diff=(decoded - reference).abs().max().item(),
+            ))
+            print(f"tile {tile or 'off'}, micro-batch {micro_batch}: {results[-1]['decode_fps']:.2f} fps decode, "
+                  f"{results[-1]['decode_encode_fps']:.2f} fps with background x264, "
+                  f"max |diff| vs first setting {results[-1]['max_abs_diff']:.3g}")
+    return results
+
+
+@torch.no_grad()
+def bench_temporal(pipe, config, args):
+    # the first motion module attention of the denoising UNet on random features: the
+    # (batch x tokens) rows attend over the frames, the rest of the UNet does not change
+    module = next(m for kind, m in attention_kinds(pipe.denoising_unet, "denoising_unet") if kind == "temporal")
+    device, dtype = pipe._execution_device, pipe.denoising_unet.dtype
+    channels = module.to_q.in_features
+    cuda = str(device).startswith("cuda")
+
+    results = []
+    for frames in args.frames:
+        generator = torch.Generator().manual_seed(0)
+        hidden_states = torch.randn(frames * 2, args.tokens, channels, generator=generator).to(device, dtype)
+        full = None
+        for window in args.windows:
+            if frames > 128 and not window and not args.full_beyond_128:
+                continue
+            backend = ("windowed", window) if window and window < frames else ("sdpa", None)
+            apply_attention_plan(dict(temporal=backend), dict(denoising_unet=pipe.denoising_unet))
+            extend_position_encoding(pipe.denoising_unet, frames)
+            if cuda:
+                torch.cuda.reset_peak_memory_stats(device)
+            times = []
+            with pipe.autocast():
+                for _ in range(args.repeats + 1):
+                    start = time.perf_counter()
+                    out = module(hidden_states, video_length=frames)
+                    if cuda:
+                        torch.cuda.synchronize(device)
+                    times.append(time.perf_counter() - start)
+            if not window or window >= frames:
+                full = out.float()
+            results.append(dict(
+                frames=frames,
+                window=window,
+                sec=statistics.median(times[1:]),
+                # math-kernel attention matrix of this module, the quantity the window bounds
+                matrix_mb=matrix_bytes(
+                    8 * math.isqrt(args.tokens), 8 * math.isqrt(args.tokens), frames, True,
+                    torch.finfo(dtype).bits // 8, window,
+                )["temporal"] / 1024**2,
+                peak_mb=(torch.cuda.max_memory_allocated(device) if cuda else peak_rss()) / 1024**2,
+                max_abs_diff=(out.float() - full).abs().max().item() if full is not None else None,
+            ))
+            r = results[-1]
+            print(f"{frames} frames, window {window or 'full'}: {r['sec'] * 1000:.1f} ms, "
+                  f"attention matrix {r['matrix_mb']:.0f} MB, peak {r['peak_mb']:.0f} MB"
+                  + (f", max |diff| vs full {r['max_abs_diff']:.3g}" if r["max_abs_diff"] is not None else ""))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    steps = subparsers.add_parser("steps", help="seconds per denoising step per resolution")
+    steps.add_argument("--resolutions", type=int, nargs="+", default=[512, 768])
+    steps.add_argument("--frames", type=int, default=24, help="frames of the single context window")
+    steps.add_argument("--steps", type=int, default=5, help="denoising steps, the first is warm-up")
+    steps.add_argument("--cfg", type=float, default=3.5)
+
+    windows = subparsers.add_parser("windows", help="scaling of the context windows over worker processes")
+    windows.add_argument("--workers", type=int, nargs="+", default=[0, 1, 3], help="extra processes, 0 = serial reference")
+    windows.add_argument("--resolution", type=int, default=512)
+    windows.add_argument("--frames", type=int, default=96)
+    windows.add_argument("-S", type=int, default=24, help="context frames")
+    windows.add_argument("-O", type=int, default=4, help="context overlap")
+    windows.add_argument("--steps", type=int, default=4, help="denoising steps, the first is warm-up")
+    windows.add_argument("--cfg", type=float, default=3.5)
+
+    samplers = subparsers.add_parser("samplers", help="wall time and quality proxies per sampler and step count")
+    samplers.add_argument("--samplers", type=str, nargs="+", default=["ddim", "dpmpp_2m", "unipc", "euler_a"], choices=list(SAMPLERS))
+    samplers.add_argument("--steps", type=int, nargs="+", default=[8, 12, 20])
+    samplers.add_argument("--reference_steps", type=int, default=50, help="DDIM steps of the reference video")
+    samplers.add_argument("--resolution", type=int, default=512)
+    samplers.add_argument("--frames", type=int, default=24)
+    samplers.add_argument("-S", type=int, default=24, help="context frames")
+    samplers.add_argument("-O", type=int, default=4, help="context overlap")
+    samplers.add_argument("--cfg", type=float, default=3.5)
+    samplers.add_argument("--seed", type=int, default=42)
+
+    deep_cache = subparsers.add_parser("deep_cache", help="speed and quality of DeepCache-style feature reuse")
+    deep_cache.add_argument("--intervals", type=int, nargs="+", default=[1, 2, 3, 5], help="1 = no reuse, the reference")
+    deep_cache.add_argument("--depth", type=int, default=1, help="down / up blocks kept in the shallow branch")
+    deep_cache.add_argument("--ref_image", type=str, default="./assets/images/ref.png")
+    deep_cache.add_argument("--pose_video", type=str, default="./assets/poses/align/img_ref_video_dance.mp4")
+    deep_cache.add_argument("--resolution", type=int, default=512)
+    deep_cache.add_argument("--frames", type=int, default=48)
+    deep_cache.add_argument("-S", type=int, default=24, help="context frames")
+    deep_cache.add_argument("-O", type=int, default=4, help="context overlap")
+    deep_cache.add_argument("--steps", type=int, default=20)
+    deep_cache.add_argument("--cfg", type=float, default=3.5)
+    deep_cache.add_argument("--seed", type=int, default=42)
+
+    decode = subparsers.add_parser("decode", help="VAE decode throughput per micro-batch and tile size")
+    decode.add_argument("--micro_batches", type=int, nargs="+", default=[1, 4, 8])
+    decode.add_argument("--tiles", type=int, nargs="+", default=[0, 48], help="latent tile sizes, 0 = whole frames")
+    decode.add_argument("--tile_overlap", type=int, default=8)
+    decode.add_argument("--resolution", type=int, default=768)
+    decode.add_argument("--frames", type=int, default=48)
+    decode.add_argument("--output_dir", type=str, default="./output/benchmark_decode")
+
+    temporal = subparsers.add_parser("temporal", help="cost of windowed temporal attention per context length")
+    temporal.add_argument("--frames", type=int, nargs="+", default=[48, 128, 256], help="context window lengths")
+    temporal.add_argument("--windows", type=int, nargs="+", default=[0, 16, 32, 64], help="temporal windows, 0 = full attention")
+    temporal.add_argument("--tokens", type=int, default=1024, help="spatial tokens per frame (32 x 32 = the 1/16 level at 512)")
+    temporal.add_argument("--repeats", type=int, default=3, help="timed calls after one warm-up call")
+    temporal.add_argument("--full_beyond_128", action="store_true", help="also run full attention past the trained 128 frames")
+
+    for sub in subparsers.choices.values():
+        sub.add_argument("--config", type=str, default="./configs/test_stage_2.yaml")
+        sub.add_argument("--bundle", type=str, default=None)
+        sub.add_argument("--json", type=str, default=None, help="also write the results to this file")
+        add_cpu_args(sub)
+    args = parser.parse_args()
+
+    configure_threads(args.threads, args.interop_threads)
+    config = OmegaConf.load(args.config)
+    device = get_device()
+    pipe = build_pipeline(
+        config, device, ref_cache_size=0, pose_cache_size=0,
+        bundle=args.bundle, cpu_options=cpu_options(args),
+    )
+
+    if args.command == "windows":
+        build_fn = partial(
+            build_pipeline, config, device, ref_cache_size=0, pose_cache_size=0,
+            bundle=args.bundle, cpu_options=cpu_options(args),
+        )
+        results = bench_windows(pipe, config, args, build_fn)
+    else:
+        results = dict(
+            steps=bench_steps, samplers=bench_samplers, deep_cache=bench_deep_cache, decode=bench_decode,
+            temporal=bench_temporal,
+        )[args.command](pipe, config, args)
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or ".", exist_ok=True)
+        with open(args.json, "w") as f:
+            json.dump(dict(command=args.command, device=device, results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pose.script.dwpose import DWposeDetector
+from pose.script.keypoint_cache import file_sha256
+from pose.script.ref_catalog import ReferenceCatalog, analyze_reference
+
+
+'''
+    Bulk-ingest a folder of reference images into the pose align catalog.
+    Every worker process builds its own detector; only the main process writes to the database.
+'''
+
+_detector = None
+
+
+def init_worker(args):
+    global _detector
+    _detector = DWposeDetector(
+        det_config = args.yolox_config, 
+        det_ckpt = args.yolox_ckpt,
+        pose_config = args.dwpose_config, 
+        pose_ckpt = args.dwpose_ckpt, 
+        single_resize=args.single_resize,
+        max_persons=args.max_persons or None,
+        device = args.device,
+        keypoints_only=True,
+        )
+
+
+def process_image(image_path, detect_resolution):
+    return analyze_reference(_detector, image_path, detect_resolution)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=str, default="./assets/images")
+    parser.add_argument("--ref_catalog", type=str, default="./cache/ref_catalog.sqlite")
+    parser.add_argument('--detect_resolution', type=int, default=512, help='must match the one used by pose_align.py')
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--yolox_config",  type=str, default="./pose/config/yolox_l_8xb8-300e_coco.py")
+    parser.add_argument("--dwpose_config", type=str, default="./pose/config/dwpose-l_384x288.py")
+    parser.add_argument("--yolox_ckpt",  type=str, default="./pretrained_weights/dwpose/yolox_l_8x8_300e_coco.pth")
+    parser.add_argument("--dwpose_ckpt", type=str, default="./pretrained_weights/dwpose/dw-ll_ucoco_384.pth")
+    parser.add_argument("--max_persons", type=int, default=1, help='pose-estimate only the top-k persons by score x box area, 0 for all')
+    parser.add_argument("--single_resize", action="store_true", help='detect on the source frames, skipping the detect_resolution LANCZOS resize')
+    args = parser.parse_args()
+
+    # collect all reference images
+    image_paths = []
+    for root, dirs, files in os.walk(args.image_dir):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in [".jpg", ".jpeg", ".png"]:
+                image_paths.append(os.path.join(root, name))
+    image_paths.sort()
+    print("Num of images:", len(image_paths))
+
+    # the fingerprint only hashes configs / checkpoints, no model is built in the main process
+    fingerprint = DWposeDetector(
+        args.yolox_config, args.yolox_ckpt, args.dwpose_config, args.dwpose_ckpt,
+        single_resize=args.single_resize,
+        max_persons=args.max_persons or None,
+        ).fingerprint(args.detect_resolution)
+    catalog = ReferenceCatalog(args.ref_catalog)
+
+    todo = [p for p in image_paths if catalog.get(file_sha256(p), fingerprint) is None]
+    print("already in catalog:", len(image_paths) - len(todo))
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args,)) as executor:
+        futures = {executor.submit(process_image, p, args.detect_resolution): p for p in todo}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                catalog.put(future.result(), fingerprint)
+            except Exception as e:
+                print("failed:", futures[future], e)
+            print(f"Process {i+1}/{len(todo)} image")
+
+    print("catalog size:", len(catalog))
+    catalog.close()
+    print('all done!')
@@ -0,0 +1,91 @@
+import os
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+from musepose.models.unet_3d import UNet3DConditionModel
+from inference.memory import peak_rss
+from inference.weights import converted_path, load_weights, save_bundle, save_model
+from test_stage_2 import load_components
+
+
+'''
+    One-time conversion of the inference weights into config.converted_weights_dir.
+
+    reference_unet / denoising_unet / pose_guider are written as complete .safetensors files
+    (base weights, motion module and MusePose weights already merged, cast to --dtype), plus
+    denoising_unet_2d for test_stage_1.py; vae and image_encoder are saved as safetensors folders.
+    test_stage_1.py and test_stage_2.py load them memory-mapped when the folder exists.
+
+    --bundle instead writes all five Pose2Video components and the scheduler config into one
+    file, loaded with test_stage_2.py --bundle / FastPose2VideoPipeline.from_bundle.
+'''
+
+
+DTYPES = dict(fp16=torch.float16, bf16=torch.bfloat16, fp32=torch.float32)
+POSE_GUIDER_KWARGS = dict(conditioning_embedding_channels=320, block_out_channels=[16, 32, 96, 256])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./configs/test_stage_2.yaml")
+    parser.add_argument("--output_dir", type=str, default=None, help="defaults to converted_weights_dir of the config")
+    parser.add_argument("--dtype", type=str, default="fp16", choices=list(DTYPES))
+    parser.add_argument("--bundle", type=str, default=None, help="write a single Pose2Video bundle file instead")
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    output_dir = args.output_dir or config.get("converted_weights_dir")
+    if not output_dir and not args.bundle:
+        raise ValueError("no --output_dir and no converted_weights_dir in the config")
+    dtype = DTYPES[args.dtype]
+
+    # the regular (slow) loading path on cpu, fp32 until saved; only the modules, no pipeline
+    # and none of its runtime patches (cpu layout, attention processors)
+    infer_config = OmegaConf.load(config.inference_config)
+    components = load_components(config, infer_config, "cpu", torch.float32)
+
+    if args.bundle:
+        save_bundle(
+            args.bundle,
+            components,
+            dtype,
+            infer_config.noise_scheduler_kwargs,
+            init_kwargs=dict(pose_guider=POSE_GUIDER_KWARGS),
+        )
+        print(f"bundle written to {args.bundle}, peak RSS {peak_rss() / 1024**3:.2f} GB")
+        return
+
+    save_model(components["reference_unet"], converted_path(output_dir, "reference_unet"), dtype)
+    save_model(components["denoising_unet"], converted_path(output_dir, "denoising_unet"), dtype)
+    save_model(
+        components["pose_guider"],
+        converted_path(output_dir, "pose_guider"),
+        dtype,
+        init_kwargs=POSE_GUIDER_KWARGS,
+    )
+    components["vae"].to(dtype).save_pretrained(os.path.join(output_dir, "vae"), safe_serialization=True)
+    components["image_encoder"].to(dtype).save_pretrained(
+        os.path.join(output_dir, "image_encoder"), safe_serialization=True
+    )
+    del components
+
+    # stage 1 uses the denoising UNet without motion module
+    denoising_unet = UNet3DConditionModel.from_pretrained_2d(
+        config.pretrained_base_model_path,
+        "",
+        subfolder="unet",
+        unet_additional_kwargs={
+            "use_motion_module": False,
+            "unet_use_temporal_attention": False,
+        },
+    )
+    denoising_unet.load_state_dict(load_weights(config.denoising_unet_path), strict=False)
+    save_model(denoising_unet, converted_path(output_dir, "denoising_unet_2d"), dtype)
+
+    print(f"converted weights written to {output_dir}, peak RSS {peak_rss() / 1024**3:.2f} GB")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,8 @@ import torch
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 import argparse
 import numpy as np
-from tqdm import tqdm
 
 from pose.script.dwpose import DWposeDetector
-from pose.script.tool import read_frames 
 
 
 
@@ -19,11 +17,8 @@ def process_single_video(video_path, detector, root_dir, save_dir):
     if os.path.exists(out_path): 
         return
 
-    frames = read_frames(video_path)
-    keypoints = []
-    for frame in tqdm(frames):
-        keypoint = detector(frame)
-        keypoints.append(keypoint)
+    # decoding + detection, or a lookup when the video is in the keypoint cache
+    keypoints = detector.detect_video(video_path)
       
     result = np.array(keypoints)
     np.save(out_path, result)
@@ -46,6 +41,10 @@ if __name__ == "__main__":
     parser.add_argument("--dwpose_config", type=str, default="./pose/config/dwpose-l_384x288.py")
     parser.add_argument("--yolox_ckpt",  type=str, default="./pretrained_weights/dwpose/yolox_l_8x8_300e_coco_20211126_140236-d3bd2b23.pth")
     parser.add_argument("--dwpose_ckpt", type=str, default="./pretrained_weights/dwpose/dw-ll_ucoco_384.pth")
+    parser.add_argument("--max_persons", type=int, default=1, help='pose-estimate only the top-k persons by score x box area, 0 for all')
+    parser.add_argument("--single_resize", action="store_true", help='detect on the source frames, skipping the detect_resolution LANCZOS resize')
+    parser.add_argument("--cache_dir", type=str, default="./cache/dwpose_keypoints", help='keypoint cache shared by the pose tools, empty to disable')
+    parser.add_argument("--cache_size_gb", type=float, default=10, help='keypoint cache size limit, LRU entries are evicted beyond it')
     args = parser.parse_args()
 
     # make save dir 
@@ -72,9 +71,15 @@ if __name__ == "__main__":
         det_ckpt = args.yolox_ckpt,
         pose_config = args.dwpose_config, 
         pose_ckpt = args.dwpose_ckpt, 
-        keypoints_only=True
+        single_resize=args.single_resize,
+        max_persons=args.max_persons or None,
+        keypoints_only=True,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=int(args.cache_size_gb * 1024**3),
         )    
     detector = detector.to(device)
         
     process_batch_videos(video_mp4_paths, detector, args.video_dir, save_dir)
+    if detector.cache is not None:
+        print("keypoint cache:", detector.cache.stats())
     print('all done!')
@@ -0,0 +1,320 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from inference.memory import available_memory
+
+
+'''
+    Attention backend per attention kind, chosen by device and free memory.
+
+    spatial    self / cross attention of the reference UNet, the denoising UNet and the VAE
+    reference  self attention of the denoising UNet, whose keys also hold the reference bank
+    temporal   the motion module attention over the frames of a context window
+
+    xformers and SDPA with a flash / memory-efficient kernel (cuda, cpu with torch >= 2.2) never
+    build the attention matrix. Where only the math kernel exists (mps, older torch), the planner
+    estimates the largest matrix of each kind and, if it does not fit into the free memory,
+    splits it: queries in chunks for spatial / reference attention, whose rows are few and long,
+    batch x heads in slices for temporal attention, whose rows are many and short.
+
+    Temporal attention can also be made local ("windowed"): every frame attends to (at least) the
+    frames within temporal_window / 2 of it, in query chunks of temporal_window / 2, so memory and time
+    grow linearly with the context window instead of quadratically. The motion module adds a
+    position encoding trained for temporal_position_encoding_max_len (128) frames;
+    extend_position_encoding lengthens it for larger context windows.
+'''
+
+
+BACKENDS = ["auto", "sdpa", "xformers", "chunked", "sliced"]
+POSITION_MODES = ["extend", "interpolate"]
+
+
+class ChunkedAttnProcessor:
+    """
+    AttnProcessor2_0 with the queries processed chunk_size at a time, so the attention
+    matrix is at most chunk_size x keys per head; math kernel when SDPA is missing.
+    With key_halo, a query chunk only sees the keys within key_halo positions of it (local
+    attention along the sequence, for the frames of temporal attention).
+    """
+
+    def __init__(self, chunk_size, key_halo=None):
+        self.chunk_size = chunk_size
+        self.key_halo = key_halo
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        residual = hidden_states
+        if getattr(attn, "spatial_norm", None) is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        )
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if getattr(attn, "group_norm", None) is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        head_dim = key.shape[-1] // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        out = torch.empty_like(query)
+        for start in range(0, query.shape[2], self.chunk_size):
+            end = start + self.chunk_size
+            k0, k1 = 0, key.shape[2]
+            if self.key_halo is not None:
+                k0, k1 = max(0, start - self.key_halo), min(k1, end + self.key_halo)
+            mask = attention_mask
+            if mask is not None:
+                mask = mask[:, :, start:end] if mask.shape[2] > 1 else mask
+                mask = mask[..., k0:k1]
+            out[:, :, start:end] = _attention(
+                query[:, :, start:end], key[:, :, k0:k1], value[:, :, k0:k1], mask, attn.scale
+            )
+
+        hidden_states = out.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = attn.to_out[0](hidden_states.to(query.dtype))
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+def _attention(query, key, value, mask, scale):
+    if hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=mask)
+    scores = query @ key.transpose(-1, -2) * scale
+    if mask is not None:
+        scores = scores + mask
+    return scores.softmax(dim=-1) @ value
+
+
+def xformers_available(device):
+    if not str(device).startswith("cuda"):
+        return False
+    try:
+        import xformers.ops  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def memory_efficient_sdpa(device):
+    """Whether SDPA on device has a kernel that never materializes the attention matrix."""
+    if not hasattr(F, "scaled_dot_product_attention"):
+        return False
+    device = str(device)
+    if device.startswith("cuda"):
+        return True
+    if device == "cpu":
+        major, minor = (int(v) for v in torch.__version__.split(".")[:2])
+        return (major, minor) >= (2, 2)
+    return False
+
+
+def attention_kinds(model, name_prefix=""):
+    """(kind, module) of every attention module of model that takes a processor."""
+    kinds = []
+    for name, module in model.named_modules():
+        if not hasattr(module, "set_processor"):
+            continue
+        if "motion_modules" in name or type(module).__name__ == "VersatileAttention":
+            kind = "temporal"
+        elif name_prefix == "denoising_unet" and name.endswith("attn1"):
+            kind = "reference"
+        else:
+            kind = "spatial"
+        kinds.append((kind, module))
+    return kinds
+
+
+def matrix_bytes(width, height, context_frames, do_classifier_free_guidance, dtype_size, temporal_window=0):
+    """Largest attention matrix of each kind, at the 1/8 resolution level, for the math kernel."""
+    tokens = (height // 8) * (width // 8)
+    rows = 2 if do_classifier_free_guidance else 1
+    heads = 8
+    temporal_keys = min(context_frames, temporal_window) if temporal_window else context_frames
+    return dict(
+        spatial=rows * context_frames * heads * tokens * tokens * dtype_size,
+        # the reference bank doubles the keys
+        reference=rows * context_frames * heads * tokens * 2 * tokens * dtype_size,
+        temporal=rows * tokens * heads * context_frames * temporal_keys * dtype_size,
+    )
+
+
+def plan_attention(device, width, height, context_frames, do_classifier_free_guidance=True,
+                   dtype_size=2, backend="auto", fraction=0.5, temporal_window=0):
+    """
+    {kind: (backend, size)} for spatial, reference and temporal attention; size is the query
+    chunk of "chunked", the slice of "sliced" and the window of "windowed", None otherwise.
+    """
+    plan = _plan_backends(
+        device, width, height, context_frames, do_classifier_free_guidance, dtype_size, backend, fraction
+    )
+    if temporal_window and temporal_window < context_frames:
+        plan["temporal"] = ("windowed", temporal_window)
+    return plan
+
+
+def _plan_backends(device, width, height, context_frames, do_classifier_free_guidance, dtype_size, backend, fraction):
+    kinds = ["spatial", "reference", "temporal"]
+    if backend == "xformers" or (backend == "auto" and xformers_available(device)):
+        return {kind: ("xformers", None) for kind in kinds}
+    if backend == "sdpa" or (backend == "auto" and memory_efficient_sdpa(device)):
+        return {kind: ("sdpa", None) for kind in kinds}
+
+    needed = matrix_bytes(width, height, context_frames, do_classifier_free_guidance, dtype_size)
+    available = available_memory(device)
+    budget = fraction * available if available else None
+    tokens = (height // 8) * (width // 8)
+    rows = (2 if do_classifier_free_guidance else 1)
+    plan = {}
+    for kind in kinds:
+        fits = budget is not None and needed[kind] <= budget
+        if backend == "auto" and fits:
+            plan[kind] = ("sdpa" if hasattr(F, "scaled_dot_product_attention") else "default", None)
+        elif kind == "temporal" and backend in ("auto", "sliced"):
+            # batch x heads rows of context_frames x context_frames each
+            per_slice = context_frames * context_frames * dtype_size
+            total = rows * tokens * 8
+            size = total if budget is None else int(max(1, min(total, budget // per_slice)))
+            plan[kind] = ("sliced", size)
+        else:
+            keys = tokens * (2 if kind == "reference" else 1)
+            per_query = rows * context_frames * 8 * keys * dtype_size
+            size = tokens if budget is None else int(max(1, min(tokens, budget // per_query)))
+            plan[kind] = ("chunked", size)
+    return plan
+
+
+def apply_attention_plan(plan, models):
+    """models: {name: module}; sets the processor of every attention module, returns module counts."""
+    from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0, SlicedAttnProcessor
+
+    processors = {}
+    for kind, (backend, size) in plan.items():
+        if backend == "xformers":
+            from diffusers.models.attention_processor import XFormersAttnProcessor
+
+            processors[kind] = XFormersAttnProcessor()
+        elif backend == "sdpa":
+            processors[kind] = AttnProcessor2_0()
+        elif backend == "chunked":
+            processors[kind] = ChunkedAttnProcessor(size)
+        elif backend == "sliced":
+            processors[kind] = SlicedAttnProcessor(size)
+        elif backend == "windowed":
+            processors[kind] = ChunkedAttnProcessor(max(1, size // 2), key_halo=size // 2)
+        else:
+            processors[kind] = AttnProcessor()
+
+    counts = {}
+    for name, model in models.items():
+        if model is None:
+            continue
+        for kind, module in attention_kinds(model, name):
+            module.set_processor(processors[kind])
+            counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+
+def configure_attention(pipe, width, height, context_frames, do_classifier_free_guidance=True, backend="auto",
+                        temporal_window=0, position_mode="extend"):
+    """Plans and applies the attention backends of a Pose2Video pipeline and logs the choice."""
+    device = pipe._execution_device
+    dtype = getattr(pipe, "autocast_dtype", None) or pipe.denoising_unet.dtype
+    plan = plan_attention(
+        device, width, height, context_frames, do_classifier_free_guidance,
+        dtype_size=torch.finfo(dtype).bits // 8, backend=backend, temporal_window=temporal_window,
+    )
+    extended = extend_position_encoding(pipe.denoising_unet, context_frames, position_mode)
+    if extended:
+        print(f"temporal position encoding: {position_mode}ed to {context_frames} frames in {extended} modules")
+    counts = apply_attention_plan(plan, dict(
+        reference_unet=pipe.reference_unet,
+        denoising_unet=pipe.denoising_unet,
+        vae=pipe.vae,
+    ))
+    print("attention:", ", ".join(
+        f"{kind} {backend}" + (f"({size})" if size else "") + f" x{counts.get(kind, 0)}"
+        for kind, (backend, size) in plan.items()
+    ))
+    return plan
+
+
+def enable_memory_efficient_attention(*models):
+    """
+    xformers when installed, else SDPA (memory-efficient kernels on cuda), else slicing;
+    for the training scripts, which used to raise without xformers. Returns the backend name.
+    """
+    if xformers_available("cuda"):
+        for model in models:
+            model.enable_xformers_memory_efficient_attention()
+        return "xformers"
+    if hasattr(F, "scaled_dot_product_attention"):
+        from diffusers.models.attention_processor import AttnProcessor2_0
+
+        for model in models:
+            model.set_attn_processor(AttnProcessor2_0())
+        return "sdpa"
+    for model in models:
+        model.set_attention_slice("auto")
+    return "sliced"
+
+
+def _sinusoid(length, channels):
+    # the encoding of the motion module: sin / cos pairs over geometric frequencies
+    position = torch.arange(length, dtype=torch.float32)[:, None]
+    div_term = torch.exp(torch.arange(0, channels, 2, dtype=torch.float32) * (-math.log(10000.0) / channels))
+    pe = torch.zeros(1, length, channels)
+    pe[0, :, 0::2] = torch.sin(position * div_term)
+    pe[0, :, 1::2] = torch.cos(position * div_term)
+    return pe
+
+
+def extend_position_encoding(unet, length, mode="extend"):
+    """
+    Lengthens the temporal position encodings (pos_encoder.pe, 1 x max_len x channels) shorter
+    than length, returns how many. "extend" continues the sinusoids, so frame distances keep
+    their trained encoding (pairs with windowed attention, which never sees distances beyond
+    its window); "interpolate" stretches the trained max_len positions over length frames, so
+    positions stay in the trained range and frames move closer together.
+    """
+    if mode not in POSITION_MODES:
+        raise ValueError(f"unknown position mode {mode!r}, choose from {POSITION_MODES}")
+    count = 0
+    for module in unet.modules():
+        pe = getattr(getattr(module, "pos_encoder", None), "pe", None)
+        if pe is None or pe.shape[1] >= length:
+            continue
+        if mode == "extend":
+            new = _sinusoid(length, pe.shape[2])
+            # keep the stored (trained) positions as they are
+            new[:, : pe.shape[1]] = pe.float().cpu()
+        else:
+            new = F.interpolate(pe.float().transpose(1, 2), size=length, mode="linear", align_corners=True)
+            new = new.transpose(1, 2)
+        module.pos_encoder.pe = new.to(pe.device, pe.dtype)
+        count += 1
+    return count
@@ -0,0 +1,96 @@
+import sys
+
+import torch
+import torch.nn.functional as F
+
+
+'''
+    CPU inference mode for the Pose2Video pipeline.
+
+    fp32 weights with bf16 autocast where the CPU has native bf16 (AVX512-BF16 / AMX),
+    channels_last convolutions, SDPA attention instead of sliced attention, optional
+    torch.compile of the UNet resnet blocks and explicit intra/inter-op thread counts.
+'''
+
+
+def add_cpu_args(parser):
+    parser.add_argument("--cpu_bf16", type=str, default="auto", choices=["auto", "on", "off"],
+                        help="bf16 autocast on cpu, auto = only with native bf16 support")
+    parser.add_argument("--no_channels_last", action="store_true", help="keep NCHW convolutions on cpu")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the UNet resnet blocks on cpu")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads, default torch's choice")
+    parser.add_argument("--interop_threads", type=int, default=None, help="inter-op threads, default torch's choice")
+
+
+def cpu_supports_bf16():
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/cpuinfo") as f:
+                flags = f.read()
+        except OSError:
+            return False
+        return "avx512_bf16" in flags or "amx_bf16" in flags
+    return False
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    """
+    Must run before the first parallel op, torch refuses to change inter-op threads later.
+
+    torch.set_num_threads sets the intra-op pool; OMP_NUM_THREADS only has an effect when it is
+    exported before the process starts, OpenMP is already initialized once torch is imported.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        torch.set_num_interop_threads(num_interop_threads)
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def use_sdpa(*models):
+    """Switches every attention module to torch's scaled_dot_product_attention, returns how many."""
+    if not hasattr(F, "scaled_dot_product_attention"):
+        return 0
+    from diffusers.models.attention_processor import AttnProcessor2_0
+
+    count = 0
+    for model in models:
+        for module in model.modules():
+            if hasattr(module, "set_processor"):
+                module.set_processor(AttnProcessor2_0())
+                count += 1
+    return count
+
+
+def compile_resnets(*models):
+    # the attention blocks are re-hooked by ReferenceAttentionControl on every call and stay
+    # eager; the resnet blocks hold most of the convolution work and never change
+    count = 0
+    for model in models:
+        for module in model.modules():
+            if "Resnet" in type(module).__name__:
+                module.forward = torch.compile(module.forward, dynamic=False)
+                count += 1
+    return count
+
+
+def optimize_for_cpu(pipe, bf16="auto", channels_last=True, compile=False):
+    """Applies the cpu mode to a pipeline whose weights are fp32 on cpu, returns a summary."""
+    use_bf16 = bf16 == "on" or (bf16 == "auto" and cpu_supports_bf16())
+    pipe.autocast_dtype = torch.bfloat16 if use_bf16 else None
+
+    models = [pipe.reference_unet, pipe.denoising_unet, pipe.pose_guider, pipe.vae]
+    if channels_last:
+        for model in models:
+            model.to(memory_format=torch.channels_last)
+
+    summary = dict(
+        autocast=str(pipe.autocast_dtype).replace("torch.", "") if use_bf16 else "off",
+        channels_last=channels_last,
+        sdpa_modules=use_sdpa(pipe.reference_unet, pipe.denoising_unet, pipe.vae),
+        compiled_modules=compile_resnets(pipe.reference_unet, pipe.denoising_unet) if compile else 0,
+        threads=torch.get_num_threads(),
+        interop_threads=torch.get_num_interop_threads(),
+    )
+    print("cpu mode:", summary)
+    return summary
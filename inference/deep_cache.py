@@ -0,0 +1,103 @@
+'''
+    DeepCache-style feature reuse for the denoising UNet3DConditionModel.
+
+    The UNet is split at `depth`: the shallow branch is conv_in, down_blocks[:depth],
+    up_blocks[-depth:] and conv_out, everything in between is the deep branch. Every `interval`
+    calls of a context window the whole UNet runs and the output of the last deep up block
+    (the input of the shallow up blocks) is stored for that window; on the calls in between only
+    the shallow branch runs and the deep up block returns the stored features. Windows overlap
+    and differ in content, so features are kept per window (and per guidance branch), never shared.
+
+    Memory: one feature map per window and branch, e.g. 640 x H/8 x W/8 x frames x batch at
+    depth 1; use a larger depth (smaller, lower-resolution features, less speedup) for long videos.
+'''
+
+
+class DeepCache:
+    def __init__(self, unet, interval=3, depth=1):
+        if interval < 1:
+            raise ValueError("interval must be >= 1")
+        n = len(unet.down_blocks)
+        if not 1 <= depth < n:
+            raise ValueError(f"depth must be between 1 and {n - 1}")
+        self.interval = interval
+        self.depth = depth
+        self.features = {}
+        self.calls = {}
+        self.window = None
+        self.reuse = False
+        self.hits = self.misses = 0
+
+        for block in unet.down_blocks[depth:]:
+            self._skip_down(block)
+        if unet.mid_block is not None:
+            self._skip_mid(unet.mid_block)
+        deep_up = unet.up_blocks[: n - depth]
+        for block in deep_up[:-1]:
+            self._skip_up(block)
+        self._cache_up(deep_up[-1])
+
+    def reset(self):
+        self.features.clear()
+        self.calls.clear()
+        self.window = None
+        self.reuse = False
+
+    def begin(self, window):
+        """Called before every UNet forward with a hashable key of the window and branch."""
+        count = self.calls.get(window, 0)
+        self.calls[window] = count + 1
+        self.window = window
+        self.reuse = count % self.interval != 0 and window in self.features
+        if self.reuse:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, windows=len(self.features))
+
+    # the deep blocks before the cached one only have to keep the shapes of the tuples the
+    # UNet forward slices; their values are never read on reuse calls
+
+    def _skip_down(self, block):
+        forward = block.forward
+        num_res = len(block.resnets) + (1 if getattr(block, "downsamplers", None) else 0)
+
+        def cached_forward(hidden_states, *args, **kwargs):
+            if self.reuse:
+                return hidden_states, (hidden_states,) * num_res
+            return forward(hidden_states, *args, **kwargs)
+
+        block.forward = cached_forward
+
+    def _skip_mid(self, block):
+        forward = block.forward
+
+        def cached_forward(hidden_states, *args, **kwargs):
+            if self.reuse:
+                return hidden_states
+            return forward(hidden_states, *args, **kwargs)
+
+        block.forward = cached_forward
+
+    _skip_up = _skip_mid
+
+    def _cache_up(self, block):
+        forward = block.forward
+
+        def cached_forward(*args, **kwargs):
+            if self.reuse:
+                return self.features[self.window]
+            output = forward(*args, **kwargs)
+            if self.window is not None:
+                self.features[self.window] = output
+            return output
+
+        block.forward = cached_forward
+
+
+def enable_deep_cache(unet, interval=3, depth=1):
+    """Wraps the deep blocks of unet, which then consults unet.deep_cache in denoise_window."""
+    unet.deep_cache = DeepCache(unet, interval, depth)
+    return unet.deep_cache
@@ -0,0 +1,275 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+from inference.profiling import stage
+from pose.script.keypoint_cache import evict_lru
+
+
+def image_hash(image):
+    h = hashlib.sha256()
+    h.update(f"{image.mode}-{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def weights_version(*paths, **extra):
+    """Cheap version tag of a set of weight files / folders: path, size and mtime of every file."""
+    h = hashlib.sha256()
+    for path in paths:
+        if path is None:
+            continue
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for f in files:
+            if os.path.exists(f):
+                st = os.stat(f)
+                h.update(f"{f}:{st.st_size}:{st.st_mtime_ns}".encode())
+            else:
+                h.update(str(f).encode())
+    h.update(repr(sorted(extra.items())).encode())
+    return h.hexdigest()[:16]
+
+
+def make_key(*parts):
+    return hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def _map_tensors(value, fn):
+    if torch.is_tensor(value):
+        return fn(value)
+    if isinstance(value, dict):
+        return {k: _map_tensors(v, fn) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_tensors(v, fn) for v in value)
+    return value
+
+
+def _nbytes(value):
+    total = 0
+
+    def count(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+
+    _map_tensors(value, count)
+    return total
+
+
+class TensorCache:
+    """
+    LRU cache of (nested) tensor structures.
+
+    Entries live in memory up to max_items / max_bytes and are optionally mirrored
+    to cache_dir, where the least recently used files are evicted beyond max_disk_bytes.
+    """
+
+    def __init__(self, max_items=4, max_bytes=None, cache_dir=None, max_disk_bytes=20 * 1024**3, dtype=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        # floating point tensors are stored in this dtype (e.g. torch.float16), None keeps them as is
+        self.dtype = dtype
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def get(self, key, device=None, dtype=None):
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+        elif self.cache_dir and os.path.exists(self._path(key)):
+            value = torch.load(self._path(key), map_location="cpu")
+            os.utime(self._path(key))
+            self._remember(key, value)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if device is None and dtype is None:
+            return value
+
+        def to(t):
+            if dtype is not None and t.is_floating_point():
+                return t.to(device=device, dtype=dtype)
+            return t.to(device=device)
+
+        return _map_tensors(value, to)
+
+    def put(self, key, value):
+        def store(t):
+            t = t.detach()
+            if self.dtype is not None and t.is_floating_point():
+                t = t.to(self.dtype)
+            return t
+
+        value = _map_tensors(value, store)
+        self._remember(key, value)
+        if self.cache_dir:
+            tmp_path = self._path(key) + ".tmp%d" % os.getpid()
+            torch.save(_map_tensors(value, lambda t: t.cpu()), tmp_path)
+            os.replace(tmp_path, self._path(key))
+            self._evict_disk()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+        if self.max_bytes is not None:
+            while len(self.memory) > 1 and sum(_nbytes(v) for v in self.memory.values()) > self.max_bytes:
+                self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        evict_lru(self.cache_dir, ".pt", self.max_disk_bytes)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+            entries=len(self.memory),
+        )
+
+
+def attention_banks(unet):
+    # modules hooked by ReferenceAttentionControl carry a `bank` list
+    return [module for module in unet.modules() if hasattr(module, "bank")]
+
+
+@torch.no_grad()
+def encode_reference(pipe, ref_image, width, height, do_classifier_free_guidance, timestep):
+    """
+    CLIP embeddings, VAE latents and reference UNet attention features of one reference image.
+
+    The reference UNet must already be hooked by a write-mode ReferenceAttentionControl; its banks
+    are filled on return. With pipe.reference_cache set, all three are looked up by
+    (image hash, resolution, cfg, weights version) and the reference path is skipped on a hit.
+    """
+    device = pipe._execution_device
+    timer = getattr(pipe, "timer", None)
+    writer_modules = attention_banks(pipe.reference_unet)
+    cache = getattr(pipe, "reference_cache", None)
+    key = None
+    if cache is not None:
+        key = make_key(
+            "reference", image_hash(ref_image), width, height, do_classifier_free_guidance,
+            getattr(pipe, "weights_version", ""),
+        )
+        with stage(timer, "reference_cache"):
+            cached = cache.get(key, device=device, dtype=pipe.reference_unet.dtype)
+        if cached is not None:
+            for module, bank in zip(writer_modules, cached["banks"]):
+                module.bank = list(bank)
+            return cached["encoder_hidden_states"], cached["ref_image_latents"]
+
+    # Prepare clip image embeds
+    with stage(timer, "clip_encode"):
+        clip_image = pipe.clip_image_processor.preprocess(
+            ref_image.resize((224, 224)), return_tensors="pt"
+        ).pixel_values
+        clip_image_embeds = pipe.image_encoder(
+            clip_image.to(device, dtype=pipe.image_encoder.dtype)
+        ).image_embeds
+    encoder_hidden_states = clip_image_embeds.unsqueeze(1)
+    uncond_encoder_hidden_states = torch.zeros_like(encoder_hidden_states)
+    if do_classifier_free_guidance:
+        encoder_hidden_states = torch.cat(
+            [uncond_encoder_hidden_states, encoder_hidden_states], dim=0
+        )
+
+    # Prepare ref image latents
+    with stage(timer, "vae_encode"):
+        ref_image_tensor = pipe.ref_image_processor.preprocess(
+            ref_image, height=height, width=width
+        )  # (bs, c, width, height)
+        ref_image_tensor = ref_image_tensor.to(
+            dtype=pipe.vae.dtype, device=pipe.vae.device
+        )
+        ref_image_latents = pipe.vae.encode(ref_image_tensor).latent_dist.mean
+        ref_image_latents = ref_image_latents * 0.18215  # (b, 4, h, w)
+
+    # Forward reference image, the writer hooks fill the banks
+    with stage(timer, "reference_unet"):
+        pipe.reference_unet(
+            ref_image_latents.repeat(
+                (2 if do_classifier_free_guidance else 1), 1, 1, 1
+            ),
+            torch.zeros_like(timestep),
+            encoder_hidden_states=encoder_hidden_states,
+            return_dict=False,
+        )
+
+    if cache is not None:
+        cache.put(
+            key,
+            dict(
+                encoder_hidden_states=encoder_hidden_states,
+                ref_image_latents=ref_image_latents,
+                banks=[list(module.bank) for module in writer_modules],
+            ),
+        )
+    return encoder_hidden_states, ref_image_latents
+
+
+@torch.no_grad()
+def encode_references(pipe, ref_images, width, height, do_classifier_free_guidance, timestep):
+    """
+    encode_reference for a batch of reference images.
+
+    Items are laid out like a batched forward: with CFG every tensor (and every bank entry)
+    is [uncond_1 .. uncond_n, cond_1 .. cond_n], matching the latent order of the denoising loop.
+    """
+    if len(ref_images) == 1:
+        return encode_reference(pipe, ref_images[0], width, height, do_classifier_free_guidance, timestep)
+
+    writer_modules = attention_banks(pipe.reference_unet)
+    states, latents, banks = [], [], []
+    for ref_image in ref_images:
+        for module in writer_modules:
+            module.bank = []
+        encoder_hidden_states, ref_image_latents = encode_reference(
+            pipe, ref_image, width, height, do_classifier_free_guidance, timestep
+        )
+        states.append(encoder_hidden_states)
+        latents.append(ref_image_latents)
+        banks.append([list(module.bank) for module in writer_modules])
+
+    def merge(tensors):
+        if not do_classifier_free_guidance:
+            return torch.cat(tensors)
+        halves = [t.chunk(2) for t in tensors]
+        return torch.cat([h[0] for h in halves] + [h[1] for h in halves])
+
+    for k, module in enumerate(writer_modules):
+        module.bank = [
+            merge([bank[k][j] for bank in banks]) for j in range(len(banks[0][k]))
+        ]
+    return merge(states), torch.cat(latents)
+
+
+def repeat_reference(pipe, encoder_hidden_states, ref_image_latents, repeats):
+    """
+    Features of one reference (from encode_reference) laid out for `repeats` samples of it, in
+    the order of encode_references: [uncond x repeats, cond x repeats] with CFG.
+    """
+    if repeats == 1:
+        return encoder_hidden_states, ref_image_latents
+    for module in attention_banks(pipe.reference_unet):
+        module.bank = [fea.repeat_interleave(repeats, dim=0) for fea in module.bank]
+    return (
+        encoder_hidden_states.repeat_interleave(repeats, dim=0),
+        ref_image_latents.repeat_interleave(repeats, dim=0),
+    )
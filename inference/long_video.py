@@ -0,0 +1,239 @@
+import os
+import json
+import shutil
+import tempfile
+
+import av
+import numpy as np
+import torch
+from torchvision import transforms
+
+from inference.feature_cache import make_key
+from musepose.utils.util import get_fps
+from pose.script.keypoint_cache import file_sha256
+
+
+'''
+    Memory-bounded long-video generation (test_stage_2.py --long_video).
+
+    Everything that grows with the video length L is either moved to disk or kept small:
+
+      pose frames, PoseGuider features  decoded and encoded chunk by chunk into frame-major
+                                        FrameStore files, read back one window at a time
+      latents, blend buffers            fp16 (latents_dtype of the pipeline), the scheduler
+                                        step still runs in the UNet dtype
+      decoded frames                    streamed into the output videos (frame_callback)
+      reference frame of the grid       an expand view over the frames of each chunk
+
+    Resident memory is then the weights plus O(window): the UNet activations and pose features
+    of one context window and one decoded chunk, independent of L. The only per-frame terms are
+    the fp16 latents and blend buffers, (1 + 2 with cfg) * 4 * H/8 * W/8 * 2 bytes, i.e. about
+    0.45 GB for 2000 frames at 768x768. The stores take 320 * H/8 * W/8 * 2 + H * W * 3 bytes
+    of disk per frame (about 7.7 MB at 768x768).
+'''
+
+
+class FrameStore:
+    """
+    Frame-major array file, indexed like a (b, c, f, h, w) tensor along the frame axis.
+
+    Frames are appended in video order; store[:, :, frames] reads only those frames from the
+    file (plain reads, no mmap, so nothing outside the window stays resident) and returns a
+    tensor on the device / dtype set with .to(). Stores pickle as their path, so window worker
+    processes read the same file.
+    """
+
+    def __init__(self, path, frame_shape, np_dtype, num_frames=0, device="cpu", dtype=None):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)  # (b, c, h, w)
+        self.np_dtype = np.dtype(np_dtype)
+        self.num_frames = num_frames
+        self.device = torch.device(device)
+        self.dtype = dtype or getattr(torch, self.np_dtype.name)
+
+    @property
+    def frame_bytes(self):
+        return int(np.prod(self.frame_shape)) * self.np_dtype.itemsize
+
+    @property
+    def shape(self):
+        b, c, h, w = self.frame_shape
+        return (b, c, self.num_frames, h, w)
+
+    @classmethod
+    def create(cls, path, frame_shape, np_dtype):
+        open(path, "wb").close()
+        return cls(path, frame_shape, np_dtype)
+
+    @classmethod
+    def open(cls, path):
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        return cls(path, meta["frame_shape"], meta["dtype"], meta["frames"])
+
+    def append(self, frames):
+        """frames: (b, c, f, h, w) tensor."""
+        array = frames.detach().cpu().permute(2, 0, 1, 3, 4).numpy().astype(self.np_dtype)
+        with open(self.path, "ab") as f:
+            f.write(np.ascontiguousarray(array).tobytes())
+        self.num_frames += array.shape[0]
+
+    def finish(self):
+        # the metadata is written last and atomically, it marks the store as complete
+        tmp_path = self.path + ".json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(frame_shape=self.frame_shape, dtype=self.np_dtype.name, frames=self.num_frames), f)
+        os.replace(tmp_path, self.path + ".json")
+
+    def to(self, device=None, dtype=None):
+        return FrameStore(
+            self.path, self.frame_shape, self.np_dtype, self.num_frames,
+            device if device is not None else self.device,
+            dtype if dtype is not None else self.dtype,
+        )
+
+    def read(self, frames):
+        """numpy array (f, b, c, h, w) of the given frame indices, one read per contiguous run."""
+        frames = list(frames)
+        out = np.empty((len(frames), *self.frame_shape), dtype=self.np_dtype)
+        with open(self.path, "rb") as f:
+            i = 0
+            while i < len(frames):
+                j = i + 1
+                while j < len(frames) and frames[j] == frames[j - 1] + 1:
+                    j += 1
+                f.seek(frames[i] * self.frame_bytes)
+                f.readinto(memoryview(out[i:j].reshape(-1)).cast("B"))
+                i = j
+        return out
+
+    def __getitem__(self, index):
+        # only [:, :, frames], the way the pipeline slices pose features and pose frames
+        frames = index[2]
+        if isinstance(frames, slice):
+            frames = range(*frames.indices(self.num_frames))
+        tensor = torch.from_numpy(self.read(frames)).permute(1, 2, 0, 3, 4).contiguous()
+        return tensor.to(device=self.device, dtype=self.dtype)
+
+
+def iter_frames(video_path):
+    """PIL frames of a video, decoded one at a time."""
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        for packet in container.demux(stream):
+            for frame in packet.decode():
+                yield frame.to_image()
+
+
+def iter_pose_frames(video_path, max_frames, skip):
+    """
+    Frames 0, k, 2k ... (k = skip + 1) of the first max_frames frames, each only once its group
+    of k frames is complete, which gives the min(L, len) // k frames of test_stage_2.prepare_pose.
+    """
+    k = skip + 1
+    held = None
+    for j, frame in enumerate(iter_frames(video_path)):
+        if j >= max_frames:
+            break
+        if j % k == 0:
+            held = frame
+        if j % k == k - 1:
+            yield held
+            held = None
+
+
+def prepare_pose_long(pipe, args, pose_video_path, timer, work_dir):
+    """
+    prepare_pose for --long_video: the same pose features and grid frames, as FrameStores.
+
+    The pose video is decoded and run through the pose guider args.S frames at a time. The
+    stores are kept in work_dir under the pose cache key, so a later job with the same pose
+    video and settings reuses them.
+    """
+    width, height = args.W, args.H
+    key = make_key(
+        "pose", file_sha256(pose_video_path), width, height,
+        args.L, args.S, args.O, args.skip, pipe.pose_weights_version,
+    )
+    pose_dir = os.path.join(work_dir, key)
+    fea_path = os.path.join(pose_dir, "pose_fea.bin")
+    frames_path = os.path.join(pose_dir, "pose_frames.bin")
+    info_path = os.path.join(pose_dir, "pose.json")
+
+    if os.path.exists(info_path):
+        print("pose features from", pose_dir)
+        with open(info_path) as f:
+            info = json.load(f)
+        return dict(
+            pose_fea=FrameStore.open(fea_path),
+            pose_frames=FrameStore.open(frames_path),
+            L=info["L"],
+            src_fps=info["src_fps"],
+            original_size=tuple(info["original_size"]),
+        )
+
+    os.makedirs(pose_dir, exist_ok=True)
+    src_fps = get_fps(pose_video_path) // (args.skip + 1)
+    pose_transform = transforms.Compose(
+        [transforms.Resize((height, width)), transforms.ToTensor()]
+    )
+
+    pose_fea = pose_frames = None
+    last_fea = None
+    original_size = (0, 0)
+
+    def encode(chunk):
+        nonlocal pose_fea, pose_frames, last_fea
+        with timer.stage("pose_guider"):
+            fea = pipe.encode_pose(chunk, width, height).cpu()
+        with timer.stage("pose_transform"):
+            # ToTensor frames are uint8 / 255, so this round trip is exact
+            frames = torch.stack([pose_transform(p) for p in chunk], dim=1).unsqueeze(0)
+            frames = (frames * 255).round().to(torch.uint8)
+        if pose_fea is None:
+            pose_fea = FrameStore.create(fea_path, fea[:, :, 0].shape, np.float16)
+            pose_frames = FrameStore.create(frames_path, frames[:, :, 0].shape, np.uint8)
+        pose_fea.append(fea)
+        pose_frames.append(frames)
+        last_fea = fea[:, :, -1:]
+
+    chunk = []
+    for pose_image_pil in iter_pose_frames(pose_video_path, args.L, args.skip):
+        original_size = pose_image_pil.size
+        chunk.append(pose_image_pil)
+        if len(chunk) == args.S:
+            encode(chunk)
+            chunk = []
+    if chunk:
+        encode(chunk)
+    if pose_fea is None:
+        raise ValueError(f"no pose frames in {pose_video_path}")
+
+    # repeat the last frame up to the end of the last window, like prepare_pose
+    L = pose_frames.num_frames
+    print(f"processing length: {L}, fps {src_fps}")
+    last_segment_frame_num = (L - args.S) % (args.S - args.O)
+    repeat_frame_num = (args.S - args.O - last_segment_frame_num) % (args.S - args.O)
+    if repeat_frame_num:
+        pose_fea.append(last_fea.expand(-1, -1, repeat_frame_num, -1, -1))
+
+    pose_fea.finish()
+    pose_frames.finish()
+    info = dict(L=L, src_fps=src_fps, original_size=list(original_size))
+    with open(info_path + ".tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(info_path + ".tmp", info_path)
+    return dict(pose_fea=pose_fea, pose_frames=pose_frames, L=L, src_fps=src_fps, original_size=original_size)
+
+
+class LongVideoWorkDir:
+    """Folder of the pose stores: the given one (kept), or a temporary one removed on close."""
+
+    def __init__(self, path=None):
+        self.keep = path is not None
+        self.path = path or tempfile.mkdtemp(prefix="musepose_long_")
+        os.makedirs(self.path, exist_ok=True)
+
+    def close(self):
+        if not self.keep:
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,111 @@
+import json
+import os
+import time
+
+from inference.feature_cache import make_key
+from inference.profiling import write_json
+
+
+'''
+    Resumable sweeps over the test_cases of a config.
+
+    root/manifest.json   the settings of the sweep and the expanded job list: id, reference image,
+                         pose video and seed per job, in test_cases order
+    root/done/<id>.json  completion record of a job (its seed and output paths), written atomically
+                         after the outputs, so a job without one is redone from scratch
+
+    Job ids hash the reference and pose paths, outputs (and their .timings.json) go to
+    root/jobs/<id>/, and every job has its own seed, so a rerun skips the finished jobs and
+    produces the same videos for the others. Test cases added to the config later are appended with the next seeds.
+'''
+
+
+class JobManifest:
+    def __init__(self, root, settings, jobs):
+        self.root = str(root)
+        self.settings = settings
+        self.jobs = jobs
+
+    @property
+    def path(self):
+        return os.path.join(self.root, "manifest.json")
+
+    def _done_path(self, job):
+        return os.path.join(self.root, "done", job["id"] + ".json")
+
+    @classmethod
+    def open(cls, root, cases, settings, seed):
+        """Loads root/manifest.json (settings must match) or creates it from cases [(ref, pose), ...]."""
+        path = os.path.join(str(root), "manifest.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data["settings"] != settings:
+                changed = sorted(
+                    k for k in set(data["settings"]) | set(settings) if data["settings"].get(k) != settings.get(k)
+                )
+                raise ValueError(
+                    f"{path} was created with different settings ({', '.join(changed)}), "
+                    f"use another --manifest folder"
+                )
+            manifest = cls(root, settings, data["jobs"])
+        else:
+            manifest = cls(root, settings, [])
+
+        known = {job["id"] for job in manifest.jobs}
+        added = 0
+        for ref_image, pose_video in cases:
+            job_id = make_key(ref_image, pose_video)[:16]
+            if job_id in known:
+                continue
+            known.add(job_id)
+            manifest.jobs.append(dict(
+                id=job_id, ref_image=ref_image, pose_video=pose_video, seed=seed + len(manifest.jobs),
+            ))
+            added += 1
+        if added or not os.path.exists(path):
+            os.makedirs(os.path.join(manifest.root, "done"), exist_ok=True)
+            write_json(path, dict(settings=settings, jobs=manifest.jobs))
+        return manifest
+
+    def is_done(self, job):
+        path = self._done_path(job)
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            outputs = json.load(f)["outputs"]
+        # a record whose videos were deleted since counts as not done
+        return all(os.path.exists(p) for p in outputs)
+
+    def pending(self):
+        return [job for job in self.jobs if not self.is_done(job)]
+
+    def mark_done(self, job, outputs, **extra):
+        write_json(self._done_path(job), dict(job, outputs=[str(p) for p in outputs], finished=time.time(), **extra))
+
+
+class Progress:
+    """Jobs per hour and ETA of the jobs of this run."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+
+    def update(self, failed=False):
+        self.done += 1
+        self.failed += int(failed)
+        elapsed = time.perf_counter() - self.started
+        rate = self.done / elapsed * 3600
+        eta = (self.total - self.done) / self.done * elapsed
+        print(
+            f"[{self.done}/{self.total}] {rate:.1f} jobs/hour, ETA {format_seconds(eta)}"
+            + (f", {self.failed} failed" if self.failed else "")
+        )
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
@@ -0,0 +1,62 @@
+import os
+
+import torch
+
+
+def available_memory(device="cpu"):
+    """Bytes that can still be allocated on device (free VRAM for cuda, available RAM otherwise)."""
+    if str(device).startswith("cuda") and torch.cuda.is_available():
+        return torch.cuda.mem_get_info(torch.device(device))[0]
+
+    # mps shares system memory, so RAM is the limit there as well
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_item_bytes(width, height, video_length, context_frames, do_classifier_free_guidance, dtype_size=2):
+    """
+    Rough extra memory of one more video in a Pose2Video batch.
+
+    Counts the pose guider features, the fp32 latent buffers, the decoded and rescaled
+    output frames, and the denoising UNet activations of one context window
+    (~64 feature maps of 320 channels at 1/8 resolution per frame, doubled with CFG).
+    """
+    h, w = height // 8, width // 8
+    cfg = 2 if do_classifier_free_guidance else 1
+    pose_fea = 320 * video_length * h * w * dtype_size
+    latents = 4 * video_length * h * w * 4 * (2 + 2 * cfg)
+    frames = 3 * video_length * height * width * 4 * 4
+    unet = estimate_window_bytes(width, height, context_frames, cfg, dtype_size)
+    return pose_fea + latents + frames + unet
+
+
+def estimate_window_bytes(width, height, context_frames, batch, dtype_size=2):
+    """Denoising UNet activations of one forward over a context window with `batch` rows."""
+    return 64 * 320 * context_frames * (height // 8) * (width // 8) * dtype_size * batch
+
+
+def auto_batch_size(device, item_bytes, max_batch_size=8, fraction=0.7):
+    """Largest batch whose estimated footprint fits into `fraction` of the available memory."""
+    available = available_memory(device)
+    if available is None:
+        return 1
+    return int(max(1, min(max_batch_size, fraction * available // item_bytes)))
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    import resource
+    import sys
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
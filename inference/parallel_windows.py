@@ -0,0 +1,218 @@
+import os
+import glob
+import queue
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from inference.feature_cache import attention_banks
+from inference.pipeline_pose2vid import ReferenceBanks, denoise_guided
+
+
+'''
+    Context windows of every denoising step shared between the main process and worker processes.
+
+    Each worker holds its own denoising UNet (built once by a picklable build function) and
+    receives, per job, the reference attention banks, CLIP embeddings and pose features from
+    the main process. Per step the windows are cut into contiguous chunks: the main process
+    denoises the first chunk while the workers denoise the others, and all predictions are
+    blended by the pipeline in window order, exactly like the serial loop. With the same
+    intra-op thread count in every process the result is bit-identical to the serial path.
+'''
+
+
+def _parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def cpu_sets(num_sets):
+    """One cpu set per participant: whole NUMA nodes when there are enough, else an even split."""
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in available]
+        if cpus:
+            nodes.append(cpus)
+    if len(nodes) >= num_sets:
+        return nodes[:num_sets]
+    if not available:
+        return [None] * num_sets
+    size = len(available) // num_sets
+    return [available[i * size : (i + 1) * size] or available for i in range(num_sets)]
+
+
+def _pin(cpus, num_threads=None):
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    num_threads = num_threads or (len(cpus) if cpus else None)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def _worker_main(build_fn, cpus, num_threads, inbox, outbox):
+    # every failure goes back as ("error", traceback), the main process is waiting for a reply
+    try:
+        _pin(cpus, num_threads)
+        pipe = build_fn()
+        unet = pipe.denoising_unet
+        autocast = pipe.autocast
+        # the other components are not needed here
+        for name in ["vae", "image_encoder", "reference_unet", "pose_guider"]:
+            setattr(pipe, name, None)
+
+        from musepose.models.mutual_self_attention import ReferenceAttentionControl
+    except Exception:
+        outbox.put(("error", traceback.format_exc()))
+        return
+    outbox.put(("ready", os.getpid()))
+
+    reader = reference_banks = encoder_hidden_states = pose_fea = None
+    while True:
+        message = inbox.get()
+        kind = message[0]
+        if kind == "close":
+            break
+        try:
+            if kind == "begin":
+                _, banks, encoder_hidden_states, pose_fea, do_cfg, batch_size = message
+                reader = ReferenceAttentionControl(
+                    unet,
+                    do_classifier_free_guidance=do_cfg,
+                    mode="read",
+                    batch_size=batch_size,
+                    fusion_blocks="full",
+                )
+                for module, bank in zip(attention_banks(unet), banks):
+                    module.bank = list(bank)
+                reference_banks = ReferenceBanks(unet, batch_size, do_cfg)
+                if getattr(unet, "deep_cache", None) is not None:
+                    unet.deep_cache.reset()
+                outbox.put(("begun", None))
+            elif kind == "step":
+                _, t, model_latents, contexts, mode = message
+                preds = []
+                with torch.no_grad(), autocast():
+                    for context in contexts:
+                        preds.append(denoise_guided(
+                            unet, reference_banks, model_latents, context, t,
+                            encoder_hidden_states, pose_fea, mode,
+                        ))
+                outbox.put(("preds", preds))
+            elif kind == "end":
+                if reader is not None:
+                    reader.clear()
+                reader = reference_banks = None
+                encoder_hidden_states = pose_fea = None
+        except Exception:
+            outbox.put(("error", traceback.format_exc()))
+
+
+class WindowWorkerPool:
+    """
+    num_workers extra processes for FastPose2VideoPipeline.window_pool.
+
+    build_fn must be picklable (e.g. functools.partial of a module-level function) and return a
+    pipeline configured like the main one, so that autocast / cpu mode match.
+    """
+
+    def __init__(self, build_fn, num_workers, num_threads=None, pin=True):
+        self.num_workers = num_workers
+        ctx = mp.get_context("spawn")
+        sets = cpu_sets(num_workers + 1) if pin else [None] * (num_workers + 1)
+        self.main_affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+        self.main_threads = torch.get_num_threads()
+        _pin(sets[0], num_threads)
+
+        self.workers = []
+        for cpus in sets[1:]:
+            inbox, outbox = ctx.Queue(), ctx.Queue()
+            process = ctx.Process(
+                target=_worker_main, args=(build_fn, cpus, num_threads, inbox, outbox), daemon=True
+            )
+            process.start()
+            self.workers.append((process, inbox, outbox))
+        for worker in self.workers:
+            self._receive(worker)
+        print(f"window workers ready: main + {num_workers}, cpu sets {[len(c) if c else 0 for c in sets]}")
+
+    def begin(self, pipe, encoder_hidden_states, pose_fea, do_cfg, batch_size):
+        # the reader banks of the main UNet, already filled by reader.update(writer)
+        banks = [list(module.bank) for module in attention_banks(pipe.denoising_unet)]
+        for _, inbox, _ in self.workers:
+            inbox.put(("begin", banks, encoder_hidden_states, pose_fea, do_cfg, batch_size))
+        self._receive_all()
+
+    def _receive(self, worker, poll=1.0):
+        """Next reply of a worker; raises if it reported an error or died without replying."""
+        process, _, outbox = worker
+        while True:
+            try:
+                kind, payload = outbox.get(timeout=poll)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"window worker {process.pid} died (exit code {process.exitcode})")
+        if kind == "error":
+            raise RuntimeError(f"window worker {process.pid} failed:\n{payload}")
+        return payload
+
+    def _receive_all(self):
+        # one reply from every worker before raising, so no stale reply is left for the next step
+        replies, error = [], None
+        for worker in self.workers:
+            try:
+                replies.append(self._receive(worker))
+            except RuntimeError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return replies
+
+    def denoise(self, t, model_latents, global_context, mode, local_fn):
+        """
+        Predictions of all windows of one step in window order; local_fn(context) denoises the
+        first chunk in the main process. model_latents are already scaled by the main
+        scheduler, the workers hold no scheduler state; mode is the guidance mode of the step.
+        """
+        # contiguous chunks, the main process takes the first one
+        n = self.num_workers + 1
+        bounds = [round(k * len(global_context) / n) for k in range(n + 1)]
+        chunks = [global_context[bounds[k] : bounds[k + 1]] for k in range(n)]
+
+        for (_, inbox, _), contexts in zip(self.workers, chunks[1:]):
+            inbox.put(("step", t, model_latents, contexts, mode))
+
+        try:
+            preds = [local_fn(context) for context in chunks[0]]
+        except Exception:
+            # collect the replies of this step before raising, they would be read as the next one
+            try:
+                self._receive_all()
+            except RuntimeError:
+                pass
+            raise
+        for worker_preds in self._receive_all():
+            preds.extend(worker_preds)
+        return preds
+
+    def end(self):
+        for _, inbox, _ in self.workers:
+            inbox.put(("end",))
+
+    def close(self):
+        for process, inbox, _ in self.workers:
+            inbox.put(("close",))
+            process.join(timeout=30)
+        self.workers = []
+        if self.main_affinity and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.main_affinity)
+        torch.set_num_threads(self.main_threads)
@@ -0,0 +1,176 @@
+from typing import List, Optional, Union
+
+import torch
+from PIL import Image
+from torch.profiler import record_function
+
+from musepose.models.mutual_self_attention import ReferenceAttentionControl
+from musepose.pipelines.pipeline_pose2img import (
+    Pose2ImagePipeline,
+    Pose2ImagePipelineOutput,
+)
+
+from inference.feature_cache import encode_reference, repeat_reference
+
+
+class FastPose2ImagePipeline(Pose2ImagePipeline):
+    """
+    Pose2ImagePipeline reusing per-reference artifacts (see inference.feature_cache).
+
+    pose_image may be a list: one sample per pose image, all of the same reference, denoised
+    as one batch; the reference path runs once. With a list of generators (one per sample)
+    every sample matches a single call with that generator.
+    """
+
+    reference_cache = None
+    weights_version = ""
+
+    def enable_reference_cache(self, cache, weights_version=""):
+        self.reference_cache = cache
+        self.weights_version = weights_version
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        ref_image: Image.Image,
+        pose_image: Union[Image.Image, List[Image.Image]],
+        width: int,
+        height: int,
+        num_inference_steps: int,
+        guidance_scale: float,
+        num_images_per_prompt: int = 1,
+        eta: float = 0.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        output_type: Optional[str] = "tensor",
+        return_dict: bool = True,
+        callback=None,
+        callback_steps: Optional[int] = 1,
+        **kwargs,
+    ):
+        device = self._execution_device
+
+        do_classifier_free_guidance = guidance_scale > 1.0
+
+        # Prepare timesteps
+        self.scheduler.set_timesteps(num_inference_steps, device=device)
+        timesteps = self.scheduler.timesteps
+
+        pose_images = pose_image if isinstance(pose_image, (list, tuple)) else [pose_image]
+        batch_size = len(pose_images)
+
+        reference_control_writer = ReferenceAttentionControl(
+            self.reference_unet,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            mode="write",
+            batch_size=batch_size,
+            fusion_blocks="full",
+        )
+        reference_control_reader = ReferenceAttentionControl(
+            self.denoising_unet,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            mode="read",
+            batch_size=batch_size,
+            fusion_blocks="full",
+        )
+
+        # CLIP embeds, ref latents and reference UNet features, possibly from the cache
+        image_prompt_embeds, ref_image_latents = encode_reference(
+            self, ref_image, width, height, do_classifier_free_guidance, timesteps[0]
+        )
+        image_prompt_embeds, ref_image_latents = repeat_reference(
+            self, image_prompt_embeds, ref_image_latents, batch_size
+        )
+        reference_control_reader.update(reference_control_writer)
+
+        num_channels_latents = self.denoising_unet.in_channels
+        latents = self.prepare_latents(
+            batch_size * num_images_per_prompt,
+            num_channels_latents,
+            width,
+            height,
+            image_prompt_embeds.dtype,
+            device,
+            generator,
+        )
+        latents = latents.unsqueeze(2)  # (bs, c, 1, h', w')
+
+        # Prepare extra step kwargs.
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+
+        # Prepare pose condition image, every distinct pose image once
+        unique = {}
+        for image in pose_images:
+            unique.setdefault(id(image), image)
+        pose_cond_tensor = torch.cat([
+            self.cond_image_processor.preprocess(image, height=height, width=width)
+            for image in unique.values()
+        ])
+        pose_cond_tensor = pose_cond_tensor.unsqueeze(2)  # (bs, c, 1, h, w)
+        pose_cond_tensor = pose_cond_tensor.to(
+            device=device, dtype=self.pose_guider.dtype
+        )
+        with record_function("pose_guider"):
+            pose_fea = self.pose_guider(pose_cond_tensor)
+        index = {key: i for i, key in enumerate(unique)}
+        pose_fea = pose_fea[[index[id(image)] for image in pose_images]]
+        pose_fea = (
+            torch.cat([pose_fea] * 2) if do_classifier_free_guidance else pose_fea
+        )
+
+        # denoising loop
+        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
+        with self.progress_bar(total=num_inference_steps) as progress_bar:
+            for i, t in enumerate(timesteps):
+                # expand the latents if we are doing classifier free guidance
+                latent_model_input = (
+                    torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                )
+                latent_model_input = self.scheduler.scale_model_input(
+                    latent_model_input, t
+                )
+
+                with record_function("denoising_unet"):
+                    noise_pred = self.denoising_unet(
+                        latent_model_input,
+                        t,
+                        encoder_hidden_states=image_prompt_embeds,
+                        pose_cond_fea=pose_fea,
+                        return_dict=False,
+                    )[0]
+
+                # perform guidance
+                if do_classifier_free_guidance:
+                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                    noise_pred = noise_pred_uncond + guidance_scale * (
+                        noise_pred_text - noise_pred_uncond
+                    )
+
+                # compute the previous noisy sample x_t -> x_t-1
+                latents = self.scheduler.step(
+                    noise_pred, t, latents, **extra_step_kwargs, return_dict=False
+                )[0]
+
+                # call the callback, if provided
+                if i == len(timesteps) - 1 or (
+                    (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
+                ):
+                    progress_bar.update()
+                    if callback is not None and i % callback_steps == 0:
+                        step_idx = i // getattr(self.scheduler, "order", 1)
+                        callback(step_idx, t, latents)
+
+            reference_control_reader.clear()
+            reference_control_writer.clear()
+
+        # Post-processing
+        with record_function("vae_decode"):
+            image = self.decode_latents(latents)  # (b, c, 1, h, w)
+
+        # Convert to tensor
+        if output_type == "tensor":
+            image = torch.from_numpy(image)
+
+        if not return_dict:
+            return image
+
+        return Pose2ImagePipelineOutput(images=image)
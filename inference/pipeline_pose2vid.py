@@ -0,0 +1,543 @@
+import math
+import time
+from contextlib import nullcontext
+from typing import List, Optional, Union
+
+import torch
+from PIL import Image
+from torch.profiler import record_function
+
+from diffusers import DDIMScheduler
+
+from musepose.models.mutual_self_attention import ReferenceAttentionControl
+from musepose.pipelines.context import get_context_scheduler
+from musepose.pipelines.pipeline_pose2vid_long import (
+    Pose2VideoPipeline,
+    Pose2VideoPipelineOutput,
+)
+
+from inference.feature_cache import attention_banks, encode_references
+from inference.profiling import stage
+from inference.samplers import make_scheduler
+from inference.vae_decode import decode_latents
+
+
+def window_model_input(model_latents, context, do_classifier_free_guidance):
+    # 3.1 expand the latents if we are doing classifier free guidance; model_latents are
+    # already scaled by scheduler.scale_model_input, once per step for all windows
+    return (
+        torch.cat([model_latents[:, :, c] for c in context])
+        .to(model_latents.device)
+        .repeat(2 if do_classifier_free_guidance else 1, 1, 1, 1, 1)
+    )
+
+
+def denoise_window(unet, latent_model_input, t, encoder_hidden_states, pose_fea, context, do_classifier_free_guidance, branch=None):
+    """Noise prediction of one batch of context windows; branch names the guidance branch for unet.deep_cache."""
+    b, c, f, h, w = latent_model_input.shape
+    deep_cache = getattr(unet, "deep_cache", None)
+    if deep_cache is not None:
+        # cached deep features belong to exactly this window and branch
+        deep_cache.begin((tuple(frame for window in context for frame in window), branch))
+    latent_pose_input = torch.cat(
+        [pose_fea[:, :, c] for c in context]
+    ).repeat(2 if do_classifier_free_guidance else 1, 1, 1, 1, 1)
+
+    with record_function("denoising_unet"):
+        return unet(
+            # latents may be stored in a lower precision than the UNet runs in (latents_dtype)
+            latent_model_input.to(unet.dtype),
+            t,
+            encoder_hidden_states=encoder_hidden_states[:b],
+            pose_cond_fea=latent_pose_input,
+            return_dict=False,
+        )[0]
+
+
+class ReferenceBanks:
+    """
+    Reference attention banks of the denoising UNet, switchable between guidance modes.
+
+    "batched"  [uncond..., cond...] in one forward, the uncond rows masked to self-attention
+               by the reader hooks (the upstream path)
+    "cond"     the conditional branch alone, with the cond half of every bank
+    "uncond"   the unconditional branch alone: empty banks, i.e. self-attention only, exactly
+               what the masked rows of the batched forward compute
+    "none"     no classifier-free guidance at all, banks as written
+
+    The uc_mask of the hooks is fixed when a reader is registered, so switching between
+    "batched" and the single-branch modes re-registers one; the other switches only swap lists.
+    """
+
+    def __init__(self, unet, batch_size, do_classifier_free_guidance):
+        self.unet = unet
+        self.batch_size = batch_size
+        self.modules = attention_banks(unet)
+        self.full = [list(module.bank) for module in self.modules]
+        self.mode = "batched" if do_classifier_free_guidance else "none"
+
+    def use(self, mode):
+        if mode == self.mode:
+            return
+        if (mode == "batched") != (self.mode == "batched"):
+            ReferenceAttentionControl(
+                self.unet,
+                do_classifier_free_guidance=mode == "batched",
+                mode="read",
+                batch_size=self.batch_size,
+                fusion_blocks="full",
+            )
+        for module, bank in zip(self.modules, self.full):
+            if mode == "cond":
+                module.bank = [fea[fea.shape[0] // 2 :] for fea in bank]
+            elif mode == "uncond":
+                module.bank = []
+            else:
+                module.bank = list(bank)
+        self.mode = mode
+
+
+def denoise_guided(unet, banks, model_latents, context, t, encoder_hidden_states, pose_fea, mode):
+    """
+    Noise prediction of one batch of windows in guidance mode "batched" or "none" (one forward),
+    "sequential" (uncond and cond as two forwards, same [uncond, cond] result) or "cond".
+    """
+    if mode in ("batched", "none"):
+        banks.use(mode)
+        do_cfg = mode == "batched"
+        return denoise_window(
+            unet, window_model_input(model_latents, context, do_cfg), t,
+            encoder_hidden_states, pose_fea, context, do_cfg, branch=mode,
+        )
+
+    uncond_states, cond_states = encoder_hidden_states.chunk(2)
+    latent_model_input = window_model_input(model_latents, context, False)
+    banks.use("cond")
+    pred = denoise_window(unet, latent_model_input, t, cond_states, pose_fea, context, False, branch="cond")
+    if mode == "cond":
+        return pred
+    banks.use("uncond")
+    pred_uncond = denoise_window(unet, latent_model_input, t, uncond_states, pose_fea, context, False, branch="uncond")
+    return torch.cat([pred_uncond, pred])
+
+
+class FrameStream:
+    """
+    Final-step bookkeeping of FastPose2VideoPipeline(frame_callback=...).
+
+    The windows of the last step are ordered by their first frame, so frames become final in
+    video order. With a stateless, elementwise scheduler step (DDIM, eta=0) every frame is stepped
+    as soon as the last window covering it is blended, then VAE-decoded and handed to
+    frame_callback(start, frames) in chunks of at most context_frames; with other schedulers the
+    whole step runs first and the frames are decoded and emitted chunk by chunk afterwards.
+    Blending sums are unchanged as long as no frame lies in more than two windows.
+    """
+
+    def __init__(self, pipe, frame_callback, global_context, num_frames, chunk_size, partial_step):
+        self.pipe = pipe
+        self.frame_callback = frame_callback
+        self.chunk_size = max(1, chunk_size)
+        self.partial_step = partial_step
+        self.global_context = sorted(
+            global_context, key=lambda context: min(min(c) for c in context)
+        )
+        self.pending = [0] * num_frames
+        for context in self.global_context:
+            for frame in {f for c in context for f in c}:
+                self.pending[frame] += 1
+        self.emitted = 0
+
+    def _emit(self, latents, start, end):
+        for a in range(start, end, self.chunk_size):
+            b = min(end, a + self.chunk_size)
+            with stage(self.pipe.timer, "vae_decode"):
+                frames = torch.from_numpy(
+                    self.pipe.decode_latents(latents[:, :, a:b].to(self.pipe.vae.dtype))
+                )
+            self.frame_callback(a, frames)
+
+    def window_done(self, context, noise_pred, counter, latents, guided_step):
+        for frame in {f for c in context for f in c}:
+            self.pending[frame] -= 1
+        ready = self.emitted
+        while ready < len(self.pending) and self.pending[ready] == 0:
+            ready += 1
+        if ready > self.emitted:
+            sl = slice(self.emitted, ready)
+            # no later window reads these frames, so they can be stepped in place
+            latents[:, :, sl] = guided_step(noise_pred[:, :, sl], counter[:, :, sl], latents[:, :, sl])
+            self._emit(latents, self.emitted, ready)
+            self.emitted = ready
+
+    def flush(self, noise_pred, counter, latents, guided_step):
+        if self.emitted < len(self.pending):
+            sl = slice(self.emitted, len(self.pending))
+            latents[:, :, sl] = guided_step(noise_pred[:, :, sl], counter[:, :, sl], latents[:, :, sl])
+            self._emit(latents, self.emitted, len(self.pending))
+            self.emitted = len(self.pending)
+
+    def emit_all(self, latents):
+        self._emit(latents, 0, latents.shape[2])
+        self.emitted = latents.shape[2]
+
+
+class FastPose2VideoPipeline(Pose2VideoPipeline):
+    """
+    Pose2VideoPipeline with the same sliding-window denoising loop, plus reusable
+    per-reference artifacts (see inference.feature_cache).
+
+    ref_image may also be a list of references, generating one video per reference in a
+    single batch; pose_images (or pose_fea) and generator are then given per item as well.
+
+    cfg_mode "sequential" runs the unconditional and conditional branch of every window as two
+    forwards instead of one of twice the batch; guidance_interval=(start, end) applies guidance
+    only over that fraction of the steps and runs the conditional branch alone elsewhere.
+
+    pose_fea can be anything indexable like the (b, c, f, h, w) tensor along the frames, e.g.
+    an inference.long_video.FrameStore; latents_dtype keeps the latents and blend buffers in a
+    smaller dtype between steps (see inference.long_video).
+    """
+
+    reference_cache = None
+    weights_version = ""
+    pose_cache = None
+    pose_weights_version = ""
+    # set by inference.cpu.optimize_for_cpu, the weights stay fp32
+    autocast_dtype = None
+    # inference.parallel_windows.WindowWorkerPool sharing the context windows of every step
+    window_pool = None
+    # frames per VAE decoder call and latent tile size, see inference.vae_decode
+    decode_batch_size = 1
+    decode_tile_size = None
+    decode_tile_overlap = 8
+    # (guidance mode, seconds) of every step of the last call, seconds of every window per step
+    last_step_times = []
+    last_window_times = []
+    # inference.profiling.StageTimer the encode / denoise / decode stages are recorded in
+    timer = None
+
+    @classmethod
+    def from_bundle(cls, path, device="cpu", dtype=None, sampler="ddim"):
+        """Rebuilds the pipeline from a single convert_weights.py --bundle file."""
+        from inference.weights import load_bundle
+
+        components, scheduler_kwargs = load_bundle(path, device, dtype)
+        return cls(scheduler=make_scheduler(sampler, scheduler_kwargs), **components)
+
+    def enable_reference_cache(self, cache, weights_version=""):
+        self.reference_cache = cache
+        self.weights_version = weights_version
+
+    def autocast(self):
+        """Context the pipeline should be called in, autocast when autocast_dtype is set."""
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self._execution_device.type, dtype=self.autocast_dtype)
+
+    def enable_batched_decode(self, batch_size, tile_size=None, tile_overlap=8):
+        self.decode_batch_size = batch_size
+        self.decode_tile_size = tile_size or None
+        self.decode_tile_overlap = tile_overlap
+
+    def decode_latents(self, latents):
+        return decode_latents(
+            self.vae, latents, self.decode_batch_size, self.decode_tile_size, self.decode_tile_overlap
+        )
+
+    def enable_deep_cache(self, interval=3, depth=1):
+        """DeepCache-style reuse of the deep denoising UNet features, see inference.deep_cache."""
+        from inference.deep_cache import enable_deep_cache
+
+        return enable_deep_cache(self.denoising_unet, interval, depth)
+
+    def enable_pose_cache(self, cache, weights_version=""):
+        # consulted by the caller, which can then skip decoding the pose video as well
+        self.pose_cache = cache
+        self.pose_weights_version = weights_version
+
+    @torch.no_grad()
+    def encode_pose(self, pose_images, width, height):
+        """PoseGuider features (1, c, f, h/8, w/8) of a list of pose frames."""
+        device = self._execution_device
+        pose_cond_tensor_list = []
+        for pose_image in pose_images:
+            pose_cond_tensor = self.cond_image_processor.preprocess(
+                pose_image, height=height, width=width
+            )
+            pose_cond_tensor = pose_cond_tensor.unsqueeze(2)  # (bs, c, 1, h, w)
+            pose_cond_tensor_list.append(pose_cond_tensor)
+        pose_cond_tensor = torch.cat(pose_cond_tensor_list, dim=2)  # (bs, c, t, h, w)
+        pose_cond_tensor = pose_cond_tensor.to(
+            device=device, dtype=self.pose_guider.dtype
+        )
+        return self.pose_guider(pose_cond_tensor)
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        ref_image: Union[Image.Image, List[Image.Image]],
+        pose_images: List[Image.Image],
+        width: int,
+        height: int,
+        video_length: int,
+        num_inference_steps: int,
+        guidance_scale: float,
+        num_images_per_prompt: int = 1,
+        eta: float = 0.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        output_type: Optional[str] = "tensor",
+        return_dict: bool = True,
+        callback=None,
+        callback_steps: Optional[int] = 1,
+        context_schedule="uniform",
+        context_frames=24,
+        context_stride=1,
+        context_overlap=4,
+        context_batch_size=1,
+        interpolation_factor=1,
+        pose_fea=None,
+        frame_callback=None,
+        latents_dtype=None,
+        cfg_mode="batched",
+        guidance_interval=(0.0, 1.0),
+        **kwargs,
+    ):
+        device = self._execution_device
+        if frame_callback is not None and interpolation_factor >= 2:
+            raise ValueError("frame_callback does not support latent interpolation")
+
+        do_classifier_free_guidance = guidance_scale > 1.0
+        if cfg_mode not in ("batched", "sequential"):
+            raise ValueError(f"cfg_mode must be 'batched' or 'sequential', not {cfg_mode!r}")
+
+        # Prepare timesteps
+        self.scheduler.set_timesteps(num_inference_steps, device=device)
+        timesteps = self.scheduler.timesteps
+
+        ref_images = ref_image if isinstance(ref_image, (list, tuple)) else [ref_image]
+        batch_size = len(ref_images)
+        if batch_size > 1 and context_batch_size != 1:
+            # several windows per forward would interleave the items against the reference banks
+            raise ValueError("batched generation requires context_batch_size=1")
+
+        reference_control_writer = ReferenceAttentionControl(
+            self.reference_unet,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            mode="write",
+            batch_size=batch_size,
+            fusion_blocks="full",
+        )
+        reference_control_reader = ReferenceAttentionControl(
+            self.denoising_unet,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            mode="read",
+            batch_size=batch_size,
+            fusion_blocks="full",
+        )
+
+        # CLIP embeds, ref latents and reference UNet features, possibly from the cache
+        encoder_hidden_states, ref_image_latents = encode_references(
+            self, ref_images, width, height, do_classifier_free_guidance, timesteps[0]
+        )
+        reference_control_reader.update(reference_control_writer)
+
+        num_channels_latents = self.denoising_unet.in_channels
+        latents = self.prepare_latents(
+            batch_size * num_images_per_prompt,
+            num_channels_latents,
+            width,
+            height,
+            video_length,
+            # not encoder_hidden_states.dtype, which is the autocast dtype under autocast
+            self.denoising_unet.dtype,
+            device,
+            generator,
+        )
+        # the scheduler step runs in the UNet dtype, the latents are only stored in latents_dtype
+        step_dtype = latents.dtype
+        if latents_dtype is not None:
+            latents = latents.to(latents_dtype)
+
+        # Prepare extra step kwargs.
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+
+        # Pose guider features, precomputed (e.g. from the pose cache) or from the pose images
+        if pose_fea is None:
+            if batch_size == 1:
+                pose_fea = self.encode_pose(pose_images, width, height)
+            else:
+                pose_fea = [self.encode_pose(p, width, height) for p in pose_images]
+        if isinstance(pose_fea, (list, tuple)):
+            pose_fea = torch.cat([p.to(device) for p in pose_fea])
+        pose_fea = pose_fea.to(device=device, dtype=self.pose_guider.dtype)
+
+        context_scheduler = get_context_scheduler(context_schedule)
+        banks = ReferenceBanks(self.denoising_unet, batch_size, do_classifier_free_guidance)
+        if getattr(self.denoising_unet, "deep_cache", None) is not None:
+            self.denoising_unet.deep_cache.reset()
+        if self.window_pool is not None:
+            self.window_pool.begin(
+                self, encoder_hidden_states, pose_fea, do_classifier_free_guidance, batch_size
+            )
+
+        def guidance_mode(i):
+            # guidance over [start, end) of the sampling progress, the cond branch alone elsewhere
+            if not do_classifier_free_guidance:
+                return "none"
+            start, end = guidance_interval
+            if start <= i / len(timesteps) < end:
+                return cfg_mode
+            return "cond"
+
+        self.last_step_times = []
+        self.last_window_times = []
+
+        # denoising loop
+        num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
+        with self.progress_bar(total=num_inference_steps) as progress_bar:
+            for i, t in enumerate(timesteps):
+                step_start = time.perf_counter()
+                mode = guidance_mode(i)
+                cfg_step = mode in ("batched", "sequential")
+                noise_pred = torch.zeros(
+                    (
+                        latents.shape[0] * (2 if cfg_step else 1),
+                        *latents.shape[1:],
+                    ),
+                    device=latents.device,
+                    dtype=latents.dtype,
+                )
+                counter = torch.zeros(
+                    (1, 1, latents.shape[2], 1, 1),
+                    device=latents.device,
+                    dtype=latents.dtype,
+                )
+
+                context_queue = list(
+                    context_scheduler(
+                        0,
+                        num_inference_steps,
+                        latents.shape[2],
+                        context_frames,
+                        context_stride,
+                        context_overlap,
+                    )
+                )
+                num_context_batches = math.ceil(len(context_queue) / context_batch_size)
+                global_context = []
+                for k in range(num_context_batches):
+                    global_context.append(
+                        context_queue[k * context_batch_size : (k + 1) * context_batch_size]
+                    )
+
+                stream = None
+                if frame_callback is not None and i == len(timesteps) - 1:
+                    stream = FrameStream(
+                        self, frame_callback, global_context, latents.shape[2], context_frames,
+                        partial_step=isinstance(self.scheduler, DDIMScheduler)
+                        and eta == 0
+                        and not self.scheduler.config.get("thresholding", False),
+                    )
+                    global_context = stream.global_context
+
+                # elementwise with one factor per timestep, and stateful schedulers (Euler) expect
+                # a single call per step; identity for DDIM, so in-place partial steps stay visible
+                model_latents = self.scheduler.scale_model_input(latents, t)
+                if self.window_pool is not None:
+                    # windows spread over worker processes, results come back in window order
+                    preds = self.window_pool.denoise(
+                        t, model_latents, global_context, mode,
+                        lambda context: denoise_guided(
+                            self.denoising_unet, banks, model_latents, context, t,
+                            encoder_hidden_states, pose_fea, mode,
+                        ),
+                    )
+                else:
+                    preds = (
+                        denoise_guided(
+                            self.denoising_unet,
+                            banks,
+                            model_latents,
+                            context,
+                            t,
+                            encoder_hidden_states,
+                            pose_fea,
+                            mode,
+                        )
+                        for context in global_context
+                    )
+
+                def guided_step(noise_pred, counter, latents):
+                    # perform guidance
+                    if cfg_step:
+                        noise_pred_uncond, noise_pred_text = (noise_pred / counter).chunk(2)
+                        noise_pred = noise_pred_uncond + guidance_scale * (
+                            noise_pred_text - noise_pred_uncond
+                        )
+                    else:
+                        noise_pred = noise_pred / counter
+
+                    return self.scheduler.step(
+                        noise_pred.to(step_dtype), t, latents.to(step_dtype), **extra_step_kwargs
+                    ).prev_sample.to(latents.dtype)
+
+                window_times = []
+                window_start = time.perf_counter()
+                for context, pred in zip(global_context, preds):
+                    # the forward runs lazily when zip pulls the next prediction
+                    window_times.append(time.perf_counter() - window_start)
+                    for j, c in enumerate(context):
+                        noise_pred[:, :, c] = noise_pred[:, :, c] + pred
+                        counter[:, :, c] = counter[:, :, c] + 1
+                    if stream is not None and stream.partial_step:
+                        stream.window_done(context, noise_pred, counter, latents, guided_step)
+                    window_start = time.perf_counter()
+
+                if stream is not None and stream.partial_step:
+                    # every frame was stepped and emitted by window_done
+                    stream.flush(noise_pred, counter, latents, guided_step)
+                else:
+                    latents = guided_step(noise_pred, counter, latents)
+                    if stream is not None:
+                        stream.emit_all(latents)
+
+                self.last_step_times.append((mode, time.perf_counter() - step_start))
+                self.last_window_times.append(window_times)
+                if self.timer is not None:
+                    self.timer.record("denoise_step", self.last_step_times[-1][1])
+                    for seconds in window_times:
+                        self.timer.record("denoise_window", seconds)
+                if i == len(timesteps) - 1 or (
+                    (i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0
+                ):
+                    progress_bar.update()
+                    if callback is not None and i % callback_steps == 0:
+                        step_idx = i // getattr(self.scheduler, "order", 1)
+                        callback(step_idx, t, latents)
+
+            reference_control_reader.clear()
+            reference_control_writer.clear()
+            if self.window_pool is not None:
+                self.window_pool.end()
+
+        if frame_callback is not None:
+            # the frames went out through frame_callback, nothing decoded is kept
+            if not return_dict:
+                return None
+            return Pose2VideoPipelineOutput(videos=None)
+
+        latents = latents.to(self.vae.dtype)
+        if interpolation_factor > 0:
+            latents = self.interpolate_latents(latents, interpolation_factor, device)
+        # Post-processing
+        with stage(self.timer, "vae_decode"):
+            images = self.decode_latents(latents)  # (b, c, f, h, w)
+
+        # Convert to tensor
+        if output_type == "tensor":
+            images = torch.from_numpy(images)
+
+        if not return_dict:
+            return images
+
+        return Pose2VideoPipelineOutput(videos=images)
@@ -0,0 +1,194 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from torch.profiler import record_function
+
+from inference.memory import peak_rss
+
+
+'''
+    Per-stage wall time and peak RSS of the inference jobs.
+
+    A stage costs two perf_counter calls and one getrusage, so the timers stay on in production;
+    wall time only, work queued on a cuda stream is counted by the stage that waits for it.
+    Peak RSS is the process high-water mark at the end of a stage, so the first stage whose value
+    jumps is the one that allocated.
+
+    Every stage is also a torch.profiler record_function range, so with --profile (make_profiler)
+    the traces and key averages are grouped by the same names.
+'''
+
+
+class StageTimer:
+    """Accumulates wall time, calls and peak RSS per named stage of one job."""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.calls = {}
+        self.peak_rss = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with record_function(name):
+                yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.peak_rss[name] = peak_rss()
+
+    def as_dict(self):
+        return dict(self.stages)
+
+    def report(self, **extra):
+        """JSON-serializable {stages: {name: {seconds, calls, peak_rss_gb}}, **extra}."""
+        return dict(
+            stages={
+                name: dict(
+                    seconds=round(seconds, 4),
+                    calls=self.calls.get(name, 0),
+                    peak_rss_gb=round(self.peak_rss.get(name, 0) / 1024**3, 3),
+                )
+                for name, seconds in self.stages.items()
+            },
+            peak_rss_gb=round(peak_rss() / 1024**3, 3),
+            **extra,
+        )
+
+
+def stage(timer, name):
+    """timer.stage(name), or only the profiler range when timer is None (no timer attached)."""
+    return record_function(name) if timer is None else timer.stage(name)
+
+
+def write_json(path, data):
+    # written next to videos that other tools pick up, so never leave a partial file behind
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def report_path(video_path):
+    return os.path.splitext(video_path)[0] + ".timings.json"
+
+
+class TimingSummary:
+    """
+    Aggregates the job reports of a run: total, mean and max seconds per stage over the
+    reports; a report of a batch (batch=n) counts as n jobs but one sample per stage.
+    """
+
+    def __init__(self):
+        self.reports = []
+        self.started = time.perf_counter()
+
+    def add(self, report):
+        self.reports.append(report)
+
+    def summary(self, **extra):
+        stages = OrderedDict()
+        jobs = sum(report.get("batch", 1) for report in self.reports)
+        for report in self.reports:
+            for name, values in report["stages"].items():
+                stages.setdefault(name, []).append(values["seconds"])
+        return dict(
+            jobs=jobs,
+            reports=len(self.reports),
+            wall_seconds=round(time.perf_counter() - self.started, 2),
+            peak_rss_gb=round(peak_rss() / 1024**3, 3),
+            stages={
+                name: dict(
+                    total=round(sum(seconds), 3),
+                    mean=round(sum(seconds) / len(seconds), 3),
+                    max=round(max(seconds), 3),
+                    jobs=len(seconds),
+                )
+                for name, seconds in stages.items()
+            },
+            **extra,
+        )
+
+    def print(self):
+        summary = self.summary()
+        if not summary["jobs"]:
+            return summary
+        print(f"timings over {summary['jobs']} jobs ({summary['reports']} reports), peak RSS {summary['peak_rss_gb']:.2f} GB:")
+        for name, values in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+            print(f"  {name:<18} total {values['total']:9.2f}s  mean {values['mean']:8.2f}s  max {values['max']:8.2f}s")
+        return summary
+
+
+def add_profile_args(parser, unit="steps"):
+    parser.add_argument("--profile", action="store_true", help=f"run torch.profiler over a window of {unit}")
+    parser.add_argument("--profile_dir", type=str, default="./output/profile", help="chrome traces and key averages go here")
+    parser.add_argument("--profile_wait", type=int, default=1, help=f"{unit} before the profiler starts")
+    parser.add_argument("--profile_warmup", type=int, default=1, help=f"{unit} traced but discarded (warm-up)")
+    parser.add_argument("--profile_active", type=int, default=3, help=f"{unit} recorded")
+    parser.add_argument("--profile_memory", action="store_true", help="also record tensor allocations")
+    parser.add_argument("--profile_row_limit", type=int, default=40, help="rows of the printed key averages table")
+
+
+class _NoProfiler:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def step(self):
+        pass
+
+
+def make_profiler(args, name):
+    """
+    torch.profiler.profile over --profile_wait / _warmup / _active steps (or jobs), or a no-op
+    without --profile. Use as a context (or start() / stop()) and call .step() after every
+    step; when the window
+    closes, <profile_dir>/<name>_<step>.json (chrome://tracing, perfetto) and
+    <name>_<step>.txt (key averages by self cpu time, and by cuda time with cuda) are written.
+    """
+    if not getattr(args, "profile", False):
+        return _NoProfiler()
+    import torch
+    from torch.profiler import ProfilerActivity, profile, schedule
+
+    os.makedirs(args.profile_dir, exist_ok=True)
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    def on_trace_ready(prof):
+        prefix = os.path.join(args.profile_dir, f"{name}_{prof.step_num}")
+        prof.export_chrome_trace(prefix + ".json")
+        averages = prof.key_averages()
+        tables = [averages.table(sort_by="self_cpu_time_total", row_limit=args.profile_row_limit)]
+        if torch.cuda.is_available():
+            tables.append(averages.table(sort_by="self_cuda_time_total", row_limit=args.profile_row_limit))
+        if args.profile_memory:
+            tables.append(averages.table(sort_by="self_cpu_memory_usage", row_limit=args.profile_row_limit))
+        with open(prefix + ".txt", "w") as f:
+            f.write("\n\n".join(tables))
+        print(tables[0])
+        print(f"profile written to {prefix}.json / .txt")
+
+    return profile(
+        activities=activities,
+        schedule=schedule(wait=args.profile_wait, warmup=args.profile_warmup, active=args.profile_active, repeat=1),
+        on_trace_ready=on_trace_ready,
+        record_shapes=True,
+        profile_memory=args.profile_memory,
+    )
@@ -0,0 +1,82 @@
+import inspect
+
+import torch
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    UniPCMultistepScheduler,
+)
+
+
+'''
+    Samplers selectable by name (sampler: in the inference config, --sampler on the command
+    line), all built from the same noise_scheduler_kwargs.
+
+    Keys a scheduler class does not take are dropped, except the zero-SNR settings the MusePose
+    weights were trained with (v_prediction, rescale_betas_zero_snr, trailing spacing): a sampler
+    that cannot honour them raises instead of silently sampling a different process.
+
+    In the pinned diffusers (<= 0.27.2) only DDIM takes rescale_betas_zero_snr; DPM++, UniPC and
+    Euler get the rescaled betas as trained_betas instead (zero_snr_betas), so every sampler
+    of SAMPLERS works with the zero-SNR config.
+'''
+
+
+SAMPLERS = {
+    "ddim": (DDIMScheduler, {}),
+    "dpmpp_2m": (DPMSolverMultistepScheduler, dict(algorithm_type="dpmsolver++", solver_order=2)),
+    "dpmpp_2m_sde": (DPMSolverMultistepScheduler, dict(algorithm_type="sde-dpmsolver++", solver_order=2)),
+    "unipc": (UniPCMultistepScheduler, {}),
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+}
+
+# settings that change the sampled process, never dropped
+REQUIRED_KWARGS = ["prediction_type", "rescale_betas_zero_snr", "timestep_spacing"]
+
+
+def sampler_name(name):
+    """Canonical key of SAMPLERS: "DDIM", "DPM++ 2M", "dpmpp-2m-sde", "Euler-a" ..."""
+    key = name.lower().replace("+", "p").replace("-", "_").replace(" ", "_")
+    key = dict(euler_ancestral="euler_a").get(key, key)
+    if key not in SAMPLERS:
+        raise ValueError(f"unknown sampler {name!r}, choose from {sorted(SAMPLERS)}")
+    return key
+
+
+def zero_snr_betas(scheduler_kwargs):
+    """
+    Betas of scheduler_kwargs after the zero terminal SNR rescale, as DDIMScheduler computes them.
+
+    Like the schedulers of newer diffusers, the last alphas_cumprod is 2**-24 instead of 0:
+    DPM-Solver, UniPC and Euler divide by it (log-SNR, sigmas), DDIM does not.
+    """
+    accepted = set(inspect.signature(DDIMScheduler.__init__).parameters)
+    ddim = DDIMScheduler(**{k: v for k, v in scheduler_kwargs.items() if k in accepted})
+    alphas_cumprod = ddim.alphas_cumprod.double().clone()
+    alphas_cumprod[-1] = 2**-24
+    alphas = alphas_cumprod / torch.cat([alphas_cumprod.new_ones(1), alphas_cumprod[:-1]])
+    return (1.0 - alphas).tolist()
+
+
+def make_scheduler(name, scheduler_kwargs):
+    """Scheduler of sampler `name` configured with the compatible part of scheduler_kwargs."""
+    cls, extra = SAMPLERS[sampler_name(name)]
+    accepted = set(inspect.signature(cls.__init__).parameters)
+    kwargs = dict(scheduler_kwargs, **extra)
+    if kwargs.get("rescale_betas_zero_snr") and "rescale_betas_zero_snr" not in accepted and "trained_betas" in accepted:
+        kwargs.pop("rescale_betas_zero_snr")
+        kwargs["trained_betas"] = zero_snr_betas(scheduler_kwargs)
+
+    missing = [k for k in REQUIRED_KWARGS if k in kwargs and k not in accepted and kwargs[k]]
+    if missing:
+        raise ValueError(
+            f"{cls.__name__} of the installed diffusers does not support {missing}, "
+            f"which the weights need; update diffusers or pick another sampler"
+        )
+    dropped = sorted(k for k in kwargs if k not in accepted)
+    if dropped:
+        print(f"{cls.__name__}: ignoring {dropped}")
+    return cls(**{k: v for k, v in kwargs.items() if k in accepted})
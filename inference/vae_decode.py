@@ -0,0 +1,97 @@
+import torch
+from einops import rearrange
+
+
+'''
+    VAE decoding of video latents in frame micro-batches, optionally in overlapping spatial
+    tiles blended with linear ramps across the seams.
+
+    micro_batch=1 without tiles is the frame-by-frame loop of the upstream pipeline and of
+    train_stage_2_multiGPU.decode_latents; larger micro-batches trade memory for fewer, larger
+    decoder calls, tiles bound the decoder activations by the tile instead of the frame size.
+'''
+
+
+def decode_item_bytes(width, height, dtype_size=4, tile_size=None):
+    """
+    Rough peak activation memory of decoding one frame: the full-resolution up block holds
+    about four 256-channel feature maps. With tiles, of one tile (tile_size in latent pixels).
+    """
+    if tile_size:
+        width, height = min(width, tile_size * 8), min(height, tile_size * 8)
+    return 4 * 256 * width * height * dtype_size
+
+
+def _tile_starts(size, tile, stride):
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def _ramp(length, overlap, first, last):
+    # 1 inside the tile, falling linearly towards the borders shared with neighbouring tiles
+    weight = torch.ones(length)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+        if not first:
+            weight[:overlap] = ramp
+        if not last:
+            weight[-overlap:] = ramp.flip(0)
+    return weight
+
+
+def decode_frames(vae, z, tile_size=None, tile_overlap=8):
+    """(n, 4, h, w) scaled latents -> (n, 3, 8h, 8w) decoder output, in tiles when tile_size is set."""
+    n, _, h, w = z.shape
+    if not tile_size or (h <= tile_size and w <= tile_size):
+        return vae.decode(z).sample
+
+    overlap = min(tile_overlap, tile_size // 2)
+    stride = tile_size - overlap
+    ys, xs = _tile_starts(h, tile_size, stride), _tile_starts(w, tile_size, stride)
+    scale = 2 ** (len(vae.config.block_out_channels) - 1)
+    video = weights = None
+    for y in ys:
+        for x in xs:
+            tile = vae.decode(z[:, :, y : y + tile_size, x : x + tile_size]).sample.float()
+            if video is None:
+                video = torch.zeros((n, tile.shape[1], h * scale, w * scale), device=tile.device)
+                weights = torch.zeros((1, 1, h * scale, w * scale), device=tile.device)
+            th, tw = tile.shape[-2:]
+            weight = (
+                _ramp(th, overlap * scale, y == ys[0], y == ys[-1])[:, None]
+                * _ramp(tw, overlap * scale, x == xs[0], x == xs[-1])[None, :]
+            ).to(tile.device)
+            Y, X = y * scale, x * scale
+            video[:, :, Y : Y + th, X : X + tw] += tile * weight
+            weights[:, :, Y : Y + th, X : X + tw] += weight
+    return video / weights
+
+
+def iter_decode(vae, latents, micro_batch=1, tile_size=None, tile_overlap=8):
+    """
+    Yields (start, frames) for latents (b, c, f, h, w): frames is a float32 cpu tensor
+    (b, 3, n, H, W) in [0, 1] of micro_batch frames per video starting at frame start.
+    """
+    video_length = latents.shape[2]
+    micro_batch = max(1, micro_batch)
+    for start in range(0, video_length, micro_batch):
+        z = 1 / 0.18215 * latents[:, :, start : start + micro_batch]
+        n = z.shape[2]
+        z = rearrange(z, "b c f h w -> (b f) c h w")
+        video = decode_frames(vae, z, tile_size, tile_overlap)
+        video = rearrange(video, "(b f) c h w -> b c f h w", f=n)
+        video = (video / 2 + 0.5).clamp(0, 1)
+        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
+        yield start, video.cpu().float()
+
+
+def decode_latents(vae, latents, micro_batch=1, tile_size=None, tile_overlap=8):
+    """numpy (b, 3, f, H, W) in [0, 1], like Pose2VideoPipeline.decode_latents."""
+    return torch.cat(
+        [frames for _, frames in iter_decode(vae, latents, micro_batch, tile_size, tile_overlap)],
+        dim=2,
+    ).numpy()
@@ -0,0 +1,87 @@
+import os
+import queue
+import threading
+
+import av
+import numpy as np
+import torchvision
+from einops import rearrange
+from PIL import Image
+
+
+class StreamingVideoWriter:
+    """
+    mp4 writer fed chunk by chunk.
+
+    Frames are laid out and encoded like musepose.utils.util.save_videos_grid (make_grid per
+    frame, libx264), so a streamed file matches one written at the end.
+    """
+
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.container = None
+        self.stream = None
+        self.frames = 0
+
+    def _open(self, width, height):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.container = av.open(self.path, "w")
+        self.stream = self.container.add_stream("libx264", rate=self.fps)
+        self.stream.width = width
+        self.stream.height = height
+
+    def write_grid(self, videos, n_rows=1):
+        """videos: (b, c, f, h, w) in [0, 1], one grid of the b videos per frame."""
+        for x in rearrange(videos, "b c t h w -> t b c h w"):
+            x = torchvision.utils.make_grid(x, nrow=n_rows)  # (c h w)
+            x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)  # (h w c)
+            x = (x * 255).numpy().astype(np.uint8)
+            image = Image.fromarray(x)
+            if self.container is None:
+                self._open(*image.size)
+            self.container.mux(self.stream.encode(av.VideoFrame.from_image(image)))
+            self.frames += 1
+
+    def close(self):
+        if self.container is not None:
+            self.container.mux(self.stream.encode())
+            self.container.close()
+            self.container = None
+
+
+class BackgroundEncoder:
+    """
+    Runs encoding work (e.g. StreamingVideoWriter.write_grid) in one background thread, so the
+    encoder overlaps with denoising and VAE decoding. At most max_pending jobs wait in the
+    queue, which bounds the frames held in memory; errors are raised again by close().
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.error is None:
+                fn, args = job
+                try:
+                    fn(*args)
+                except Exception as e:
+                    self.error = e
+
+    def submit(self, fn, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((fn, args))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,257 @@
+import os
+import json
+from collections.abc import Mapping
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from omegaconf import DictConfig, ListConfig, OmegaConf
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+
+'''
+    Fast weight loading for inference.
+
+    Converted files (see convert_weights.py) are .safetensors holding the complete, already
+    cast state dict of one module plus its constructor config in the metadata. They are
+    memory-mapped and every tensor is copied once, straight into a module skeleton on the
+    target device and dtype, instead of torch.load -> fp32 module -> load_state_dict -> cast.
+'''
+
+
+def load_weights(path):
+    """State dict of a .safetensors / .pth file, memory-mapped when the format allows it."""
+    if path.endswith(".safetensors"):
+        return load_file(path, device="cpu")
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, ValueError):
+        # torch < 2.1 has no mmap, legacy (non-zip) checkpoints cannot be mapped
+        return torch.load(path, map_location="cpu")
+
+
+class SafetensorsView(Mapping):
+    """
+    Read-only state dict over an open safe_open handle, restricted to keys under prefix.
+
+    Tensors are read from the file on access, so load_into holds one extra tensor at a time
+    instead of the whole file.
+    """
+
+    def __init__(self, handle, prefix=""):
+        self.handle = handle
+        self.prefix = prefix
+        self._keys = [k[len(prefix):] for k in handle.keys() if k.startswith(prefix)]
+        self._key_set = set(self._keys)
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        return self.handle.get_tensor(self.prefix + key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def load_into(model, state_dict, device, dtype, strict=True):
+    """
+    Places every tensor of state_dict into model on device / dtype, one copy per tensor.
+
+    model may be an empty (meta) skeleton from init_empty_weights; with strict, missing or
+    unexpected keys raise like nn.Module.load_state_dict.
+    """
+    if isinstance(state_dict, str):
+        state_dict = load_weights(state_dict)
+
+    expected = set(model.state_dict().keys())
+    missing = sorted(expected - set(state_dict))
+    unexpected = sorted(set(state_dict) - expected)
+    if strict and (missing or unexpected):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {model.__class__.__name__}: "
+            f"missing keys {missing[:10]}, unexpected keys {unexpected[:10]}"
+        )
+
+    for name, tensor in state_dict.items():
+        if name in expected:
+            set_module_tensor_to_device(model, name, device, value=tensor, dtype=dtype)
+    return missing, unexpected
+
+
+def _jsonable(value):
+    if isinstance(value, (DictConfig, ListConfig)):
+        return OmegaConf.to_container(value, resolve=True)
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def _module_spec(model, init_kwargs=None):
+    # how to rebuild model without its weights: diffusers from_config, transformers config class, or cls(**kwargs)
+    if init_kwargs is not None:
+        return "init", init_kwargs
+    if hasattr(model.config, "to_dict"):
+        return "pretrained_config", model.config.to_dict()
+    return "from_config", {k: v for k, v in model.config.items() if not k.startswith("_")}
+
+
+def _build_empty(cls, builder, config):
+    with init_empty_weights():
+        if builder == "from_config":
+            return cls.from_config(config)
+        if builder == "pretrained_config":
+            return cls(cls.config_class.from_dict(config))
+        return cls(**config)
+
+
+def _cast_state_dict(model, dtype, prefix=""):
+    state_dict = {}
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu()
+        if tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        state_dict[prefix + name] = tensor.contiguous()
+    return state_dict
+
+
+def _save_atomic(state_dict, path, metadata):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    save_file(state_dict, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+def save_model(model, path, dtype, init_kwargs=None):
+    """
+    Writes model as a converted .safetensors file.
+
+    Models with a diffusers config are rebuilt with from_config, others with cls(**init_kwargs).
+    """
+    builder, config = _module_spec(model, init_kwargs)
+    _save_atomic(
+        _cast_state_dict(model, dtype),
+        path,
+        dict(builder=builder, config=json.dumps(_jsonable(config))),
+    )
+
+
+def load_model(cls, path, device, dtype):
+    """Rebuilds a module written by save_model without initializing it, then maps in its weights."""
+    with safe_open(path, framework="pt", device="cpu") as f:
+        metadata = f.metadata()
+        model = _build_empty(cls, metadata["builder"], json.loads(metadata["config"]))
+        load_into(model, SafetensorsView(f), device, dtype)
+    return model.eval()
+
+
+def converted_path(weights_dir, name):
+    return os.path.join(weights_dir, name + ".safetensors")
+
+
+def has_converted(weights_dir, *names):
+    return weights_dir is not None and all(
+        os.path.exists(converted_path(weights_dir, name)) for name in names
+    )
+
+
+def load_converted_components(weights_dir, device, dtype, denoising_unet="denoising_unet"):
+    """vae, image_encoder, reference_unet, denoising_unet and pose_guider from a convert_weights.py folder."""
+    from diffusers import AutoencoderKL
+    from transformers import CLIPVisionModelWithProjection
+
+    from musepose.models.pose_guider import PoseGuider
+    from musepose.models.unet_2d_condition import UNet2DConditionModel
+    from musepose.models.unet_3d import UNet3DConditionModel
+
+    vae = AutoencoderKL.from_pretrained(
+        os.path.join(weights_dir, "vae"), torch_dtype=dtype, low_cpu_mem_usage=True
+    ).to(device)
+    image_enc = CLIPVisionModelWithProjection.from_pretrained(
+        os.path.join(weights_dir, "image_encoder"), torch_dtype=dtype, low_cpu_mem_usage=True
+    ).to(device)
+    return dict(
+        vae=vae,
+        image_encoder=image_enc,
+        reference_unet=load_model(
+            UNet2DConditionModel, converted_path(weights_dir, "reference_unet"), device, dtype
+        ),
+        denoising_unet=load_model(
+            UNet3DConditionModel, converted_path(weights_dir, denoising_unet), device, dtype
+        ),
+        pose_guider=load_model(
+            PoseGuider, converted_path(weights_dir, "pose_guider"), device, dtype
+        ),
+    )
+
+
+BUNDLE_COMPONENTS = ["vae", "image_encoder", "reference_unet", "denoising_unet", "pose_guider"]
+
+
+def save_bundle(path, components, dtype, scheduler_kwargs, init_kwargs=None):
+    """
+    Writes every pipeline component into one .safetensors file.
+
+    Tensors are stored as "<component>.<name>"; the metadata holds the rebuild spec of every
+    component, the scheduler kwargs and the dtype, so load_bundle needs nothing else.
+    """
+    init_kwargs = init_kwargs or {}
+    state_dict = {}
+    metadata = dict(
+        dtype=str(dtype).replace("torch.", ""),
+        scheduler=json.dumps(_jsonable(scheduler_kwargs)),
+    )
+    for name in BUNDLE_COMPONENTS:
+        model = components[name]
+        builder, config = _module_spec(model, init_kwargs.get(name))
+        metadata[name] = json.dumps(dict(builder=builder, config=_jsonable(config)))
+        state_dict.update(_cast_state_dict(model, dtype, prefix=name + "."))
+    _save_atomic(state_dict, path, metadata)
+
+
+def _prefetch(path):
+    # one sequential pass through the file into the page cache, so the mmap below never seeks
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def load_bundle(path, device, dtype=None):
+    """Components (dict) and scheduler kwargs of a save_bundle file, in the bundle dtype by default."""
+    from diffusers import AutoencoderKL
+    from transformers import CLIPVisionModelWithProjection
+
+    from musepose.models.pose_guider import PoseGuider
+    from musepose.models.unet_2d_condition import UNet2DConditionModel
+    from musepose.models.unet_3d import UNet3DConditionModel
+
+    classes = dict(
+        vae=AutoencoderKL,
+        image_encoder=CLIPVisionModelWithProjection,
+        reference_unet=UNet2DConditionModel,
+        denoising_unet=UNet3DConditionModel,
+        pose_guider=PoseGuider,
+    )
+
+    _prefetch(path)
+    components = {}
+    # tensors are streamed from the mapped file one at a time, the bundle is never held as a whole
+    with safe_open(path, framework="pt", device="cpu") as f:
+        metadata = f.metadata()
+        if dtype is None:
+            dtype = getattr(torch, metadata["dtype"])
+        for name in BUNDLE_COMPONENTS:
+            spec = json.loads(metadata[name])
+            model = _build_empty(classes[name], spec["builder"], spec["config"])
+            load_into(model, SafetensorsView(f, prefix=name + "."), device, dtype)
+            components[name] = model.eval()
+    return components, json.loads(metadata["scheduler"])
@@ -0,0 +1,280 @@
+import os
+import json
+import random
+import argparse
+
+import numpy as np
+import torch
+from decord import VideoReader
+from omegaconf import OmegaConf
+from PIL import Image
+from torch.utils.data import Dataset
+from torchvision import transforms
+from transformers import CLIPImageProcessor
+
+from inference.profiling import write_json
+
+
+'''
+    Offline VAE latents for train_stage_1_multiGPU.py and train_stage_2_multiGPU.py.
+
+    python latent_cache.py --config ./configs/train_stage_2.yaml --output ./latent_cache/768
+
+    encodes every frame of every video of data.meta_paths once, at data.train_width x
+    data.train_height, and stores the parameters of its latent distribution in memory-mapped shards:
+
+    index.json          resolution, crop ratio, VAE and per video: paths, frames, shard, offset
+    shard_00000.npy     (frames, 8, height / 8, width / 8) float16: 4 mean then 4 logvar channels
+
+    With data.latent_cache: <output> in the training config, the training scripts read the shards
+    and sample the latents (mean + std * noise, what latent_dist.sample() does) instead of running
+    the VAE encoder on the target frames and the reference image in every step.
+
+    The frames are cropped the way RandomResizedCrop(scale=(1.0, 1.0), ratio=(0.9, 1.0)) of the
+    stage 2 dataset always ends up cropping them (centred, aspect ratio clamped to the ratio
+    range), so stage 2 trains on the same pixels; the random crops of stage 1
+    (img_scale=(0.9, 1.0)) cannot be cached and are replaced by that crop as well.
+    Several processes can fill one cache: --rank i --world_size n encodes every n-th shard.
+'''
+
+
+CROP_RATIO = (0.9, 1.0)
+
+
+def crop_box(width, height, ratio=CROP_RATIO):
+    """PIL box of the fallback crop of RandomResizedCrop(scale=(1, 1), ratio) on a width x height frame."""
+    in_ratio = width / height
+    if in_ratio < min(ratio):
+        w, h = width, int(round(width / min(ratio)))
+    elif in_ratio > max(ratio):
+        w, h = int(round(height * max(ratio))), height
+    else:
+        w, h = width, height
+    left, top = (width - w) // 2, (height - h) // 2
+    return left, top, left + w, top + h
+
+
+def frame_transform(width, height, normalize=True):
+    steps = [
+        transforms.Resize((height, width), interpolation=transforms.InterpolationMode.BILINEAR),
+        transforms.ToTensor(),
+    ]
+    if normalize:
+        steps.append(transforms.Normalize([0.5], [0.5]))
+    return transforms.Compose(steps)
+
+
+def sample_latents(params):
+    """Latents (..., 4, h, w) drawn from stored (..., 8, h, w) mean / logvar, like latent_dist.sample()."""
+    mean, logvar = params.float().chunk(2, dim=-3)
+    std = torch.exp(0.5 * logvar.clamp(-30.0, 20.0))
+    return mean + std * torch.randn_like(mean)
+
+
+def plan_shards(videos, shard_frames):
+    """Assigns (shard, offset) to every video in order; a video is never split across shards."""
+    shards, size = [], shard_frames
+    for video in videos:
+        if size + video["frames"] > shard_frames and size > 0:
+            shards.append(0)
+            size = 0
+        video["shard"], video["offset"] = len(shards) - 1, size
+        size += video["frames"]
+        shards[-1] = size
+    return shards
+
+
+def shard_path(root, shard):
+    return os.path.join(root, f"shard_{shard:05d}.npy")
+
+
+@torch.no_grad()
+def encode_shard(vae, root, shard, frames, videos, width, height, batch_size, device):
+    # written under a temporary name and renamed when complete, so reruns skip finished shards
+    path = shard_path(root, shard)
+    tmp = path[:-4] + ".tmp.npy"
+    out = np.lib.format.open_memmap(
+        tmp, mode="w+", dtype=np.float16, shape=(frames, 8, height // 8, width // 8)
+    )
+    transform = frame_transform(width, height)
+    for video in videos:
+        reader = VideoReader(video["video_path"])
+        box = None
+        for start in range(0, video["frames"], batch_size):
+            indices = list(range(start, min(video["frames"], start + batch_size)))
+            images = [Image.fromarray(frame) for frame in reader.get_batch(indices).asnumpy()]
+            box = box or crop_box(*images[0].size)
+            pixels = torch.stack([transform(image.crop(box)) for image in images])
+            params = vae.encode(pixels.to(device, vae.dtype)).latent_dist.parameters
+            out[video["offset"] + start : video["offset"] + start + len(indices)] = params.cpu().numpy()
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+
+class LatentCache:
+    """Read side of a latent_cache.py output folder; shards are memory-mapped on first use per process."""
+
+    def __init__(self, root, width=None, height=None):
+        with open(os.path.join(root, "index.json")) as f:
+            index = json.load(f)
+        if (width, height) != (None, None) and (index["width"], index["height"]) != (width, height):
+            raise ValueError(
+                f"{root} holds {index['width']}x{index['height']} latents, the config trains at {width}x{height}"
+            )
+        self.root = root
+        self.width, self.height = index["width"], index["height"]
+        self.ratio = tuple(index["crop_ratio"])
+        self.videos = index["videos"]
+        self._shards = {}
+
+    def params(self, video, frames):
+        """fp16 (len(frames), 8, h, w) distribution parameters of frames of video."""
+        shard = self._shards.get(video["shard"])
+        if shard is None:
+            shard = self._shards[video["shard"]] = np.load(shard_path(self.root, video["shard"]), mmap_mode="r")
+        rows = video["offset"] + np.asarray(frames)
+        return torch.from_numpy(np.ascontiguousarray(shard[rows]))
+
+    def pose_frames(self, video, frames):
+        """Pose frames cropped like the cached video frames, (len(frames), 3, H, W) in [0, 1]."""
+        reader = VideoReader(video["kps_path"])
+        images = [Image.fromarray(frame) for frame in reader.get_batch(list(frames)).asnumpy()]
+        box = crop_box(*images[0].size, ratio=self.ratio)
+        transform = frame_transform(self.width, self.height, normalize=False)
+        return torch.stack([transform(image.crop(box)) for image in images])
+
+    def clip_image(self, processor, video, frame):
+        # the CLIP input is the uncropped reference frame, as in the pixel datasets
+        image = Image.fromarray(VideoReader(video["video_path"])[frame].asnumpy())
+        return processor(images=image, return_tensors="pt").pixel_values[0]
+
+
+class LatentImageDataset(Dataset):
+    """HumanDanceDataset (stage 1) on a latent cache: target / reference latents instead of pixels."""
+
+    def __init__(self, cache_dir, width, height, sample_margin=30):
+        self.cache = LatentCache(cache_dir, width, height)
+        self.sample_margin = sample_margin
+        self.clip_image_processor = CLIPImageProcessor()
+
+    def __len__(self):
+        return len(self.cache.videos)
+
+    def __getitem__(self, index):
+        video = self.cache.videos[index]
+        video_length = video["frames"]
+        margin = min(self.sample_margin, video_length)
+        ref_img_idx = random.randint(0, video_length - 1)
+        if ref_img_idx + margin < video_length:
+            tgt_img_idx = random.randint(ref_img_idx + margin, video_length - 1)
+        elif ref_img_idx - margin > 0:
+            tgt_img_idx = random.randint(0, ref_img_idx - margin)
+        else:
+            tgt_img_idx = random.randint(0, video_length - 1)
+
+        params = self.cache.params(video, [tgt_img_idx, ref_img_idx])
+        return dict(
+            video_dir=video["video_path"],
+            latent_params_img=params[0],
+            tgt_pose=self.cache.pose_frames(video, [tgt_img_idx])[0],
+            latent_params_ref=params[1],
+            clip_images=self.cache.clip_image(self.clip_image_processor, video, ref_img_idx),
+        )
+
+
+class LatentVideoDataset(Dataset):
+    """HumanDanceVideoDataset (stage 2) on a latent cache: clip / reference latents instead of pixels."""
+
+    def __init__(self, cache_dir, width, height, n_sample_frames, sample_rate):
+        self.cache = LatentCache(cache_dir, width, height)
+        self.n_sample_frames = n_sample_frames
+        self.sample_rate = sample_rate
+        self.clip_image_processor = CLIPImageProcessor()
+
+    def __len__(self):
+        return len(self.cache.videos)
+
+    def __getitem__(self, index):
+        video = self.cache.videos[index]
+        video_length = video["frames"]
+        clip_length = min(video_length, (self.n_sample_frames - 1) * self.sample_rate + 1)
+        start_idx = random.randint(0, video_length - clip_length)
+        batch_index = np.linspace(
+            start_idx, start_idx + clip_length - 1, self.n_sample_frames, dtype=int
+        ).tolist()
+        ref_img_idx = random.randint(0, video_length - 1)
+
+        return dict(
+            video_dir=video["video_path"],
+            latent_params_vid=self.cache.params(video, batch_index),  # (f, 8, h, w)
+            pixel_values_pose=self.cache.pose_frames(video, batch_index),  # (f, c, H, W)
+            latent_params_ref=self.cache.params(video, [ref_img_idx])[0],
+            clip_ref_img=self.cache.clip_image(self.clip_image_processor, video, ref_img_idx),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./configs/train_stage_2.yaml", help="training config: data.meta_paths, resolution, VAE")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--shard_frames", type=int, default=8192, help="frames per shard file")
+    parser.add_argument("--batch_size", type=int, default=16, help="frames per VAE encoder call")
+    parser.add_argument("--rank", type=int, default=0, help="this process encodes the shards with index %% world_size == rank")
+    parser.add_argument("--world_size", type=int, default=1)
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+
+    from diffusers import AutoencoderKL
+
+    cfg = OmegaConf.load(args.config)
+    width, height = cfg.data.train_width, cfg.data.train_height
+
+    videos = []
+    for meta_path in cfg.data.meta_paths:
+        with open(meta_path) as f:
+            for meta in json.load(f):
+                videos.append(dict(
+                    video_path=meta["video_path"],
+                    kps_path=meta["kps_path"],
+                    frames=len(VideoReader(meta["video_path"])),
+                ))
+    shards = plan_shards(videos, args.shard_frames)
+    print(f"{len(videos)} videos, {sum(shards)} frames in {len(shards)} shards")
+
+    os.makedirs(args.output, exist_ok=True)
+    index = dict(
+        width=width,
+        height=height,
+        crop_ratio=list(CROP_RATIO),
+        vae=cfg.vae_model_path,
+        shard_frames=args.shard_frames,
+        videos=videos,
+    )
+    index_path = os.path.join(args.output, "index.json")
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            previous = json.load(f)
+        if previous != index:
+            raise ValueError(f"{index_path} describes different videos or settings, use another --output")
+
+    vae = AutoencoderKL.from_pretrained(cfg.vae_model_path).to(
+        args.device, dtype=torch.float16 if args.device.startswith("cuda") else torch.float32
+    )
+    for shard, frames in enumerate(shards):
+        if shard % args.world_size != args.rank or os.path.exists(shard_path(args.output, shard)):
+            continue
+        encode_shard(
+            vae, args.output, shard, frames, [v for v in videos if v["shard"] == shard],
+            width, height, args.batch_size, args.device,
+        )
+        print(f"shard {shard + 1}/{len(shards)} done")
+
+    write_json(index_path, index)
+    missing = [s for s in range(len(shards)) if not os.path.exists(shard_path(args.output, s))]
+    if missing:
+        print(f"{len(missing)} shards still to encode by the other ranks")
+
+
+if __name__ == "__main__":
+    main()
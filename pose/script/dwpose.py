@@ -11,9 +11,12 @@ import cv2
 import torch
 import numpy as np
 from PIL import Image
+from tqdm import tqdm
 
 
 import pose.script.util as util
+from pose.script.keypoint_cache import KeypointCache, detector_fingerprint
+from pose.script.tool import read_frames
 
 def resize_image(input_image, resolution):
     H, W, C = input_image.shape
@@ -68,14 +71,48 @@ def draw_pose(pose, H, W, draw_face):
     return canvas
 
 class DWposeDetector:
-    def __init__(self, det_config=None, det_ckpt=None, pose_config=None, pose_ckpt=None, device="cpu", keypoints_only=False):
-        from pose.script.wholebody import Wholebody
-
-        self.pose_estimation = Wholebody(det_config, det_ckpt, pose_config, pose_ckpt, device)
+    def __init__(self, det_config=None, det_ckpt=None, pose_config=None, pose_ckpt=None, device="cpu", keypoints_only=False,
+                 cache_dir=None, cache_max_bytes=10 * 1024**3, single_resize=False, max_persons=None):
+        self.det_config = det_config
+        self.det_ckpt = det_ckpt
+        self.pose_config = pose_config
+        self.pose_ckpt = pose_ckpt
+        self.device = device
         self.keypoints_only = keypoints_only
+        # detect on the source frame: yolox / dwpose resize it once to their own inputs
+        self.single_resize = single_resize
+        # only the top max_persons boxes go through the pose model, draw_pose uses the first one
+        self.max_persons = max_persons
+
+        # the models are only built on the first real detection, so fully cached runs never load them
+        self._pose_estimation = None
+        self._fingerprints = {}
+        self.cache = KeypointCache(cache_dir, cache_max_bytes) if cache_dir else None
+
+    @property
+    def pose_estimation(self):
+        if self._pose_estimation is None:
+            from pose.script.wholebody import Wholebody
+
+            self._pose_estimation = Wholebody(self.det_config, self.det_ckpt, self.pose_config, self.pose_ckpt, self.device,
+                                              max_persons=self.max_persons)
+        return self._pose_estimation
+
     def to(self, device):
-        self.pose_estimation.to(device)
+        self.device = device
+        if self._pose_estimation is not None:
+            self._pose_estimation.to(device)
         return self
+
+    def fingerprint(self, detect_resolution):
+        if detect_resolution not in self._fingerprints:
+            self._fingerprints[detect_resolution] = detector_fingerprint(
+                self.det_config, self.det_ckpt, self.pose_config, self.pose_ckpt,
+                detect_resolution=detect_resolution,
+                single_resize=self.single_resize,
+                max_persons=self.max_persons,
+            )
+        return self._fingerprints[detect_resolution]
     '''
         detect_resolution: 短边resize到多少 这是 draw pose 时的原始渲染分辨率。建议1024
         image_resolution: 短边resize到多少 这是 save pose 时的文件分辨率。建议768
@@ -91,10 +128,35 @@ class DWposeDetector:
         # cv2.imshow('', input_image)
         # cv2.waitKey(0)
 
+        input_image, (H, W) = self.prepare_image(input_image, detect_resolution)
+        
+        pose = self.detect_pose(input_image)
+            
+        if self.keypoints_only==True:
+            return pose     
+        else:   
+            detected_map = render_pose(pose, H, W, image_resolution, output_type)
+            return detected_map, pose
+
+    def prepare_image(self, input_image, detect_resolution):
+        '''
+            BGR image fed to the detector, and the (H, W) of the detect resolution used for drawing.
+            single_resize skips the intermediate LANCZOS image: mmdet resizes the source straight to 640,
+            mmpose warps the person crops straight from the source, and keypoints are normalized by the
+            source size, which is the only scale factor needed.
+        '''
         input_image = HWC3(input_image)
+        if self.single_resize:
+            H, W = util.size_calculate(input_image.shape[0], input_image.shape[1], detect_resolution)
+            return input_image, (H, W)
         input_image = resize_image(input_image, detect_resolution)
-        H, W, C = input_image.shape 
-        
+        H, W, C = input_image.shape
+        return input_image, (H, W)
+
+    def detect_pose(self, input_image):
+        # keypoints are normalized by the size of the image actually given to the detector
+        H, W, C = input_image.shape
+
         with torch.no_grad():
             candidate, subset = self.pose_estimation(input_image)
             nums, keys, locs = candidate.shape
@@ -123,21 +185,50 @@ class DWposeDetector:
             
             bodies = dict(candidate=body, subset=score)
             pose = dict(bodies=bodies, hands=hands, faces=faces)
-            
-            if self.keypoints_only==True:
-                return pose     
-            else:   
-                detected_map = draw_pose(pose, H, W, draw_face=False)
-                detected_map = HWC3(detected_map)
-                img = resize_image(input_image, image_resolution)
-                H, W, C = img.shape
-                detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
-                # cv2.imshow('detected_map',detected_map)
-                # cv2.waitKey(0)
-
-                if output_type == "pil":
-                    detected_map = cv2.cvtColor(detected_map, cv2.COLOR_BGR2RGB)
-                    detected_map = Image.fromarray(detected_map)
-                    
-                return detected_map, pose
+            return pose
 
+    def detect_image(self, input_image, detect_resolution=1024):
+        # keypoints only, whatever keypoints_only is set to
+        input_image = cv2.cvtColor(np.array(input_image, dtype=np.uint8), cv2.COLOR_RGB2BGR)
+        input_image, _ = self.prepare_image(input_image, detect_resolution)
+        return self.detect_pose(input_image)
+
+    def detect_video(self, video_path, detect_resolution=1024, max_frames=None, frames=None):
+        '''
+            keypoints of every frame (RGB decoded) of a video, looked up in the keypoint cache first.
+            max_frames: only the leading max_frames frames are needed
+            frames: the frames of video_path already decoded by read_frames, so callers that
+                    also need the pixels decode the video once
+        '''
+        if self.cache is not None:
+            key = self.cache.key(video_path, self.fingerprint(detect_resolution))
+            poses = self.cache.get(key, max_frames)
+            if poses is not None:
+                return poses
+
+        if frames is None:
+            frames = read_frames(video_path, max_frames)
+        else:
+            frames = frames[:max_frames]
+        poses = [self.detect_image(frame, detect_resolution) for frame in tqdm(frames)]
+
+        if self.cache is not None:
+            complete = max_frames is None or len(frames) < max_frames
+            self.cache.put(key, poses, complete=complete)
+        return poses
+
+
+def render_pose(pose, H, W, image_resolution, output_type="pil"):
+    # draw at the detect resolution (H, W), then resize to the short edge image_resolution
+    detected_map = draw_pose(pose, H, W, draw_face=False)
+    detected_map = HWC3(detected_map)
+    H, W = util.size_calculate(H, W, image_resolution)
+    detected_map = cv2.resize(detected_map, (W, H), interpolation=cv2.INTER_LINEAR)
+    # cv2.imshow('detected_map',detected_map)
+    # cv2.waitKey(0)
+
+    if output_type == "pil":
+        detected_map = cv2.cvtColor(detected_map, cv2.COLOR_BGR2RGB)
+        detected_map = Image.fromarray(detected_map)
+        
+    return detected_map
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+'''
+    Content-addressed cache of per-frame DWpose keypoints.
+
+    key = sha256(video bytes) + detector fingerprint (config/ckpt hashes, options)
+    one entry = one .npy file holding {"poses": [pose dict per frame], "complete": bool}
+    least recently used entries are evicted once the cache exceeds max_bytes
+'''
+
+_file_hash_memo = {}
+
+
+def evict_lru(cache_dir, suffix, max_bytes):
+    """
+    Deletes the least recently used (by mtime) files ending in suffix until cache_dir holds at
+    most max_bytes of them. Other processes may evict the same folder concurrently, so files
+    vanishing in between are skipped.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(suffix):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+        total += st.st_size
+
+    # oldest first
+    entries.sort()
+    for _, size, name in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    # memoized on (path, size, mtime) so the same process never hashes a file twice
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo_key in _file_hash_memo:
+        return _file_hash_memo[memo_key]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _file_hash_memo[memo_key] = digest
+    return digest
+
+
+def detector_fingerprint(det_config, det_ckpt, pose_config, pose_ckpt, **options):
+    # local files are hashed by content, urls / None by their string
+    h = hashlib.sha256()
+    for path in (det_config, det_ckpt, pose_config, pose_ckpt):
+        if path is not None and os.path.isfile(path):
+            h.update(file_sha256(path).encode())
+        else:
+            h.update(str(path).encode())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class KeypointCache:
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, video_path, fingerprint):
+        return hashlib.sha256((file_sha256(video_path) + fingerprint).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key, num_frames=None):
+        '''
+            return the cached pose list, or None on a miss.
+            num_frames: number of leading frames needed, None means the whole video
+        '''
+        path = self._path(key)
+        if os.path.exists(path):
+            entry = np.load(path, allow_pickle=True).item()
+            poses = entry["poses"]
+            if entry["complete"] or (num_frames is not None and len(poses) >= num_frames):
+                # touch so the entry becomes most recently used
+                os.utime(path)
+                self.hits += 1
+                return poses if num_frames is None else poses[:num_frames]
+        self.misses += 1
+        return None
+
+    def put(self, key, poses, complete=True):
+        path = self._path(key)
+        tmp_path = path + ".tmp%d" % os.getpid()
+        entry = dict(poses=list(poses), complete=complete)
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.array(entry, dtype=object), allow_pickle=True)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        evict_lru(self.cache_dir, ".npy", self.max_bytes)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / lookups if lookups else 0.0,
+        )
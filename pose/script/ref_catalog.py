@@ -0,0 +1,113 @@
+import os
+import json
+import pickle
+import sqlite3
+
+from PIL import Image
+
+from pose.script.keypoint_cache import file_sha256
+from pose.script.util import body_proportions
+
+
+'''
+    On-disk catalog of reference images for pose alignment.
+
+    Every row keeps the dwpose keypoints of a reference image and its derived body proportions,
+    keyed by (image sha256, detector fingerprint), so alignment jobs never re-detect a known reference.
+'''
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS refs (
+    image_hash  TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    path        TEXT,
+    width       INTEGER,
+    height      INTEGER,
+    pose        BLOB,
+    proportions TEXT,
+    PRIMARY KEY (image_hash, fingerprint)
+)
+"""
+
+
+def analyze_reference(detector, image_path, detect_resolution):
+    '''
+        detect the reference image and derive its proportions, no database access.
+        safe to run in worker processes.
+    '''
+    image = Image.open(image_path).convert("RGB")
+    width, height = image.size
+    pose = detector.detect_image(image, detect_resolution)
+
+    # h不变，w缩放到原比例
+    ratio = width / height
+    body = pose['bodies']['candidate'].copy()
+    hands = pose['hands'].copy()
+    body[:, 0] = body[:, 0] * ratio
+    hands[:, :, 0] = hands[:, :, 0] * ratio
+
+    return dict(
+        image_hash=file_sha256(image_path),
+        path=os.path.abspath(image_path),
+        width=width,
+        height=height,
+        pose=pose,
+        proportions=body_proportions(body, hands),
+    )
+
+
+class ReferenceCatalog:
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        with self.conn:
+            self.conn.execute(SCHEMA)
+
+    def get(self, image_hash, fingerprint):
+        row = self.conn.execute(
+            "SELECT path, width, height, pose, proportions FROM refs WHERE image_hash = ? AND fingerprint = ?",
+            (image_hash, fingerprint),
+        ).fetchone()
+        if row is None:
+            return None
+        path, width, height, pose, proportions = row
+        return dict(
+            image_hash=image_hash,
+            path=path,
+            width=width,
+            height=height,
+            pose=pickle.loads(pose),
+            proportions=json.loads(proportions),
+        )
+
+    def put(self, entry, fingerprint):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry["image_hash"],
+                    fingerprint,
+                    entry["path"],
+                    entry["width"],
+                    entry["height"],
+                    pickle.dumps(entry["pose"]),
+                    json.dumps(entry["proportions"]),
+                ),
+            )
+
+    def lookup(self, detector, image_path, detect_resolution):
+        # catalog hit: no detector call. miss: detect once and remember it
+        fingerprint = detector.fingerprint(detect_resolution)
+        entry = self.get(file_sha256(image_path), fingerprint)
+        if entry is None:
+            entry = analyze_reference(detector, image_path, detect_resolution)
+            self.put(entry, fingerprint)
+        return entry
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM refs").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
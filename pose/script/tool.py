@@ -105,7 +105,7 @@ def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=6, f
     save_videos_from_pil(outputs, path, fps)
 
 
-def read_frames(video_path):
+def read_frames(video_path, max_frames=None):
     container = av.open(video_path)
 
     video_stream = next(s for s in container.streams if s.type == "video")
@@ -118,6 +118,9 @@ def read_frames(video_path):
                 frame.to_rgb().to_ndarray(),
             )
             frames.append(image)
+            if max_frames is not None and len(frames) >= max_frames:
+                container.close()
+                return frames
 
     return frames
 
@@ -151,3 +151,30 @@ def warpAffine_kps(kps, M):
 
 
 
+
+
+
+'''
+    Limb lengths of the most significant person, used to align a pose video to a reference.
+    body / hands are dwpose outputs whose w coordinate is already multiplied by W/H.
+'''
+def body_proportions(body, hands):
+    def dist(a, b):
+        return float(np.linalg.norm(a - b))
+
+    hand = []
+    for k in range(2):
+        for j in [1, 5, 9, 13, 17]:
+            hand.append(dist(hands[k, 0], hands[k, j]))
+
+    return dict(
+        neck=dist(body[0], body[1]),
+        face=dist(body[16], body[17]),
+        shoulder=dist(body[2], body[5]),
+        arm_upper=[dist(body[2], body[3]), dist(body[5], body[6])],
+        arm_lower=[dist(body[3], body[4]), dist(body[6], body[7])],
+        hand=hand,
+        body_len=dist(body[1], (body[8] + body[11]) / 2),
+        leg_upper=[dist(body[8], body[9]), dist(body[11], body[12])],
+        leg_lower=[dist(body[9], body[10]), dist(body[12], body[13])],
+    )
@@ -33,8 +33,11 @@ class Wholebody:
     def __init__(self, 
                  det_config=None, det_ckpt=None, 
                  pose_config=None, pose_ckpt=None,
-                 device="cpu"):
+                 device="cpu", max_persons=None):
         
+        # run the pose model only on the max_persons most significant boxes (score x area), None for all
+        self.max_persons = max_persons
+
         if det_config is None:
             det_config = os.path.join(os.path.dirname(__file__), "yolox_config/yolox_l_8xb8-300e_coco.py")
         
@@ -72,7 +75,14 @@ class Wholebody:
                                     pred_instance.scores > 0.5)]
     
         # set NMS threshold
-        bboxes = bboxes[nms(bboxes, 0.7), :4]
+        bboxes = bboxes[nms(bboxes, 0.7)]
+
+        # most significant persons first, downstream only uses the first one
+        if self.max_persons is not None:
+            area = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+            order = np.argsort(-(bboxes[:, 4] * area), kind="stable")
+            bboxes = bboxes[order[:self.max_persons]]
+        bboxes = bboxes[:, :4]
 
         # predict keypoints
         if len(bboxes) == 0:
@@ -9,8 +9,10 @@ import cv2
 import os
 import moviepy.video.io.ImageSequenceClip
 
-from pose.script.dwpose import DWposeDetector, draw_pose
-from pose.script.util import size_calculate, warpAffine_kps
+from pose.script.dwpose import DWposeDetector, draw_pose, render_pose
+from pose.script.util import size_calculate, warpAffine_kps, body_proportions
+from pose.script.ref_catalog import ReferenceCatalog, analyze_reference
+from pose.script.tool import get_fps, read_frames
 
 
 
@@ -248,18 +250,60 @@ def align_img(img, pose_ori, scales, detect_resolution, image_resolution):
 
 
 
+'''
+    Scale parameters of every body part: align / pose = ref / 1st.
+    prop_ref, prop_1st: body_proportions() of the reference and of the 1st video frame
+'''
+def align_scales(prop_ref, prop_1st):
+    ref = {k: np.asarray(v, dtype=np.float64) for k, v in prop_ref.items()}
+    fst = {k: np.asarray(v, dtype=np.float64) for k, v in prop_1st.items()}
+
+    align_args = dict()
+    align_args["scale_neck"] = ref["neck"] / fst["neck"]
+    align_args["scale_face"] = ref["face"] / fst["face"]
+    align_args["scale_shoulder"] = ref["shoulder"] / fst["shoulder"]
+
+    s = ref["arm_upper"] / fst["arm_upper"]
+    align_args["scale_arm_upper"] = (s[0]+s[1])/2
+    s = ref["arm_lower"] / fst["arm_lower"]
+    align_args["scale_arm_lower"] = (s[0]+s[1])/2
+
+    # hand
+    ratio = 0   
+    count = 0
+    for i in range(10): 
+        if fst["hand"][i] != 0:
+            ratio = ratio + ref["hand"][i]/fst["hand"][i]
+            count = count + 1
+    if count!=0:
+        align_args["scale_hand"] = (ratio/count+align_args["scale_arm_upper"]+align_args["scale_arm_lower"])/3
+    else:
+        align_args["scale_hand"] = (align_args["scale_arm_upper"]+align_args["scale_arm_lower"])/2
+
+    # body 
+    align_args["scale_body_len"] = ref["body_len"] / fst["body_len"]
+
+    s = ref["leg_upper"] / fst["leg_upper"]
+    align_args["scale_leg_upper"] = (s[0]+s[1])/2
+    s = ref["leg_lower"] / fst["leg_lower"]
+    align_args["scale_leg_lower"] = (s[0]+s[1])/2
+
+    return align_args
+
+
+
 def run_align_video_with_filterPose_translate_smooth(args):
 
     vidfn=args.vidfn
     imgfn_refer=args.imgfn_refer
     outfn=args.outfn
     
-    video = cv2.VideoCapture(vidfn)
-    width= video.get(cv2.CAP_PROP_FRAME_WIDTH)
-    height= video.get(cv2.CAP_PROP_FRAME_HEIGHT)
- 
-    total_frame= video.get(cv2.CAP_PROP_FRAME_COUNT)
-    fps= video.get(cv2.CAP_PROP_FPS)
+    # one PyAV decode supplies the frames, their size, count and fps and the keypoints below,
+    # so the pose list and the frames cannot drift apart
+    video_frames = read_frames(vidfn, args.max_frame)
+    width, height = video_frames[0].size
+    total_frame = len(video_frames)
+    fps = float(get_fps(vidfn))
 
     print("height:", height)
     print("width:", width)
@@ -275,22 +319,42 @@ def run_align_video_with_filterPose_translate_smooth(args):
         det_ckpt = args.yolox_ckpt,
         pose_config = args.dwpose_config, 
         pose_ckpt = args.dwpose_ckpt, 
-        keypoints_only=False
+        single_resize=args.single_resize,
+        max_persons=args.max_persons or None,
+        keypoints_only=False,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=int(args.cache_size_gb * 1024**3),
         )    
     detector = detector.to(device)
 
+    # reference keypoints and proportions come from the catalog, the detector only runs on unknown references
     refer_img = cv2.imread(imgfn_refer)
-    output_refer, pose_refer = detector(refer_img,detect_resolution=args.detect_resolution, image_resolution=args.image_resolution, output_type='cv2',return_pose_dict=True)
-    body_ref_img  = pose_refer['bodies']['candidate']
-    hands_ref_img = pose_refer['hands']
-    faces_ref_img = pose_refer['faces']
+    if args.ref_catalog:
+        catalog = ReferenceCatalog(args.ref_catalog)
+        ref_entry = catalog.lookup(detector, imgfn_refer, args.detect_resolution)
+        catalog.close()
+    else:
+        ref_entry = analyze_reference(detector, imgfn_refer, args.detect_resolution)
+    pose_refer = ref_entry['pose']
+    ref_H, ref_W = ref_entry['height'], ref_entry['width']
+    H_ref_det, W_ref_det = size_calculate(ref_H, ref_W, args.detect_resolution)
+    output_refer = render_pose(pose_refer, H_ref_det, W_ref_det, args.image_resolution, output_type='cv2')
     output_refer = cv2.cvtColor(output_refer, cv2.COLOR_RGB2BGR)
+
+    # h不变，w缩放到原比例
+    ref_ratio = ref_W / ref_H
+    body_ref_img = pose_refer['bodies']['candidate'].copy()
+    body_ref_img[:, 0] = body_ref_img[:, 0] * ref_ratio
     
 
     skip_frames = args.align_frame
     max_frame = args.max_frame
     pose_list, video_frame_buffer, video_pose_buffer = [], [], []
 
+    # keypoints of the video frames, shared with the other pose tools through the keypoint cache
+    video_poses = detector.detect_video(vidfn, args.detect_resolution, max_frames=max_frame, frames=video_frames)
+    H_det, W_det = size_calculate(H_in, W_in, args.detect_resolution)
+
 
     cap = cv2.VideoCapture('2.mp4')     # 读取视频
     while cap.isOpened():               # 当视频被打开时：
@@ -306,20 +370,18 @@ def run_align_video_with_filterPose_translate_smooth(args):
     cv2.destroyAllWindows()             # 关闭所有窗口
 
 
-    for i in range(max_frame):
-        ret, img = video.read()
-        if img is None: 
-            break 
-        else: 
-            if i < skip_frames:
-                continue           
-            video_frame_buffer.append(img)
+    for i in range(min(total_frame, len(video_poses))):
+        if i < skip_frames:
+            continue
+        # BGR, as the frames were read before
+        img = cv2.cvtColor(np.asarray(video_frames[i]), cv2.COLOR_RGB2BGR)
+        video_frame_buffer.append(img)
 
 
        
         # estimate scale parameters by the 1st frame in the video
         if i==skip_frames:
-            output_1st_img, pose_1st_img = detector(img, args.detect_resolution, args.image_resolution, output_type='cv2', return_pose_dict=True)
+            pose_1st_img = copy.deepcopy(video_poses[i])
             body_1st_img  = pose_1st_img['bodies']['candidate']
             hands_1st_img = pose_1st_img['hands']
             faces_1st_img = pose_1st_img['faces']
@@ -334,105 +396,13 @@ def run_align_video_with_filterPose_translate_smooth(args):
             '''
             
             # h不变，w缩放到原比例
-            ref_H, ref_W = refer_img.shape[0], refer_img.shape[1]
-            ref_ratio = ref_W / ref_H
-            body_ref_img[:, 0]  = body_ref_img[:, 0] * ref_ratio
-            hands_ref_img[:, :, 0] = hands_ref_img[:, :, 0] * ref_ratio
-            faces_ref_img[:, :, 0] = faces_ref_img[:, :, 0] * ref_ratio
-
             video_ratio = width / height
             body_1st_img[:, 0]  = body_1st_img[:, 0] * video_ratio
             hands_1st_img[:, :, 0] = hands_1st_img[:, :, 0] * video_ratio
             faces_1st_img[:, :, 0] = faces_1st_img[:, :, 0] * video_ratio
 
             # scale
-            align_args = dict()
-            
-            dist_1st_img = np.linalg.norm(body_1st_img[0]-body_1st_img[1])   # 0.078   
-            dist_ref_img = np.linalg.norm(body_ref_img[0]-body_ref_img[1])   # 0.106
-            align_args["scale_neck"] = dist_ref_img / dist_1st_img  # align / pose = ref / 1st
-
-            dist_1st_img = np.linalg.norm(body_1st_img[16]-body_1st_img[17])
-            dist_ref_img = np.linalg.norm(body_ref_img[16]-body_ref_img[17])
-            align_args["scale_face"] = dist_ref_img / dist_1st_img
-
-            dist_1st_img = np.linalg.norm(body_1st_img[2]-body_1st_img[5])  # 0.112
-            dist_ref_img = np.linalg.norm(body_ref_img[2]-body_ref_img[5])  # 0.174
-            align_args["scale_shoulder"] = dist_ref_img / dist_1st_img  
-
-            dist_1st_img = np.linalg.norm(body_1st_img[2]-body_1st_img[3])  # 0.895
-            dist_ref_img = np.linalg.norm(body_ref_img[2]-body_ref_img[3])  # 0.134
-            s1 = dist_ref_img / dist_1st_img
-            dist_1st_img = np.linalg.norm(body_1st_img[5]-body_1st_img[6])
-            dist_ref_img = np.linalg.norm(body_ref_img[5]-body_ref_img[6])
-            s2 = dist_ref_img / dist_1st_img
-            align_args["scale_arm_upper"] = (s1+s2)/2 # 1.548
-
-            dist_1st_img = np.linalg.norm(body_1st_img[3]-body_1st_img[4])
-            dist_ref_img = np.linalg.norm(body_ref_img[3]-body_ref_img[4])
-            s1 = dist_ref_img / dist_1st_img
-            dist_1st_img = np.linalg.norm(body_1st_img[6]-body_1st_img[7])
-            dist_ref_img = np.linalg.norm(body_ref_img[6]-body_ref_img[7])
-            s2 = dist_ref_img / dist_1st_img
-            align_args["scale_arm_lower"] = (s1+s2)/2
-
-            # hand
-            dist_1st_img = np.zeros(10)
-            dist_ref_img = np.zeros(10)      
-             
-            dist_1st_img[0] = np.linalg.norm(hands_1st_img[0,0]-hands_1st_img[0,1])
-            dist_1st_img[1] = np.linalg.norm(hands_1st_img[0,0]-hands_1st_img[0,5])
-            dist_1st_img[2] = np.linalg.norm(hands_1st_img[0,0]-hands_1st_img[0,9])
-            dist_1st_img[3] = np.linalg.norm(hands_1st_img[0,0]-hands_1st_img[0,13])
-            dist_1st_img[4] = np.linalg.norm(hands_1st_img[0,0]-hands_1st_img[0,17])
-            dist_1st_img[5] = np.linalg.norm(hands_1st_img[1,0]-hands_1st_img[1,1])
-            dist_1st_img[6] = np.linalg.norm(hands_1st_img[1,0]-hands_1st_img[1,5])
-            dist_1st_img[7] = np.linalg.norm(hands_1st_img[1,0]-hands_1st_img[1,9])
-            dist_1st_img[8] = np.linalg.norm(hands_1st_img[1,0]-hands_1st_img[1,13])
-            dist_1st_img[9] = np.linalg.norm(hands_1st_img[1,0]-hands_1st_img[1,17])
-
-            dist_ref_img[0] = np.linalg.norm(hands_ref_img[0,0]-hands_ref_img[0,1])
-            dist_ref_img[1] = np.linalg.norm(hands_ref_img[0,0]-hands_ref_img[0,5])
-            dist_ref_img[2] = np.linalg.norm(hands_ref_img[0,0]-hands_ref_img[0,9])
-            dist_ref_img[3] = np.linalg.norm(hands_ref_img[0,0]-hands_ref_img[0,13])
-            dist_ref_img[4] = np.linalg.norm(hands_ref_img[0,0]-hands_ref_img[0,17])
-            dist_ref_img[5] = np.linalg.norm(hands_ref_img[1,0]-hands_ref_img[1,1])
-            dist_ref_img[6] = np.linalg.norm(hands_ref_img[1,0]-hands_ref_img[1,5])
-            dist_ref_img[7] = np.linalg.norm(hands_ref_img[1,0]-hands_ref_img[1,9])
-            dist_ref_img[8] = np.linalg.norm(hands_ref_img[1,0]-hands_ref_img[1,13])
-            dist_ref_img[9] = np.linalg.norm(hands_ref_img[1,0]-hands_ref_img[1,17])
-
-            ratio = 0   
-            count = 0
-            for i in range (10): 
-                if dist_1st_img[i] != 0:
-                    ratio = ratio + dist_ref_img[i]/dist_1st_img[i]
-                    count = count + 1
-            if count!=0:
-                align_args["scale_hand"] = (ratio/count+align_args["scale_arm_upper"]+align_args["scale_arm_lower"])/3
-            else:
-                align_args["scale_hand"] = (align_args["scale_arm_upper"]+align_args["scale_arm_lower"])/2
-
-            # body 
-            dist_1st_img = np.linalg.norm(body_1st_img[1] - (body_1st_img[8] + body_1st_img[11])/2 )
-            dist_ref_img = np.linalg.norm(body_ref_img[1] - (body_ref_img[8] + body_ref_img[11])/2 )
-            align_args["scale_body_len"]=dist_ref_img / dist_1st_img
-
-            dist_1st_img = np.linalg.norm(body_1st_img[8]-body_1st_img[9])
-            dist_ref_img = np.linalg.norm(body_ref_img[8]-body_ref_img[9])
-            s1 = dist_ref_img / dist_1st_img
-            dist_1st_img = np.linalg.norm(body_1st_img[11]-body_1st_img[12])
-            dist_ref_img = np.linalg.norm(body_ref_img[11]-body_ref_img[12])
-            s2 = dist_ref_img / dist_1st_img
-            align_args["scale_leg_upper"] = (s1+s2)/2
-
-            dist_1st_img = np.linalg.norm(body_1st_img[9]-body_1st_img[10])
-            dist_ref_img = np.linalg.norm(body_ref_img[9]-body_ref_img[10])
-            s1 = dist_ref_img / dist_1st_img
-            dist_1st_img = np.linalg.norm(body_1st_img[12]-body_1st_img[13])
-            dist_ref_img = np.linalg.norm(body_ref_img[12]-body_ref_img[13])
-            s2 = dist_ref_img / dist_1st_img
-            align_args["scale_leg_lower"] = (s1+s2)/2
+            align_args = align_scales(ref_entry['proportions'], body_proportions(body_1st_img, hands_1st_img))
 
             ####################
             ####################
@@ -446,7 +416,8 @@ def run_align_video_with_filterPose_translate_smooth(args):
         
     
         # pose align
-        pose_img, pose_ori = detector(img, args.detect_resolution, args.image_resolution, output_type='cv2', return_pose_dict=True)
+        pose_ori = copy.deepcopy(video_poses[i])
+        pose_img = render_pose(pose_ori, H_det, W_det, args.image_resolution, output_type='cv2')
         video_pose_buffer.append(pose_img)
         pose_align = align_img(img, pose_ori, align_args, args.detect_resolution, args.image_resolution)
         
@@ -515,6 +486,8 @@ def run_align_video_with_filterPose_translate_smooth(args):
     clip.write_videofile(outfn, fps=fps)
     clip = moviepy.video.io.ImageSequenceClip.ImageSequenceClip(result_pose_only, fps=fps)
     clip.write_videofile(args.outfn_align_pose_video, fps=fps)
+    if detector.cache is not None:
+        print("keypoint cache:", detector.cache.stats())
     print('pose align done')
 
 
@@ -529,6 +502,11 @@ def main():
     parser.add_argument("--dwpose_config", type=str, default="./pose/config/dwpose-l_384x288.py")
     parser.add_argument("--yolox_ckpt",  type=str, default="./pretrained_weights/dwpose/yolox_l_8x8_300e_coco.pth")
     parser.add_argument("--dwpose_ckpt", type=str, default="./pretrained_weights/dwpose/dw-ll_ucoco_384.pth")
+    parser.add_argument("--max_persons", type=int, default=1, help='pose-estimate only the top-k persons by score x box area, 0 for all')
+    parser.add_argument("--single_resize", action="store_true", help='detect on the source frames, skipping the detect_resolution LANCZOS resize')
+    parser.add_argument("--cache_dir", type=str, default="./cache/dwpose_keypoints", help='keypoint cache shared by the pose tools, empty to disable')
+    parser.add_argument("--ref_catalog", type=str, default="./cache/ref_catalog.sqlite", help='reference keypoint / proportion catalog, empty to disable')
+    parser.add_argument("--cache_size_gb", type=float, default=10, help='keypoint cache size limit, LRU entries are evicted beyond it')
 
 
     parser.add_argument('--align_frame', type=int, default=0, help='the frame index of the video to align')
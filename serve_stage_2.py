@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import queue
+import uuid
+import argparse
+import threading
+import traceback
+from collections import OrderedDict, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from omegaconf import OmegaConf
+
+from inference.profiling import StageTimer
+from test_stage_2 import build_pipeline, get_device, handle_single, parse_args as parse_job_args
+
+
+'''
+    Resident Pose2Video server: the pipeline is built once, jobs are queued over HTTP.
+
+    POST /jobs        {"ref_image": ..., "pose_video": ..., "W": 768, "H": 768, "steps": 20,
+                       "cfg": 3.5, "seed": 99, "S": 48, "O": 4, "L": 300, "skip": 1, "fps": null}
+    GET  /jobs/<id>   status, output paths and per-stage timings of one job
+    GET  /health      liveness, device, uptime
+    GET  /metrics     queue depth, job counters, per-stage latency
+'''
+
+# job fields a client may set, everything else comes from test_stage_2.py defaults
+JOB_FIELDS = ["W", "H", "L", "S", "O", "cfg", "seed", "steps", "fps", "skip"]
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    # argparse prints and exits on malformed values, a server reports them to the client instead
+    def error(self, message):
+        raise ValueError(message)
+
+
+class PipelineServer:
+    def __init__(self, config, output_dir, history=1000, keep_jobs=1000):
+        self.config = config
+        self.output_dir = output_dir
+        # finished jobs kept for GET /jobs/<id>, the oldest are dropped beyond this
+        self.keep_jobs = keep_jobs
+        self.device = get_device()
+        self.started = time.time()
+
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.latency = defaultdict(lambda: deque(maxlen=history))
+
+        t0 = time.perf_counter()
+        self.pipe = build_pipeline(config, self.device)
+        self.record_latency("load_pipeline", time.perf_counter() - t0)
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def record_latency(self, stage, seconds):
+        with self.lock:
+            self.latency[stage].append(seconds)
+
+    def submit(self, params):
+        if not isinstance(params, dict):
+            raise ValueError("the job must be a JSON object")
+        for key in ["ref_image", "pose_video"]:
+            if key not in params:
+                raise ValueError(f"missing field: {key}")
+            if not os.path.exists(params[key]):
+                raise ValueError(f"{key} not found: {params[key]}")
+
+        argv = ["--config", "unused"]
+        for key in JOB_FIELDS:
+            if params.get(key) is not None:
+                argv += [f"--{key}" if len(key) > 1 else f"-{key}", str(params[key])]
+        args = parse_job_args(argv, parser_class=JobArgumentParser)
+
+        job_id = uuid.uuid4().hex[:12]
+        job = dict(
+            id=job_id,
+            status="queued",
+            ref_image=params["ref_image"],
+            pose_video=params["pose_video"],
+            params={key: getattr(args, key) for key in JOB_FIELDS},
+            outputs=[],
+            timings={},
+            error=None,
+            submitted=time.time(),
+        )
+        with self.lock:
+            self.jobs[job_id] = job
+            self.counters["submitted"] += 1
+        self.queue.put((job_id, args))
+        return job
+
+    def get_job(self, job_id):
+        # a copy, the worker thread keeps updating the job while it is serialized
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job, outputs=list(job["outputs"]), timings=dict(job["timings"]))
+
+    def update_job(self, job_id, counter=None, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+            if counter:
+                self.counters[counter] += 1
+
+    def _forget_finished(self):
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job["status"] in ("done", "failed")]
+            for job_id in finished[: max(0, len(finished) - self.keep_jobs)]:
+                del self.jobs[job_id]
+
+    def run(self):
+        while True:
+            job_id, args = self.queue.get()
+            with self.lock:
+                job = dict(self.jobs[job_id])
+            started = time.time()
+            self.update_job(job_id, status="running", started=started)
+            self.record_latency("queue_wait", started - job["submitted"])
+
+            timer = StageTimer()
+            try:
+                generator = torch.Generator().manual_seed(args.seed)
+                # one folder per job: the file names only carry the inputs, cfg, steps and skip
+                save_dir = os.path.join(self.output_dir, job_id)
+                outputs = handle_single(
+                    self.pipe, self.config, args, job["ref_image"], job["pose_video"], generator, save_dir, timer
+                )
+                self.update_job(job_id, counter="done", status="done", outputs=list(outputs))
+            except Exception:
+                error = traceback.format_exc()
+                self.update_job(job_id, counter="failed", status="failed", error=error)
+                print(error)
+            finally:
+                finished = time.time()
+                timings = timer.as_dict()
+                self.update_job(job_id, finished=finished, timings=timings)
+                for stage, seconds in timings.items():
+                    self.record_latency(stage, seconds)
+                self.record_latency("job_total", finished - started)
+                self._forget_finished()
+                self.queue.task_done()
+
+    def health(self):
+        return dict(status="ok", device=self.device, uptime=time.time() - self.started)
+
+    def metrics(self):
+        with self.lock:
+            latency = {}
+            for stage, values in self.latency.items():
+                values = sorted(values)
+                latency[stage] = dict(
+                    count=len(values),
+                    mean=sum(values) / len(values),
+                    p50=values[len(values) // 2],
+                    p95=values[min(len(values) - 1, int(len(values) * 0.95))],
+                    max=values[-1],
+                )
+            running = sum(1 for job in self.jobs.values() if job["status"] == "running")
+            return dict(
+                queue_depth=self.queue.qsize(),
+                running=running,
+                jobs=dict(self.counters),
+                latency=latency,
+            )
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, code, payload):
+            body = json.dumps(payload, indent=2).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, server.health())
+            elif self.path == "/metrics":
+                self.send_json(200, server.metrics())
+            elif self.path.startswith("/jobs/"):
+                job = server.get_job(self.path[len("/jobs/"):])
+                if job is None:
+                    self.send_json(404, dict(error="unknown job"))
+                else:
+                    self.send_json(200, job)
+            else:
+                self.send_json(404, dict(error="not found"))
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                self.send_json(404, dict(error="not found"))
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                job = server.submit(params)
+            except ValueError as e:
+                self.send_json(400, dict(error=str(e)))
+                return
+            self.send_json(202, dict(id=job["id"], queue_depth=server.queue.qsize()))
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./configs/test_stage_2.yaml")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--output_dir", type=str, default="./output/server", help="outputs of a job go to output_dir/<job id>/")
+    parser.add_argument("--keep_jobs", type=int, default=1000, help="finished jobs kept for GET /jobs/<id>")
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    server = PipelineServer(config, args.output_dir, keep_jobs=args.keep_jobs)
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    print(f"serving on http://{args.host}:{args.port}")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
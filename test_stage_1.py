@@ -2,6 +2,7 @@ import os,sys
 import argparse
 import os
 import sys
+import time
 from datetime import datetime
 from pathlib import Path
 from typing import List
@@ -15,14 +16,17 @@ from diffusers.pipelines.stable_diffusion import StableDiffusionPipeline
 from einops import repeat
 from omegaconf import OmegaConf
 from PIL import Image
-from torchvision import transforms
 from transformers import CLIPVisionModelWithProjection
 
 
 from musepose.models.pose_guider import PoseGuider
 from musepose.models.unet_2d_condition import UNet2DConditionModel
 from musepose.models.unet_3d import UNet3DConditionModel
-from musepose.pipelines.pipeline_pose2img import Pose2ImagePipeline
+from inference.pipeline_pose2img import FastPose2ImagePipeline
+from inference.feature_cache import TensorCache, weights_version
+from inference.memory import peak_rss
+from inference.profiling import add_profile_args, make_profiler
+from inference.weights import has_converted, load_converted_components, load_weights
 from musepose.utils.util import get_fps, read_frames, save_videos_grid
 
 
@@ -36,6 +40,10 @@ def parse_args():
     parser.add_argument("--cfg", type=float, default=7)
     parser.add_argument("--steps", type=int, default=20)
     parser.add_argument("--fps", type=int)
+    parser.add_argument("--ref_cache_size", type=int, default=4, help="reference images whose CLIP/VAE/reference-UNet features are kept in memory, 0 disables")
+    parser.add_argument("--ref_cache_dir", type=str, default=None, help="also persist reference features to this folder")
+    parser.add_argument("--batch_size", type=int, default=1, help="samples (seeds x pose images) of a reference per pipeline call, 0 = all of them")
+    add_profile_args(parser, unit="pipeline calls")
     args = parser.parse_args()
 
     return args
@@ -52,55 +60,70 @@ def main():
     else:
         weight_dtype = torch.float32
 
-    vae = AutoencoderKL.from_pretrained(
-        config.pretrained_vae_path,
-    ).to("cuda", dtype=weight_dtype)
-
-    reference_unet = UNet2DConditionModel.from_pretrained(
-        config.pretrained_base_model_path,
-        subfolder="unet",
-    ).to(dtype=weight_dtype, device="cuda")
-
+    t0 = time.perf_counter()
     inference_config_path = config.inference_config
     infer_config = OmegaConf.load(inference_config_path)
-    denoising_unet = UNet3DConditionModel.from_pretrained_2d(
-        config.pretrained_base_model_path,
-        # config.motion_module_path,
-        "",
-        subfolder="unet",
-        unet_additional_kwargs={
-            "use_motion_module": False,
-            "unet_use_temporal_attention": False,
-        },
-    ).to(dtype=weight_dtype, device="cuda")
-
-    pose_guider = PoseGuider(320, block_out_channels=(16, 32, 96, 256)).to(
-        dtype=weight_dtype, device="cuda"
-    )
-
-    image_enc = CLIPVisionModelWithProjection.from_pretrained(
-        config.image_encoder_path
-    ).to(dtype=weight_dtype, device="cuda")
-
     sched_kwargs = OmegaConf.to_container(infer_config.noise_scheduler_kwargs)
     scheduler = DDIMScheduler(**sched_kwargs)
 
-
     width, height = args.W, args.H
 
-    # load pretrained weights
-    denoising_unet.load_state_dict(
-        torch.load(config.denoising_unet_path, map_location="cpu"),
-        strict=False,
-    )
-    reference_unet.load_state_dict(
-        torch.load(config.reference_unet_path, map_location="cpu"),
-    )
-    pose_guider.load_state_dict(
-        torch.load(config.pose_guider_path, map_location="cpu"),
-    )
+    weights_dir = config.get("converted_weights_dir")
+    if has_converted(weights_dir, "reference_unet", "denoising_unet_2d", "pose_guider"):
+        # written by convert_weights.py: memory-mapped, already typed, no base weights to overwrite
+        components = load_converted_components(
+            weights_dir, "cuda", weight_dtype, denoising_unet="denoising_unet_2d"
+        )
+        vae = components["vae"]
+        image_enc = components["image_encoder"]
+        reference_unet = components["reference_unet"]
+        denoising_unet = components["denoising_unet"]
+        pose_guider = components["pose_guider"]
+    else:
+        if weights_dir:
+            print(f"no converted weights in {weights_dir}, run convert_weights.py for a faster start")
+
+        vae = AutoencoderKL.from_pretrained(
+            config.pretrained_vae_path,
+        ).to("cuda", dtype=weight_dtype)
+
+        reference_unet = UNet2DConditionModel.from_pretrained(
+            config.pretrained_base_model_path,
+            subfolder="unet",
+        ).to(dtype=weight_dtype, device="cuda")
+
+        denoising_unet = UNet3DConditionModel.from_pretrained_2d(
+            config.pretrained_base_model_path,
+            # config.motion_module_path,
+            "",
+            subfolder="unet",
+            unet_additional_kwargs={
+                "use_motion_module": False,
+                "unet_use_temporal_attention": False,
+            },
+        ).to(dtype=weight_dtype, device="cuda")
+
+        pose_guider = PoseGuider(320, block_out_channels=(16, 32, 96, 256)).to(
+            dtype=weight_dtype, device="cuda"
+        )
 
-    pipe = Pose2ImagePipeline(
+        image_enc = CLIPVisionModelWithProjection.from_pretrained(
+            config.image_encoder_path
+        ).to(dtype=weight_dtype, device="cuda")
+
+        # load pretrained weights
+        denoising_unet.load_state_dict(
+            load_weights(config.denoising_unet_path),
+            strict=False,
+        )
+        reference_unet.load_state_dict(
+            load_weights(config.reference_unet_path),
+        )
+        pose_guider.load_state_dict(
+            load_weights(config.pose_guider_path),
+        )
+
+    pipe = FastPose2ImagePipeline(
         vae=vae,
         image_encoder=image_enc,
         reference_unet=reference_unet,
@@ -110,6 +133,20 @@ def main():
     )
 
     pipe = pipe.to("cuda", dtype=weight_dtype)
+    print(f"pipeline loaded in {time.perf_counter() - t0:.1f}s, peak RSS {peak_rss() / 1024**3:.2f} GB")
+
+    if args.ref_cache_size > 0 or args.ref_cache_dir:
+        # every seed / pose of the same reference image reuses its CLIP, VAE and reference UNet features
+        pipe.enable_reference_cache(
+            TensorCache(max_items=args.ref_cache_size, cache_dir=args.ref_cache_dir),
+            weights_version(
+                config.pretrained_base_model_path,
+                config.pretrained_vae_path,
+                config.image_encoder_path,
+                config.reference_unet_path,
+                dtype=config.weight_dtype,
+            ),
+        )
 
     date_str = datetime.now().strftime("%Y%m%d")
     time_str = datetime.now().strftime("%H%M")
@@ -120,71 +157,81 @@ def main():
     save_dir = Path(f"./output/image-{date_str}/{save_dir_name}")
     save_dir.mkdir(exist_ok=True, parents=True)
 
-    def handle_single(ref_image_path, pose_path,seed):
-        generator = torch.manual_seed(seed)
+    def handle_batch(ref_image_path, samples):
+        """
+        Generates samples [(pose image path, seed), ...] of one reference in one pipeline call,
+        then writes the result and the (reference, pose, result) grid of every sample once.
+        """
         ref_name = Path(ref_image_path).stem
-        # pose_name = Path(pose_image_path).stem.replace("_kps", "")
-        pose_name = Path(pose_path).stem
-
         ref_image_pil = Image.open(ref_image_path).convert("RGB")
-        pose_image = Image.open(pose_path).convert("RGB")
-
-        original_width, original_height = pose_image.size
-
-        pose_transform = transforms.Compose(
-            [transforms.Resize((height, width)), transforms.ToTensor()]
-        )
-
-        pose_image_tensor = pose_transform(pose_image)
-        pose_image_tensor = pose_image_tensor.unsqueeze(0)  # (1, c, h, w)
-
-        ref_image_tensor = pose_transform(ref_image_pil)  # (c, h, w)
-        ref_image_tensor = ref_image_tensor.unsqueeze(1).unsqueeze(0)  # (1, c, 1, h, w)
+        pose_images = {}
+        for pose_path, _ in samples:
+            if pose_path not in pose_images:
+                pose_images[pose_path] = Image.open(pose_path).convert("RGB")
 
-        image = pipe(
+        images = pipe(
             ref_image_pil,
-            pose_image,
+            [pose_images[pose_path] for pose_path, _ in samples],
             width,
             height,
             args.steps,
             args.cfg,
-            generator=generator,
-        ).images
-
-        image = image.squeeze(2).squeeze(0)  # (c, h, w)
-        image = image.transpose(0, 1).transpose(1, 2)  # (h w c)
-        #image = (image + 1.0) / 2.0  # -1,1 -> 0,1
-        
-        image = (image * 255).numpy().astype(np.uint8)
-        image = Image.fromarray(image, 'RGB')
-        # image.save(os.path.join(save_dir, f"{ref_name}_{pose_name}_{args.H}x{args.W}_{int(args.cfg)}_{time_str}.png"))
-
-        image_grid = Image.new('RGB',(original_width*3,original_height))
-        imgs = [ref_image_pil,pose_image,image]
-        x_offset = 0
-        for img in imgs:
-            img = img.resize((original_width*2, original_height*2))
-            img.save(os.path.join(save_dir, f"res_{ref_name}_{pose_name}_{args.cfg}_{seed}.jpg"))
-            img = img.resize((original_width,original_height))
-            image_grid.paste(img, (x_offset,0))
-            x_offset += img.size[0]
-        image_grid.save(os.path.join(save_dir, f"grid_{ref_name}_{pose_name}_{args.cfg}_{seed}.jpg"))
-
-
-    for ref_image_path_dir in config["test_cases"].keys():
-        if os.path.isdir(ref_image_path_dir):
-            ref_image_paths = glob.glob(os.path.join(ref_image_path_dir, '*.jpg'))
-        else:
-            ref_image_paths = [ref_image_path_dir]
-        for ref_image_path in ref_image_paths:
-            for pose_image_path_dir in config["test_cases"][ref_image_path_dir]:            
-                if os.path.isdir(pose_image_path_dir):
-                    pose_image_paths = glob.glob(os.path.join(pose_image_path_dir, '*.jpg'))
-                else:
-                    pose_image_paths = [pose_image_path_dir]
-                for pose_image_path in pose_image_paths:
-                    for i in range(args.cnt):
-                        handle_single(ref_image_path, pose_image_path, args.seed + i) 
+            # per sample, so every image matches a --batch_size 1 run with its seed
+            generator=[torch.Generator().manual_seed(seed) for _, seed in samples],
+        ).images  # (n, c, 1, h, w)
+
+        # reference and pose panels of the grids, resized once per pose image
+        panels = {}
+        for (pose_path, seed), image in zip(samples, images):
+            # pose_name = Path(pose_image_path).stem.replace("_kps", "")
+            pose_name = Path(pose_path).stem
+            pose_image = pose_images[pose_path]
+            original_width, original_height = pose_image.size
+            if pose_path not in panels:
+                panels[pose_path] = [
+                    img.resize((original_width, original_height)) for img in (ref_image_pil, pose_image)
+                ]
+
+            image = image.squeeze(1).permute(1, 2, 0)  # (h w c)
+            image = (image * 255).numpy().astype(np.uint8)
+            image = Image.fromarray(image, 'RGB')
+            image.resize((original_width*2, original_height*2)).save(
+                os.path.join(save_dir, f"res_{ref_name}_{pose_name}_{args.cfg}_{seed}.jpg")
+            )
+
+            image_grid = Image.new('RGB',(original_width*3,original_height))
+            for i, img in enumerate(panels[pose_path] + [image.resize((original_width, original_height))]):
+                image_grid.paste(img, (i * original_width, 0))
+            image_grid.save(os.path.join(save_dir, f"grid_{ref_name}_{pose_name}_{args.cfg}_{seed}.jpg"))
+
+    def iter_cases():
+        # (reference image, every pose image of it)
+        for ref_image_path_dir in config["test_cases"].keys():
+            if os.path.isdir(ref_image_path_dir):
+                ref_image_paths = glob.glob(os.path.join(ref_image_path_dir, '*.jpg'))
+            else:
+                ref_image_paths = [ref_image_path_dir]
+            for ref_image_path in ref_image_paths:
+                pose_image_paths = []
+                for pose_image_path_dir in config["test_cases"][ref_image_path_dir]:            
+                    if os.path.isdir(pose_image_path_dir):
+                        pose_image_paths += glob.glob(os.path.join(pose_image_path_dir, '*.jpg'))
+                    else:
+                        pose_image_paths.append(pose_image_path_dir)
+                yield ref_image_path, pose_image_paths
+
+    with make_profiler(args, "test_stage_1") as profiler:
+        for ref_image_path, pose_image_paths in iter_cases():
+            samples = [
+                (pose_image_path, args.seed + i) for pose_image_path in pose_image_paths for i in range(args.cnt)
+            ]
+            batch_size = args.batch_size or len(samples)
+            for start in range(0, len(samples), batch_size):
+                handle_batch(ref_image_path, samples[start : start + batch_size])
+                profiler.step()
+
+    if pipe.reference_cache is not None:
+        print("reference feature cache:", pipe.reference_cache.stats())
 
 
 if __name__ == "__main__":
@@ -1,5 +1,10 @@
 import os,sys
+import time
+import statistics
 import argparse
+import traceback
+from collections import OrderedDict
+from functools import partial
 from datetime import datetime
 from pathlib import Path
 from typing import List
@@ -8,9 +13,8 @@ import av
 import numpy as np
 import torch
 import torchvision
-from diffusers import AutoencoderKL, DDIMScheduler
+from diffusers import AutoencoderKL
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipeline
-from einops import repeat
 from omegaconf import OmegaConf
 from PIL import Image
 from torchvision import transforms
@@ -21,13 +25,26 @@ import torch.nn.functional as F
 from musepose.models.pose_guider import PoseGuider
 from musepose.models.unet_2d_condition import UNet2DConditionModel
 from musepose.models.unet_3d import UNet3DConditionModel
-from musepose.pipelines.pipeline_pose2vid_long import Pose2VideoPipeline
+from inference.pipeline_pose2vid import FastPose2VideoPipeline
+from inference.feature_cache import TensorCache, make_key, weights_version
+from pose.script.keypoint_cache import file_sha256
 from musepose.utils.util import get_fps, read_frames, save_videos_grid
-
-
-
-def parse_args():
-    parser = argparse.ArgumentParser()
+from inference.profiling import StageTimer, TimingSummary, add_profile_args, make_profiler, report_path, write_json
+from inference.video_writer import BackgroundEncoder, StreamingVideoWriter
+from inference.long_video import LongVideoWorkDir, prepare_pose_long
+from inference.manifest import JobManifest, Progress
+from inference.memory import auto_batch_size, available_memory, estimate_item_bytes, estimate_window_bytes, peak_rss
+from inference.vae_decode import decode_item_bytes
+from inference.samplers import SAMPLERS, make_scheduler
+from inference.attention import BACKENDS, POSITION_MODES, configure_attention
+from inference.parallel_windows import WindowWorkerPool
+from inference.cpu import add_cpu_args, configure_threads, optimize_for_cpu
+from inference.weights import has_converted, load_converted_components, load_weights
+
+
+
+def parse_args(argv=None, parser_class=argparse.ArgumentParser):
+    parser = parser_class()
     parser.add_argument("--config", type=str, default="./configs/test_stage_2.yaml")
     parser.add_argument("-W", type=int, default=768, help="Width")
     parser.add_argument("-H", type=int, default=768, help="Height")
@@ -36,12 +53,54 @@ def parse_args():
     parser.add_argument("-O", type=int, default=4,   help="video slice overlap frame number")
 
     parser.add_argument("--cfg",   type=float, default=3.5, help="Classifier free guidance")
+    parser.add_argument("--cfg_mode", type=str, default="auto", choices=["auto", "batched", "sequential"],
+                        help="uncond and cond branch in one forward, or two; auto = batched if it fits in memory")
+    parser.add_argument("--cfg_interval", type=float, nargs=2, default=[0.0, 1.0], metavar=("START", "END"),
+                        help="apply guidance only over this fraction of the steps, the cond branch alone elsewhere")
     parser.add_argument("--seed",  type=int,   default=99)
-    parser.add_argument("--steps", type=int,   default=20, help="DDIM sampling steps")
+    parser.add_argument("--steps", type=int,   default=20, help="sampling steps")
+    parser.add_argument("--sampler", type=str, default=None, help=f"one of {', '.join(SAMPLERS)}, default: sampler of the config")
     parser.add_argument("--fps",   type=int)
     
     parser.add_argument("--skip",  type=int,   default=1, help="frame sample rate = (skip+1)") 
-    args = parser.parse_args()
+
+    parser.add_argument("--ref_cache_size", type=int, default=4, help="reference images whose CLIP/VAE/reference-UNet features are kept in memory, 0 disables")
+    parser.add_argument("--ref_cache_dir",  type=str, default=None, help="also persist reference features to this folder")
+    parser.add_argument("--pose_cache_size", type=int, default=2, help="pose videos whose PoseGuider features are kept in memory, 0 disables")
+    parser.add_argument("--pose_cache_dir",  type=str, default=None, help="also persist PoseGuider features (fp16) to this folder")
+    parser.add_argument("--pose_cache_gb",   type=float, default=20, help="disk budget of --pose_cache_dir")
+
+    parser.add_argument("--batch_size",     type=int, default=1, help="jobs generated together, 0 picks it from available memory")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="upper bound of the automatic batch size")
+    parser.add_argument("--compare_sequential", action="store_true", help="also run every batch job by job and report the speedup")
+
+    parser.add_argument("--bundle", type=str, default=None, help="load every model from one convert_weights.py --bundle file")
+    parser.add_argument("--stream", action="store_true", help="decode and write frames as soon as they are final (single jobs, not --batch_size)")
+    parser.add_argument("--decode_batch", type=int, default=0, help="frames per VAE decoder call, 0 picks it from available memory")
+    parser.add_argument("--decode_tile", type=int, default=0, help="decode in spatial tiles of this many latent pixels (0 = whole frames)")
+    parser.add_argument("--decode_tile_overlap", type=int, default=8, help="latent pixels shared by neighbouring tiles, blended across the seam")
+    parser.add_argument("--attention", type=str, default="auto", choices=BACKENDS,
+                        help="attention kernels; auto picks xformers / SDPA, chunks or slices only where memory requires it")
+    parser.add_argument("--temporal_window", type=int, default=0,
+                        help="frames each frame attends to in the motion modules (0 = the whole context window), linear cost in -S")
+    parser.add_argument("--temporal_positions", type=str, default="extend", choices=POSITION_MODES,
+                        help="position encoding of context windows longer than the trained 128 frames")
+    parser.add_argument("--deep_cache", type=int, default=0, help="reuse the deep UNet features of each window, full UNet every N steps (0 = off)")
+    parser.add_argument("--deep_cache_depth", type=int, default=1, help="down / up blocks recomputed on reuse steps, more = closer to the full UNet")
+    parser.add_argument("--long_video", action="store_true", help="memory bounded by the window size instead of the video length, implies --stream")
+    parser.add_argument("--long_video_dir", type=str, default=None, help="keep the on-disk pose features of --long_video here (default: a temporary folder)")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="resumable sweep: jobs, outputs and completion records in this folder, reruns skip finished jobs")
+    add_cpu_args(parser)
+    add_profile_args(parser, unit="jobs")
+    parser.add_argument("--window_workers", type=int, default=0, help="extra processes sharing the context windows of every step (e.g. one per NUMA node)")
+    args = parser.parse_args(argv)
+    if args.long_video:
+        if args.batch_size != 1:
+            parser.error("--long_video generates one job at a time, use --batch_size 1")
+        args.stream = True
+    if args.manifest and args.batch_size != 1:
+        parser.error("--manifest records jobs one at a time, use --batch_size 1")
 
     print('Width:', args.W)
     print('Height:', args.H)
@@ -49,7 +108,7 @@ def parse_args():
     print('Slice:', args.S)
     print('Overlap:', args.O)
     print('Classifier free guidance:', args.cfg)
-    print('DDIM sampling steps :', args.steps)
+    print('sampling steps :', args.steps)
     print("skip", args.skip)
 
     return args
@@ -63,19 +122,73 @@ def scale_video(video,width,height):
     return scaled_video
 
 
-def main():
-    args = parse_args()
+def cpu_options(args):
+    return dict(bf16=args.cpu_bf16, channels_last=not args.no_channels_last, compile=args.compile)
 
-    config = OmegaConf.load(args.config)
 
-    if config.weight_dtype == "fp16":
-        weight_dtype = torch.float16
-    else:
-        weight_dtype = torch.float32
+def configure_decode(pipe, args, device):
+    """Frames per VAE decoder call (--decode_batch, 0 = from available memory) and tiling."""
+    batch_size = args.decode_batch or auto_batch_size(
+        device,
+        decode_item_bytes(args.W, args.H, torch.finfo(pipe.vae.dtype).bits // 8, args.decode_tile),
+        max_batch_size=16,
+    )
+    pipe.enable_batched_decode(batch_size, args.decode_tile, args.decode_tile_overlap)
+    print(f"VAE decode: {batch_size} frames per call"
+          + (f", {args.decode_tile}px latent tiles" if args.decode_tile else ""))
+
+
+def resolve_cfg_mode(pipe, args):
+    if args.cfg_mode != "auto":
+        return args.cfg_mode
+    dtype_size = 2 if pipe.autocast_dtype or pipe.denoising_unet.dtype != torch.float32 else 4
+    needed = estimate_window_bytes(args.W, args.H, args.S, 2, dtype_size)
+    available = available_memory(pipe._execution_device)
+    if available is None or 0.7 * available >= needed:
+        return "batched"
+    print(f"cfg: {needed / 1024**3:.1f} GB for a batched window, {available / 1024**3:.1f} GB available, running the branches sequentially")
+    return "sequential"
+
+
+def report_step_times(step_times):
+    """Seconds per step per guidance mode, and what the single-branch steps of --cfg_interval saved."""
+    by_mode = OrderedDict()
+    for mode, seconds in step_times:
+        by_mode.setdefault(mode, []).append(seconds)
+    print("step times:", ", ".join(
+        f"{mode} {len(times)} x {statistics.median(times):.2f}s" for mode, times in by_mode.items()
+    ))
+    guided = by_mode.get("batched", []) + by_mode.get("sequential", [])
+    single = by_mode.get("cond", [])
+    if guided and single:
+        saved = len(single) * (statistics.median(guided) - statistics.median(single))
+        total = sum(seconds for _, seconds in step_times)
+        print(f"guidance interval saved ~{saved:.1f}s, {saved / (total + saved):.0%} of the denoising time with guidance on every step")
+
+
+def write_timings(pipe, timer, paths, summary=None, **extra):
+    """Writes the stage report of a job next to its result video, adds it to the run summary."""
+    report = timer.report(
+        steps=[
+            dict(mode=mode, seconds=round(seconds, 4), windows=[round(w, 4) for w in windows])
+            for (mode, seconds), windows in zip(pipe.last_step_times, pipe.last_window_times)
+        ],
+        outputs=paths,
+        **extra,
+    )
+    write_json(report_path(paths[0]), report)
+    if summary is not None:
+        summary.add(report)
+    return report
+
 
+def get_device():
     # Set device dynamically
-    device = "mps" if torch.backends.mps.is_available() else "cpu"
+    return "mps" if torch.backends.mps.is_available() else "cpu"
 
+
+def load_components(config, infer_config, device, weight_dtype):
+    """The original loading path: base weights from pretrained folders, MusePose .pth files on top."""
     vae = AutoencoderKL.from_pretrained(
         config.pretrained_vae_path,
     ).to(device, dtype=weight_dtype)  # Changed to device
@@ -85,8 +198,6 @@ def main():
         subfolder="unet",
     ).to(dtype=weight_dtype, device=device)  # Changed to device
 
-    inference_config_path = config.inference_config
-    infer_config = OmegaConf.load(inference_config_path)
     denoising_unet = UNet3DConditionModel.from_pretrained_2d(
         config.pretrained_base_model_path,
         config.motion_module_path,
@@ -102,64 +213,149 @@ def main():
         config.image_encoder_path
     ).to(dtype=weight_dtype, device=device)  # Changed to device
 
-    sched_kwargs = OmegaConf.to_container(infer_config.noise_scheduler_kwargs)
-    scheduler = DDIMScheduler(**sched_kwargs)
-
-    generator = torch.manual_seed(args.seed)
-
-    width, height = args.W, args.H
-
     # load pretrained weights
     denoising_unet.load_state_dict(
-        torch.load(config.denoising_unet_path, map_location="cpu"),
+        load_weights(config.denoising_unet_path),
         strict=False,
     )
     reference_unet.load_state_dict(
-        torch.load(config.reference_unet_path, map_location="cpu"),
+        load_weights(config.reference_unet_path),
     )
     pose_guider.load_state_dict(
-        torch.load(config.pose_guider_path, map_location="cpu"),
+        load_weights(config.pose_guider_path),
     )
-
-    pipe = Pose2VideoPipeline(
+    return dict(
         vae=vae,
         image_encoder=image_enc,
         reference_unet=reference_unet,
         denoising_unet=denoising_unet,
         pose_guider=pose_guider,
-        scheduler=scheduler,
     )
+
+
+def build_pipeline(config, device, ref_cache_size=4, ref_cache_dir=None,
+                   pose_cache_size=2, pose_cache_dir=None, pose_cache_gb=20, fast_weights=True, bundle=None,
+                   cpu_options=None, sampler=None, deep_cache_interval=0, deep_cache_depth=1,
+                   attention="auto", attention_shape=(768, 768, 48, True), temporal_window=0, position_mode="extend"):
+    if config.weight_dtype == "fp16" and device != "cpu":
+        weight_dtype = torch.float16
+    else:
+        # fp16 kernels are slow or missing on cpu, the cpu mode keeps fp32 weights and autocasts instead
+        weight_dtype = torch.float32
+
+    infer_config = OmegaConf.load(config.inference_config) if config.get("inference_config") else {}
+    # --sampler, then sampler: of the test config, then of the inference config
+    sampler = sampler or config.get("sampler") or infer_config.get("sampler", "DDIM")
+    print("sampler:", sampler)
+
+    t0 = time.perf_counter()
+    if bundle:
+        # every component, the scheduler config included, from one convert_weights.py --bundle file
+        pipe = FastPose2VideoPipeline.from_bundle(bundle, device, weight_dtype, sampler=sampler)
+    else:
+        sched_kwargs = OmegaConf.to_container(infer_config.noise_scheduler_kwargs)
+        scheduler = make_scheduler(sampler, sched_kwargs)
+
+        weights_dir = config.get("converted_weights_dir")
+        if fast_weights and has_converted(weights_dir, "reference_unet", "denoising_unet", "pose_guider"):
+            # written by convert_weights.py: memory-mapped, already typed, no base weights to overwrite
+            components = load_converted_components(weights_dir, device, weight_dtype)
+        else:
+            if fast_weights and weights_dir:
+                print(f"no converted weights in {weights_dir}, run convert_weights.py for a faster start")
+            components = load_components(config, infer_config, device, weight_dtype)
+
+        pipe = FastPose2VideoPipeline(scheduler=scheduler, **components)
     pipe = pipe.to(device, dtype=weight_dtype)  # Changed to device
-    pipe.enable_attention_slicing()
+    if device == "cpu":
+        optimize_for_cpu(pipe, **(cpu_options or {}))
+    # (width, height, context frames, cfg) of the largest attention the pipeline will run
+    configure_attention(
+        pipe, *attention_shape, backend=attention, temporal_window=temporal_window, position_mode=position_mode
+    )
+    if deep_cache_interval > 1:
+        pipe.enable_deep_cache(deep_cache_interval, deep_cache_depth)
+        print(f"deep feature reuse: full UNet every {deep_cache_interval} steps, depth {deep_cache_depth}")
+    print(f"pipeline loaded in {time.perf_counter() - t0:.1f}s, peak RSS {peak_rss() / 1024**3:.2f} GB")
+
+    if ref_cache_size > 0 or ref_cache_dir:
+        # repeated reference images skip the CLIP encoder, VAE encoder and reference UNet
+        pipe.enable_reference_cache(
+            TensorCache(max_items=ref_cache_size, cache_dir=ref_cache_dir),
+            weights_version(bundle, dtype=config.weight_dtype) if bundle else weights_version(
+                config.pretrained_base_model_path,
+                config.pretrained_vae_path,
+                config.image_encoder_path,
+                config.reference_unet_path,
+                dtype=config.weight_dtype,
+            ),
+        )
+
+    if pose_cache_size > 0 or pose_cache_dir:
+        # repeated pose videos skip the video decode and the pose guider
+        pipe.enable_pose_cache(
+            TensorCache(
+                max_items=pose_cache_size,
+                cache_dir=pose_cache_dir,
+                max_disk_bytes=int(pose_cache_gb * 1024**3),
+                dtype=torch.float16,
+            ),
+            weights_version(bundle) if bundle else file_sha256(config.pose_guider_path),
+        )
+    return pipe
 
 
+def default_save_dir(config, args):
     date_str = datetime.now().strftime("%Y%m%d")
     time_str = datetime.now().strftime("%H%M")
 
-    def handle_single(ref_image_path,pose_video_path):
-        print ('handle===',ref_image_path, pose_video_path)
-        ref_name = Path(ref_image_path).stem
-        pose_name = Path(pose_video_path).stem.replace("_kps", "")
+    m1 = config.pose_guider_path.split('.')[0].split('/')[-1]
+    m2 = config.motion_module_path.split('.')[0].split('/')[-1]
 
-        ref_image_pil = Image.open(ref_image_path).convert("RGB")
+    save_dir_name = f"{time_str}-{args.cfg}-{m1}-{m2}"
+    return Path(f"./output/video-{date_str}/{save_dir_name}")
 
-        pose_list = []
-        pose_tensor_list = []
+
+def prepare_pose(pipe, args, pose_video_path, timer):
+    """
+    PoseGuider features and grid frames of one pose video, from pipe.pose_cache when possible.
+
+    A cache hit skips both decoding the pose video and running the pose guider.
+    """
+    width, height = args.W, args.H
+    cache = pipe.pose_cache
+    key = None
+    if cache is not None:
+        # L / S / O / skip decide which frames are used and how the last window is padded
+        key = make_key(
+            "pose", file_sha256(pose_video_path), width, height,
+            args.L, args.S, args.O, args.skip, pipe.pose_weights_version,
+        )
+        with timer.stage("pose_cache"):
+            cached = cache.get(key, device=pipe.pose_guider.device, dtype=pipe.pose_guider.dtype)
+        if cached is not None:
+            print("pose features from cache:", pose_video_path)
+            return cached
+
+    pose_list = []
+    pose_tensor_list = []
+    with timer.stage("read_frames"):
         pose_images = read_frames(pose_video_path)
         src_fps = get_fps(pose_video_path)
-        print(f"pose video has {len(pose_images)} frames, with {src_fps} fps")
-        L = min(args.L, len(pose_images))
-        pose_transform = transforms.Compose(
-            [transforms.Resize((height, width)), transforms.ToTensor()]
-        )
-        original_width,original_height = 0,0
-
-        pose_images = pose_images[::args.skip+1]
-        print("processing length:", len(pose_images))
-        src_fps = src_fps // (args.skip + 1)
-        print("fps", src_fps)
-        L = L // ((args.skip + 1))
-        
+    print(f"pose video has {len(pose_images)} frames, with {src_fps} fps")
+    L = min(args.L, len(pose_images))
+    pose_transform = transforms.Compose(
+        [transforms.Resize((height, width)), transforms.ToTensor()]
+    )
+    original_width,original_height = 0,0
+
+    pose_images = pose_images[::args.skip+1]
+    print("processing length:", len(pose_images))
+    src_fps = src_fps // (args.skip + 1)
+    print("fps", src_fps)
+    L = L // ((args.skip + 1))
+    
+    with timer.stage("pose_transform"):
         for pose_image_pil in pose_images[: L]:
             pose_tensor_list.append(pose_transform(pose_image_pil))
             pose_list.append(pose_image_pil)
@@ -173,54 +369,370 @@ def main():
             pose_list.append(pose_list[-1])
             pose_tensor_list.append(pose_tensor_list[-1])
 
-        
-        ref_image_tensor = pose_transform(ref_image_pil)  # (c, h, w)
-        ref_image_tensor = ref_image_tensor.unsqueeze(1).unsqueeze(0)  # (1, c, 1, h, w)
-        ref_image_tensor = repeat(ref_image_tensor, "b c f h w -> b c (repeat f) h w", repeat=L)
-
-        pose_tensor = torch.stack(pose_tensor_list, dim=0)  # (f, c, h, w)
+        pose_tensor = torch.stack(pose_tensor_list[:L], dim=0)  # (f, c, h, w)
         pose_tensor = pose_tensor.transpose(0, 1)
         pose_tensor = pose_tensor.unsqueeze(0)
 
-        video = pipe(
-            ref_image_pil,
-            pose_list,
-            width,
-            height,
-            len(pose_list),
-            args.steps,
-            args.cfg,
-            generator=generator,
-            context_frames=args.S,
-            context_stride=1,
-            context_overlap=args.O,
-        ).videos
+    with timer.stage("pose_guider"):
+        pose_fea = pipe.encode_pose(pose_list, width, height)
+    if cache is not None and cache.dtype is not None:
+        # use the features exactly as a later cache hit returns them, so reruns match the first run
+        pose_fea = pose_fea.to(cache.dtype).to(pipe.pose_guider.dtype)
+
+    pose = dict(
+        pose_fea=pose_fea,
+        # ToTensor frames are uint8 / 255, so this round trip is exact
+        pose_frames=(pose_tensor * 255).round().to(torch.uint8),
+        L=L,
+        src_fps=src_fps,
+        original_size=(original_width, original_height),
+    )
+    if cache is not None:
+        with timer.stage("pose_cache"):
+            cache.put(key, dict(pose, pose_fea=pose_fea.cpu()))
+    return pose
+
+
+def output_paths(config, args, ref_image_path, pose_video_path, save_dir):
+    ref_name = Path(ref_image_path).stem
+    pose_name = Path(pose_video_path).stem.replace("_kps", "")
+
+    m1 = config.pose_guider_path.split('.')[0].split('/')[-1]
+    m2 = config.motion_module_path.split('.')[0].split('/')[-1]
+
+    save_dir = Path(save_dir)
+    save_dir.mkdir(exist_ok=True, parents=True)
+
+    out_path = f"{save_dir}/{ref_name}_{pose_name}_{args.cfg}_{args.steps}_{args.skip}.mp4"
+    grid_path = f"{save_dir}/{ref_name}_{pose_name}_{args.cfg}_{args.steps}_{args.skip}_{m1}_{m2}.mp4"
+    return out_path, grid_path
 
 
-        m1 = config.pose_guider_path.split('.')[0].split('/')[-1]
-        m2 = config.motion_module_path.split('.')[0].split('/')[-1]
+def save_outputs(config, args, ref_image_path, pose_video_path, ref_image_pil, pose, video, save_dir, timer):
+    """Writes the result video and the (reference, pose, result) grid of one job, returns their paths."""
+    width, height = args.W, args.H
+    L, src_fps = pose["L"], pose["src_fps"]
+    original_width, original_height = pose["original_size"]
+    pose_tensor = pose["pose_frames"].float() / 255
 
-        save_dir_name = f"{time_str}-{args.cfg}-{m1}-{m2}"
-        save_dir = Path(f"./output/video-{date_str}/{save_dir_name}")
-        save_dir.mkdir(exist_ok=True, parents=True)
+    pose_transform = transforms.Compose(
+        [transforms.Resize((height, width)), transforms.ToTensor()]
+    )
+    ref_image_tensor = pose_transform(ref_image_pil)  # (c, h, w)
+    ref_image_tensor = ref_image_tensor.unsqueeze(1).unsqueeze(0)  # (1, c, 1, h, w)
+    ref_image_tensor = ref_image_tensor.expand(-1, -1, L, -1, -1)
 
+    out_path, grid_path = output_paths(config, args, ref_image_path, pose_video_path, save_dir)
+    with timer.stage("scale_video"):
         result = scale_video(video[:,:,:L], original_width, original_height)
+    with timer.stage("save_video"):
         save_videos_grid(
             result,
-            f"{save_dir}/{ref_name}_{pose_name}_{args.cfg}_{args.steps}_{args.skip}.mp4",
+            out_path,
             n_rows=1,
             fps=src_fps if args.fps is None else args.fps,
         )    
 
+    with timer.stage("scale_video"):
         video = torch.cat([ref_image_tensor, pose_tensor[:,:,:L], video[:,:,:L]], dim=0) 
         video = scale_video(video, original_width, original_height)     
+    with timer.stage("save_video"):
         save_videos_grid(
             video,
-            f"{save_dir}/{ref_name}_{pose_name}_{args.cfg}_{args.steps}_{args.skip}_{m1}_{m2}.mp4",
+            grid_path,
             n_rows=3,
             fps=src_fps if args.fps is None else args.fps,
         )
+    return [out_path, grid_path]
+
+
+def stream_outputs(config, args, ref_image_path, pose_video_path, ref_image_pil, pose, save_dir, timer):
+    """
+    Streaming counterpart of save_outputs: returns a pipeline frame_callback that rescales and
+    appends every finished chunk to the result and grid videos, and a close() returning their paths.
+    """
+    width, height = args.W, args.H
+    L, src_fps = pose["L"], pose["src_fps"]
+    original_width, original_height = pose["original_size"]
+    fps = src_fps if args.fps is None else args.fps
+
+    pose_transform = transforms.Compose(
+        [transforms.Resize((height, width)), transforms.ToTensor()]
+    )
+    ref_image_tensor = pose_transform(ref_image_pil)  # (c, h, w)
+    ref_image_tensor = ref_image_tensor.unsqueeze(1).unsqueeze(0)  # (1, c, 1, h, w)
+
+    out_path, grid_path = output_paths(config, args, ref_image_path, pose_video_path, save_dir)
+    result_writer = StreamingVideoWriter(out_path, fps)
+    grid_writer = StreamingVideoWriter(grid_path, fps)
+    # rescaling and x264 run in the background while the pipeline denoises and decodes
+    encoder = BackgroundEncoder()
+    started = time.perf_counter()
+    first = [True]
+
+    def write(frames, pose_tensor):
+        n = frames.shape[2]
+        with timer.stage("scale_video"):
+            result = scale_video(frames, original_width, original_height)
+        with timer.stage("save_video"):
+            result_writer.write_grid(result, n_rows=1)
+
+        with timer.stage("scale_video"):
+            video = torch.cat([ref_image_tensor.expand(-1, -1, n, -1, -1), pose_tensor, frames], dim=0)
+            video = scale_video(video, original_width, original_height)
+        with timer.stage("save_video"):
+            grid_writer.write_grid(video, n_rows=3)
+
+    def frame_callback(start, frames):
+        # frames beyond L only pad the last window
+        frames = frames[:, :, : max(0, L - start)]
+        n = frames.shape[2]
+        if n == 0:
+            return
+        if first[0]:
+            timer.record("first_frame", time.perf_counter() - started)
+            first[0] = False
+        encoder.submit(write, frames, pose["pose_frames"][:, :, start : start + n].float() / 255)
+
+    def close():
+        try:
+            encoder.close()
+        finally:
+            result_writer.close()
+            grid_writer.close()
+        return [out_path, grid_path]
+
+    return frame_callback, close
+
+
+def handle_single(pipe, config, args, ref_image_path, pose_video_path, generator, save_dir, timer=None, summary=None):
+    """
+    Generates one (reference, pose video) pair and returns the paths of the written videos;
+    the stage timings go to <result>.timings.json and to summary (a TimingSummary) if given.
+    """
+    if timer is None:
+        timer = StageTimer()
+
+    print ('handle===',ref_image_path, pose_video_path)
+    width, height = args.W, args.H
+
+    ref_image_pil = Image.open(ref_image_path).convert("RGB")
+    work_dir = None
+    if args.long_video:
+        # pose frames and features on disk, read back one window at a time
+        work_dir = LongVideoWorkDir(args.long_video_dir)
+        pose = prepare_pose_long(pipe, args, pose_video_path, timer, work_dir.path)
+    else:
+        pose = prepare_pose(pipe, args, pose_video_path, timer)
+
+    frame_callback = close = None
+    if args.stream:
+        # finished frames are decoded and written while the last step is still running
+        frame_callback, close = stream_outputs(
+            config, args, ref_image_path, pose_video_path, ref_image_pil, pose, save_dir, timer
+        )
 
+    pipe.timer = timer
+    finished = False
+    try:
+        with timer.stage("pipeline"), pipe.autocast():
+            video = pipe(
+                ref_image_pil,
+                None,
+                width,
+                height,
+                pose["pose_fea"].shape[2],
+                args.steps,
+                args.cfg,
+                generator=generator,
+                context_frames=args.S,
+                context_stride=1,
+                context_overlap=args.O,
+                pose_fea=pose["pose_fea"],
+                frame_callback=frame_callback,
+                latents_dtype=torch.float16 if args.long_video else None,
+                cfg_mode=resolve_cfg_mode(pipe, args),
+                guidance_interval=args.cfg_interval,
+            ).videos
+        report_step_times(pipe.last_step_times)
+        finished = True
+    finally:
+        pipe.timer = None
+        if work_dir is not None:
+            work_dir.close()
+        if close is not None and not finished:
+            # stop the encoder thread and close the partial videos, the pipeline error is the one raised
+            try:
+                close()
+            except Exception:
+                pass
+
+    if close is not None:
+        paths = close()
+    else:
+        paths = save_outputs(
+            config, args, ref_image_path, pose_video_path, ref_image_pil, pose, video, save_dir, timer
+        )
+    write_timings(
+        pipe, timer, paths, summary,
+        ref_image=ref_image_path, pose_video=pose_video_path, frames=pose["L"],
+    )
+    return paths
+
+
+def handle_batch(pipe, config, args, jobs, save_dir, timer=None, summary=None):
+    """
+    Generates jobs sharing W, H, length, steps and window schedule as one pipeline batch.
+
+    Every job dict carries ref_image_path, pose_video_path, ref_image_pil, pose (from
+    prepare_pose) and its own seed; returns the written paths per job. Every job gets the
+    timings of the whole batch, the summary counts them once.
+    """
+    if timer is None:
+        timer = StageTimer()
+
+    print('handle batch===', [(job["ref_image_path"], job["pose_video_path"]) for job in jobs])
+    pipe.timer = timer
+    try:
+        with timer.stage("pipeline"), pipe.autocast():
+            videos = pipe(
+                [job["ref_image_pil"] for job in jobs],
+                None,
+                args.W,
+                args.H,
+                jobs[0]["pose"]["pose_fea"].shape[2],
+                args.steps,
+                args.cfg,
+                generator=[torch.Generator().manual_seed(job["seed"]) for job in jobs],
+                context_frames=args.S,
+                context_stride=1,
+                context_overlap=args.O,
+                pose_fea=[job["pose"]["pose_fea"] for job in jobs],
+                cfg_mode=resolve_cfg_mode(pipe, args),
+                guidance_interval=args.cfg_interval,
+            ).videos
+    finally:
+        pipe.timer = None
+    report_step_times(pipe.last_step_times)
+
+    paths = [
+        save_outputs(
+            config, args, job["ref_image_path"], job["pose_video_path"], job["ref_image_pil"],
+            job["pose"], videos[i : i + 1], save_dir, timer,
+        )
+        for i, job in enumerate(jobs)
+    ]
+    for i, job in enumerate(jobs):
+        write_timings(
+            pipe, timer, paths[i], summary if i == 0 else None,
+            ref_image=job["ref_image_path"], pose_video=job["pose_video_path"], frames=job["pose"]["L"],
+            batch=len(jobs),
+        )
+    return paths
+
+
+def run_batched(pipe, config, args, device, save_dir, summary=None, profiler=None):
+    """
+    Batched counterpart of the sequential loop in main(). Job i is seeded with seed + i, so every
+    item matches a single run with torch.Generator().manual_seed(seed + i).
+    """
+    groups = OrderedDict()
+    limits = {}
+    batched = dict(jobs=0, seconds=0.0)
+    sequential = dict(jobs=0, seconds=0.0)
+
+    def flush(signature):
+        jobs = groups.pop(signature)
+        t0 = time.perf_counter()
+        handle_batch(pipe, config, args, jobs, save_dir, summary=summary)
+        if profiler is not None:
+            profiler.step()
+        batched["jobs"] += len(jobs)
+        batched["seconds"] += time.perf_counter() - t0
+        print(f"batch of {len(jobs)}: {(time.perf_counter() - t0) / len(jobs):.1f}s per job")
+
+        if args.compare_sequential:
+            t0 = time.perf_counter()
+            for job in jobs:
+                handle_single(
+                    pipe, config, args, job["ref_image_path"], job["pose_video_path"],
+                    torch.Generator().manual_seed(job["seed"]), Path(save_dir) / "sequential",
+                )
+            sequential["jobs"] += len(jobs)
+            sequential["seconds"] += time.perf_counter() - t0
+
+    for index, (ref_image_path, pose_video_path) in enumerate(iter_test_cases(config)):
+        pose = prepare_pose(pipe, args, pose_video_path, StageTimer())
+        video_length = pose["pose_fea"].shape[2]
+        signature = (args.W, args.H, video_length, args.steps, args.S, args.O)
+        if signature not in limits:
+            limits[signature] = args.batch_size or auto_batch_size(
+                device,
+                estimate_item_bytes(args.W, args.H, video_length, args.S, args.cfg > 1.0),
+                args.max_batch_size,
+            )
+            print(f"batch size {limits[signature]} for W={args.W} H={args.H} frames={video_length}")
+
+        groups.setdefault(signature, []).append(dict(
+            ref_image_path=ref_image_path,
+            pose_video_path=pose_video_path,
+            ref_image_pil=Image.open(ref_image_path).convert("RGB"),
+            pose=pose,
+            seed=args.seed + index,
+        ))
+        if len(groups[signature]) >= limits[signature]:
+            flush(signature)
+
+    for signature in list(groups):
+        flush(signature)
+
+    if batched["jobs"]:
+        per_job = batched["seconds"] / batched["jobs"]
+        print(f"batched: {batched['jobs']} jobs, {per_job:.1f}s per job, {3600 / per_job:.1f} jobs/hour")
+    if sequential["jobs"]:
+        per_job = sequential["seconds"] / sequential["jobs"]
+        print(f"sequential: {sequential['jobs']} jobs, {per_job:.1f}s per job, {3600 / per_job:.1f} jobs/hour")
+        print(f"batched speedup: {sequential['seconds'] / batched['seconds']:.2f}x")
+
+
+def manifest_settings(config, args):
+    """Everything that changes the videos of a job; a manifest folder holds one combination."""
+    keys = [
+        "config", "W", "H", "L", "S", "O", "cfg", "cfg_interval", "steps", "sampler", "skip", "fps",
+        "deep_cache", "deep_cache_depth", "temporal_window", "temporal_positions",
+    ]
+    return dict({key: getattr(args, key) for key in keys}, motion_module=config.motion_module_path)
+
+
+def run_manifest(pipe, config, args, summary=None, profiler=None):
+    """
+    Runs the unfinished jobs of the --manifest folder one by one, each seeded with its own seed
+    from the manifest; a failed job is reported and left pending for the next run.
+    """
+    manifest = JobManifest.open(args.manifest, iter_test_cases(config), manifest_settings(config, args), args.seed)
+    pending = manifest.pending()
+    print(f"manifest {manifest.path}: {len(manifest.jobs)} jobs, "
+          f"{len(manifest.jobs) - len(pending)} done, {len(pending)} to run")
+    progress = Progress(len(pending))
+    for job in pending:
+        try:
+            paths = handle_single(
+                pipe, config, args, job["ref_image"], job["pose_video"],
+                # one folder per job, same reference / pose names in different folders never collide
+                torch.Generator().manual_seed(job["seed"]), Path(args.manifest) / "jobs" / job["id"], summary=summary,
+            )
+        except Exception:
+            traceback.print_exc()
+            progress.update(failed=True)
+            continue
+        manifest.mark_done(job, paths)
+        progress.update()
+        if profiler is not None:
+            profiler.step()
+    return progress
+
+
+def iter_test_cases(config):
     for ref_image_path_dir in config["test_cases"].keys():
         if os.path.isdir(ref_image_path_dir):
             ref_image_paths = glob.glob(os.path.join(ref_image_path_dir, '*.jpg'))
@@ -233,7 +745,74 @@ def main():
                 else:
                     pose_video_paths = [pose_video_path_dir]
                 for pose_video_path in pose_video_paths:
-                    handle_single(ref_image_path, pose_video_path) 
+                    yield ref_image_path, pose_video_path
+
+
+def main():
+    args = parse_args()
+
+    config = OmegaConf.load(args.config)
+
+    configure_threads(args.threads, args.interop_threads)
+    device = get_device()
+    summary = TimingSummary()
+    load_start = time.perf_counter()
+    pipe = build_pipeline(
+        config, device,
+        args.ref_cache_size, args.ref_cache_dir,
+        args.pose_cache_size, args.pose_cache_dir, args.pose_cache_gb,
+        bundle=args.bundle,
+        cpu_options=cpu_options(args),
+        sampler=args.sampler,
+        deep_cache_interval=args.deep_cache,
+        deep_cache_depth=args.deep_cache_depth,
+        attention=args.attention,
+        attention_shape=(args.W, args.H, args.S, args.cfg > 1.0),
+        temporal_window=args.temporal_window,
+        position_mode=args.temporal_positions,
+    )
+    if args.window_workers > 0:
+        pipe.window_pool = WindowWorkerPool(
+            partial(
+                build_pipeline, config, device, ref_cache_size=0, pose_cache_size=0,
+                bundle=args.bundle, cpu_options=cpu_options(args),
+                deep_cache_interval=args.deep_cache, deep_cache_depth=args.deep_cache_depth,
+                attention=args.attention, attention_shape=(args.W, args.H, args.S, args.cfg > 1.0),
+                temporal_window=args.temporal_window, position_mode=args.temporal_positions,
+            ),
+            args.window_workers,
+            num_threads=args.threads,
+        )
+
+    configure_decode(pipe, args, device)
+    load_seconds = time.perf_counter() - load_start
+
+    generator = torch.manual_seed(args.seed)
+    # a manifest keeps its outputs at fixed paths, plain runs get a fresh folder
+    save_dir = Path(args.manifest) if args.manifest else default_save_dir(config, args)
+
+    with make_profiler(args, "test_stage_2") as profiler:
+        if args.manifest:
+            run_manifest(pipe, config, args, summary, profiler)
+        elif args.batch_size != 1:
+            run_batched(pipe, config, args, device, save_dir, summary, profiler)
+        else:
+            for ref_image_path, pose_video_path in iter_test_cases(config):
+                handle_single(pipe, config, args, ref_image_path, pose_video_path, generator, save_dir, summary=summary)
+                profiler.step()
+
+    summary.print()
+    if summary.reports:
+        write_json(os.path.join(save_dir, "timings_summary.json"), summary.summary(model_load_seconds=round(load_seconds, 2)))
+
+    if pipe.reference_cache is not None:
+        print("reference feature cache:", pipe.reference_cache.stats())
+    if pipe.pose_cache is not None:
+        print("pose feature cache:", pipe.pose_cache.stats())
+    if getattr(pipe.denoising_unet, "deep_cache", None) is not None:
+        print("deep feature reuse:", pipe.denoising_unet.deep_cache.stats())
+    if pipe.window_pool is not None:
+        pipe.window_pool.close()
 
 
 
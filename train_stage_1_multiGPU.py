@@ -27,9 +27,9 @@ from accelerate.utils import DistributedDataParallelKwargs
 from diffusers import AutoencoderKL, DDIMScheduler
 from diffusers.optimization import get_scheduler
 from diffusers.utils import check_min_version
-from diffusers.utils.import_utils import is_xformers_available
 from omegaconf import OmegaConf
 from PIL import Image
+from torch.profiler import record_function
 from tqdm.auto import tqdm
 from transformers import CLIPVisionModelWithProjection
 
@@ -41,6 +41,9 @@ from src.models.unet_2d_condition import UNet2DConditionModel
 from src.models.unet_3d import UNet3DConditionModel
 from src.pipelines.pipeline_pose2img import Pose2ImagePipeline
 from src.utils.util import delete_additional_ckpt, import_filename, seed_everything
+from inference.attention import enable_memory_efficient_attention
+from inference.profiling import add_profile_args, make_profiler
+from latent_cache import LatentImageDataset, sample_latents
 
 warnings.filterwarnings("ignore")
 
@@ -76,24 +79,27 @@ class Net(nn.Module):
         uncond_fwd: bool = False,
     ):
         pose_cond_tensor = pose_img.to(device="cuda")
-        pose_fea = self.pose_guider(pose_cond_tensor)
+        with record_function("pose_guider"):
+            pose_fea = self.pose_guider(pose_cond_tensor)
 
         if not uncond_fwd:
             ref_timesteps = torch.zeros_like(timesteps)
-            self.reference_unet(
-                ref_image_latents,
-                ref_timesteps,
-                encoder_hidden_states=clip_image_embeds,
-                return_dict=False,
-            )
+            with record_function("reference_unet"):
+                self.reference_unet(
+                    ref_image_latents,
+                    ref_timesteps,
+                    encoder_hidden_states=clip_image_embeds,
+                    return_dict=False,
+                )
             self.reference_control_reader.update(self.reference_control_writer)
 
-        model_pred = self.denoising_unet(
-            noisy_latents,
-            timesteps,
-            pose_cond_fea=pose_fea,
-            encoder_hidden_states=clip_image_embeds,
-        ).sample
+        with record_function("denoising_unet"):
+            model_pred = self.denoising_unet(
+                noisy_latents,
+                timesteps,
+                pose_cond_fea=pose_fea,
+                encoder_hidden_states=clip_image_embeds,
+            ).sample
 
         return model_pred
 
@@ -129,7 +135,7 @@ def compute_snr(noise_scheduler, timesteps):
 
 
 
-def main(cfg):
+def main(cfg, profile_args=None):
     kwargs = DistributedDataParallelKwargs(find_unused_parameters=True)
     accelerator = Accelerator(
         gradient_accumulation_steps=cfg.solver.gradient_accumulation_steps,
@@ -269,13 +275,9 @@ def main(cfg):
     )
 
     if cfg.solver.enable_xformers_memory_efficient_attention:
-        if is_xformers_available():
-            reference_unet.enable_xformers_memory_efficient_attention()
-            denoising_unet.enable_xformers_memory_efficient_attention()
-        else:
-            raise ValueError(
-                "xformers is not available. Make sure it is installed correctly"
-            )
+        # falls back to SDPA (or slicing) when xformers is not installed
+        attention_backend = enable_memory_efficient_attention(reference_unet, denoising_unet)
+        logger.info(f"Memory efficient attention: {attention_backend}")
 
     if cfg.solver.gradient_checkpointing:
         reference_unet.enable_gradient_checkpointing()
@@ -323,12 +325,22 @@ def main(cfg):
         * cfg.solver.gradient_accumulation_steps,
     )
 
-    train_dataset = HumanDanceDataset(
-        img_size=(cfg.data.train_width, cfg.data.train_height),
-        img_scale=(0.9, 1.0),
-        data_meta_paths=cfg.data.meta_paths,
-        sample_margin=cfg.data.sample_margin,
-    )
+    # data.latent_cache: latents precomputed by latent_cache.py, no VAE encoder in the training step
+    use_latent_cache = bool(cfg.data.get("latent_cache"))
+    if use_latent_cache:
+        train_dataset = LatentImageDataset(
+            cfg.data.latent_cache,
+            width=cfg.data.train_width,
+            height=cfg.data.train_height,
+            sample_margin=cfg.data.sample_margin,
+        )
+    else:
+        train_dataset = HumanDanceDataset(
+            img_size=(cfg.data.train_width, cfg.data.train_height),
+            img_scale=(0.9, 1.0),
+            data_meta_paths=cfg.data.meta_paths,
+            sample_margin=cfg.data.sample_margin,
+        )
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset, batch_size=cfg.data.train_bs, shuffle=True, num_workers=cfg.data.train_bs, drop_last=True
     )
@@ -412,14 +424,23 @@ def main(cfg):
     )
     progress_bar.set_description("Steps")
 
+    # --profile: torch.profiler over a window of training steps, a no-op otherwise
+    profiler = make_profiler(profile_args, f"train_stage_1_rank{accelerator.process_index}")
+    profiler.start()
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
         for step, batch in enumerate(train_dataloader):
             with accelerator.accumulate(net):
                 # Convert videos to latent space
-                pixel_values = batch["img"].to(weight_dtype)
                 with torch.no_grad():
-                    latents = vae.encode(pixel_values).latent_dist.sample()
+                    if use_latent_cache:
+                        latents = sample_latents(
+                            batch["latent_params_img"].to(accelerator.device)
+                        ).to(weight_dtype)
+                    else:
+                        pixel_values = batch["img"].to(weight_dtype)
+                        with record_function("vae_encode"):
+                            latents = vae.encode(pixel_values).latent_dist.sample()
                     latents = latents.unsqueeze(2)  # (b, c, 1, h, w)
                     latents = latents * 0.18215
 
@@ -448,7 +469,7 @@ def main(cfg):
                 ref_image_list = []
                 for batch_idx, (ref_img, clip_img) in enumerate(
                     zip(
-                        batch["ref_img"],
+                        batch["latent_params_ref" if use_latent_cache else "ref_img"],
                         batch["clip_images"],
                     )
                 ):
@@ -459,20 +480,27 @@ def main(cfg):
                     ref_image_list.append(ref_img)
 
                 with torch.no_grad():
-                    ref_img = torch.stack(ref_image_list, dim=0).to(
-                        dtype=vae.dtype, device=vae.device
-                    )
-                    ref_image_latents = vae.encode(
-                        ref_img
-                    ).latent_dist.sample()  # (bs, d, 64, 64)
+                    if use_latent_cache:
+                        ref_image_latents = sample_latents(
+                            torch.stack(ref_image_list, dim=0).to(vae.device)
+                        ).to(vae.dtype)
+                    else:
+                        ref_img = torch.stack(ref_image_list, dim=0).to(
+                            dtype=vae.dtype, device=vae.device
+                        )
+                        with record_function("vae_encode"):
+                            ref_image_latents = vae.encode(
+                                ref_img
+                            ).latent_dist.sample()  # (bs, d, 64, 64)
                     ref_image_latents = ref_image_latents * 0.18215
 
                     clip_img = torch.stack(clip_image_list, dim=0).to(
                         dtype=image_enc.dtype, device=image_enc.device
                     )
-                    clip_image_embeds = image_enc(
-                        clip_img.to("cuda", dtype=weight_dtype)
-                    ).image_embeds
+                    with record_function("clip_encode"):
+                        clip_image_embeds = image_enc(
+                            clip_img.to("cuda", dtype=weight_dtype)
+                        ).image_embeds
                     image_prompt_embeds = clip_image_embeds.unsqueeze(1)  # (bs, 1, d)
 
                 # add noise
@@ -530,15 +558,17 @@ def main(cfg):
                 train_loss += avg_loss.item() / cfg.solver.gradient_accumulation_steps
 
                 # Backpropagate
-                accelerator.backward(loss)
-                if accelerator.sync_gradients:
-                    accelerator.clip_grad_norm_(
-                        trainable_params,
-                        cfg.solver.max_grad_norm,
-                    )
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                with record_function("backward"):
+                    accelerator.backward(loss)
+                with record_function("optimizer"):
+                    if accelerator.sync_gradients:
+                        accelerator.clip_grad_norm_(
+                            trainable_params,
+                            cfg.solver.max_grad_norm,
+                        )
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad()
 
             if accelerator.sync_gradients:
                 reference_control_reader.clear()
@@ -556,6 +586,7 @@ def main(cfg):
                 "lr": lr_scheduler.get_last_lr()[0],
             }
             progress_bar.set_postfix(**logs)
+            profiler.step()
 
             if global_step >= cfg.solver.max_train_steps:
                 break
@@ -587,6 +618,7 @@ def main(cfg):
                 total_limit=20,
             )
 
+    profiler.stop()
     # Create the pipeline using the trained modules and save it.
     accelerator.wait_for_everyone()
     accelerator.end_training()
@@ -602,6 +634,7 @@ def save_checkpoint(model, save_dir, prefix, ckpt_num, total_limit=None):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="./configs/train_stage_1.yaml")
+    add_profile_args(parser, unit="training steps")
     args = parser.parse_args()
 
     if args.config[-5:] == ".yaml":
@@ -612,4 +645,4 @@ if __name__ == "__main__":
         raise ValueError("Do not support this format config file")
     
 
-    main(config)
+    main(config, args)
@@ -27,10 +27,10 @@ from accelerate.utils import DistributedDataParallelKwargs
 from diffusers import AutoencoderKL, DDIMScheduler
 from diffusers.optimization import get_scheduler
 from diffusers.utils import check_min_version
-from diffusers.utils.import_utils import is_xformers_available
 from einops import rearrange
 from omegaconf import OmegaConf
 from PIL import Image
+from torch.profiler import record_function
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPVisionModelWithProjection
@@ -48,6 +48,10 @@ from src.utils.util import (
     save_videos_grid,
     seed_everything,
 )
+from inference.vae_decode import decode_latents as decode_video_latents
+from inference.attention import enable_memory_efficient_attention
+from inference.profiling import add_profile_args, make_profiler
+from latent_cache import LatentVideoDataset, sample_latents
 
 warnings.filterwarnings("ignore")
 
@@ -83,24 +87,27 @@ class Net(nn.Module):
         uncond_fwd: bool = False,
     ):
         pose_cond_tensor = pose_img.to(device="cuda")
-        pose_fea = self.pose_guider(pose_cond_tensor)
+        with record_function("pose_guider"):
+            pose_fea = self.pose_guider(pose_cond_tensor)
 
         if not uncond_fwd:
             ref_timesteps = torch.zeros_like(timesteps)
-            self.reference_unet(
-                ref_image_latents,
-                ref_timesteps,
-                encoder_hidden_states=clip_image_embeds,
-                return_dict=False,
-            )
+            with record_function("reference_unet"):
+                self.reference_unet(
+                    ref_image_latents,
+                    ref_timesteps,
+                    encoder_hidden_states=clip_image_embeds,
+                    return_dict=False,
+                )
             self.reference_control_reader.update(self.reference_control_writer)
 
-        model_pred = self.denoising_unet(
-            noisy_latents,
-            timesteps,
-            pose_cond_fea=pose_fea,
-            encoder_hidden_states=clip_image_embeds,
-        ).sample
+        with record_function("denoising_unet"):
+            model_pred = self.denoising_unet(
+                noisy_latents,
+                timesteps,
+                pose_cond_fea=pose_fea,
+                encoder_hidden_states=clip_image_embeds,
+            ).sample
 
         return model_pred
 
@@ -136,7 +143,7 @@ def compute_snr(noise_scheduler, timesteps):
 
 
 
-def main(cfg):
+def main(cfg, profile_args=None):
     kwargs = DistributedDataParallelKwargs(find_unused_parameters=False)
     accelerator = Accelerator(
         gradient_accumulation_steps=cfg.solver.gradient_accumulation_steps,
@@ -283,13 +290,9 @@ def main(cfg):
     )
 
     if cfg.solver.enable_xformers_memory_efficient_attention:
-        if is_xformers_available():
-            reference_unet.enable_xformers_memory_efficient_attention()
-            denoising_unet.enable_xformers_memory_efficient_attention()
-        else:
-            raise ValueError(
-                "xformers is not available. Make sure it is installed correctly"
-            )
+        # falls back to SDPA (or slicing) when xformers is not installed
+        attention_backend = enable_memory_efficient_attention(reference_unet, denoising_unet)
+        logger.info(f"Memory efficient attention: {attention_backend}")
 
     if cfg.solver.gradient_checkpointing:
         reference_unet.enable_gradient_checkpointing()
@@ -338,14 +341,25 @@ def main(cfg):
         * cfg.solver.gradient_accumulation_steps,
     )
 
-    train_dataset = HumanDanceVideoDataset(
-        width=cfg.data.train_width,
-        height=cfg.data.train_height,
-        n_sample_frames=cfg.data.n_sample_frames,
-        sample_rate=cfg.data.sample_rate,
-        img_scale=(1.0, 1.0),
-        data_meta_paths=cfg.data.meta_paths,
-    )
+    # data.latent_cache: latents precomputed by latent_cache.py, no VAE encoder in the training step
+    use_latent_cache = bool(cfg.data.get("latent_cache"))
+    if use_latent_cache:
+        train_dataset = LatentVideoDataset(
+            cfg.data.latent_cache,
+            width=cfg.data.train_width,
+            height=cfg.data.train_height,
+            n_sample_frames=cfg.data.n_sample_frames,
+            sample_rate=cfg.data.sample_rate,
+        )
+    else:
+        train_dataset = HumanDanceVideoDataset(
+            width=cfg.data.train_width,
+            height=cfg.data.train_height,
+            n_sample_frames=cfg.data.n_sample_frames,
+            sample_rate=cfg.data.sample_rate,
+            img_scale=(1.0, 1.0),
+            data_meta_paths=cfg.data.meta_paths,
+        )
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset, batch_size=cfg.data.train_bs, shuffle=True, num_workers=1, drop_last=True
     )
@@ -429,6 +443,9 @@ def main(cfg):
     )
     progress_bar.set_description("Steps")
 
+    # --profile: torch.profiler over a window of training steps, a no-op otherwise
+    profiler = make_profiler(profile_args, f"train_stage_2_rank{accelerator.process_index}")
+    profiler.start()
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
         t_data_start = time.time()
@@ -436,16 +453,23 @@ def main(cfg):
             t_data = time.time() - t_data_start
             with accelerator.accumulate(net):
                 # Convert videos to latent space
-                pixel_values_vid = batch["pixel_values_vid"].to(weight_dtype)
                 with torch.no_grad():
-                    video_length = pixel_values_vid.shape[1]
-                    pixel_values_vid = rearrange(
-                        pixel_values_vid, "b f c h w -> (b f) c h w"
-                    )
-                    latents = vae.encode(pixel_values_vid).latent_dist.sample()
-                    latents = rearrange(
-                        latents, "(b f) c h w -> b c f h w", f=video_length
-                    )
+                    if use_latent_cache:
+                        latents = sample_latents(
+                            batch["latent_params_vid"].to(accelerator.device)
+                        ).to(weight_dtype)
+                        latents = rearrange(latents, "b f c h w -> b c f h w")
+                    else:
+                        pixel_values_vid = batch["pixel_values_vid"].to(weight_dtype)
+                        video_length = pixel_values_vid.shape[1]
+                        pixel_values_vid = rearrange(
+                            pixel_values_vid, "b f c h w -> (b f) c h w"
+                        )
+                        with record_function("vae_encode"):
+                            latents = vae.encode(pixel_values_vid).latent_dist.sample()
+                        latents = rearrange(
+                            latents, "(b f) c h w -> b c f h w", f=video_length
+                        )
                     latents = latents * 0.18215
 
                 noise = torch.randn_like(latents)
@@ -474,7 +498,7 @@ def main(cfg):
                 ref_image_list = []
                 for batch_idx, (ref_img, clip_img) in enumerate(
                     zip(
-                        batch["pixel_values_ref_img"],
+                        batch["latent_params_ref" if use_latent_cache else "pixel_values_ref_img"],
                         batch["clip_ref_img"],
                     )
                 ):
@@ -485,21 +509,28 @@ def main(cfg):
                     ref_image_list.append(ref_img)
 
                 with torch.no_grad():
-                    ref_img = torch.stack(ref_image_list, dim=0).to(
-                        dtype=vae.dtype, device=vae.device
-                    )
-                    ref_image_latents = vae.encode(
-                        ref_img
-                    ).latent_dist.sample()  # (bs, d, 64, 64)
+                    if use_latent_cache:
+                        ref_image_latents = sample_latents(
+                            torch.stack(ref_image_list, dim=0).to(vae.device)
+                        ).to(vae.dtype)
+                    else:
+                        ref_img = torch.stack(ref_image_list, dim=0).to(
+                            dtype=vae.dtype, device=vae.device
+                        )
+                        with record_function("vae_encode"):
+                            ref_image_latents = vae.encode(
+                                ref_img
+                            ).latent_dist.sample()  # (bs, d, 64, 64)
                     ref_image_latents = ref_image_latents * 0.18215
 
                     clip_img = torch.stack(clip_image_list, dim=0).to(
                         dtype=image_enc.dtype, device=image_enc.device
                     )
                     clip_img = clip_img.to(device="cuda", dtype=weight_dtype)
-                    clip_image_embeds = image_enc(
-                        clip_img.to("cuda", dtype=weight_dtype)
-                    ).image_embeds
+                    with record_function("clip_encode"):
+                        clip_image_embeds = image_enc(
+                            clip_img.to("cuda", dtype=weight_dtype)
+                        ).image_embeds
                     clip_image_embeds = clip_image_embeds.unsqueeze(1)  # (bs, 1, d)
 
                 # add noise
@@ -558,15 +589,17 @@ def main(cfg):
                 train_loss += avg_loss.item() / cfg.solver.gradient_accumulation_steps
 
                 # Backpropagate
-                accelerator.backward(loss)
-                if accelerator.sync_gradients:
-                    accelerator.clip_grad_norm_(
-                        trainable_params,
-                        cfg.solver.max_grad_norm,
-                    )
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                with record_function("backward"):
+                    accelerator.backward(loss)
+                with record_function("optimizer"):
+                    if accelerator.sync_gradients:
+                        accelerator.clip_grad_norm_(
+                            trainable_params,
+                            cfg.solver.max_grad_norm,
+                        )
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad()
 
             if accelerator.sync_gradients:
                 reference_control_reader.clear()
@@ -585,6 +618,7 @@ def main(cfg):
             }
             t_data_start = time.time()
             progress_bar.set_postfix(**logs)
+            profiler.step()
 
             if global_step >= cfg.solver.max_train_steps:
                 break
@@ -600,6 +634,7 @@ def main(cfg):
                 global_step,
             )
 
+    profiler.stop()
     # Create the pipeline using the trained modules and save it.
     accelerator.wait_for_everyone()
     accelerator.end_training()
@@ -617,25 +652,15 @@ def save_checkpoint(model, save_dir, prefix, ckpt_num):
     torch.save(mm_state_dict, save_path)
 
 
-def decode_latents(vae, latents):
-    video_length = latents.shape[2]
-    latents = 1 / 0.18215 * latents
-    latents = rearrange(latents, "b c f h w -> (b f) c h w")
-    # video = self.vae.decode(latents).sample
-    video = []
-    for frame_idx in tqdm(range(latents.shape[0])):
-        video.append(vae.decode(latents[frame_idx : frame_idx + 1]).sample)
-    video = torch.cat(video)
-    video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-    video = (video / 2 + 0.5).clamp(0, 1)
-    # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-    video = video.cpu().float().numpy()
-    return video
+def decode_latents(vae, latents, micro_batch=8, tile_size=None):
+    # frames are decoded micro_batch at a time (optionally in latent tiles) instead of one by one
+    return decode_video_latents(vae, latents, micro_batch, tile_size)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="./configs/train_stage_2.yaml")
+    add_profile_args(parser, unit="training steps")
     args = parser.parse_args()
 
     if args.config[-5:] == ".yaml":
@@ -644,4 +669,4 @@ if __name__ == "__main__":
         config = import_filename(args.config).cfg
     else:
         raise ValueError("Do not support this format config file")
-    main(config)
+    main(config, args)